@@ -41,7 +41,7 @@ from sklearn.decomposition import PCA
 import warnings
 warnings.filterwarnings(action='ignore')
 
-from simulate_expression_compendia_modules import pipeline
+from simulate_expression_compendia_modules import pipeline, compendium_io
 from ponyo import utils, train_vae_modules
 
 from numpy.random import seed
@@ -377,13 +377,9 @@ all_data_df = pd.DataFrame()
 # Get batch 1 data
 partition_1_file = os.path.join(
     compendia_dir,
-    "Partition_1_0.txt.xz")
+    "Partition_1_0")
 
-partition_1 = pd.read_table(
-    partition_1_file,
-    header=0,
-    index_col=0,
-    sep='\t')
+partition_1 = compendium_io.read_compendium(partition_1_file)
 
 
 for i in lst_num_partitions:
@@ -401,13 +397,9 @@ for i in lst_num_partitions:
     # Get data with additional batch effects added
     partition_other_file = os.path.join(
         compendia_dir,
-        "Partition_"+str(i)+"_0.txt.xz")
+        "Partition_"+str(i)+"_0")
 
-    partition_other = pd.read_table(
-        partition_other_file,
-        header=0,
-        index_col=0,
-        sep='\t')
+    partition_other = compendium_io.read_compendium(partition_other_file)
     
     # Simulated data with i batch effects
     partition_data_df =  partition_other
@@ -513,16 +505,9 @@ all_corrected_data_df = pd.DataFrame()
 # Get batch 1 data
 partition_1_file = os.path.join(
     compendia_dir,
-    "Partition_corrected_1_0.txt.xz")
+    "Partition_corrected_1_0")
 
-partition_1 = pd.read_table(
-    partition_1_file,
-    header=0,
-    index_col=0,
-    sep='\t')
-
-# Transpose data to df: sample x gene
-partition_1 = partition_1.T
+partition_1 = compendium_io.read_compendium(partition_1_file)
 
 for i in lst_num_partitions:
     print('Plotting PCA of 1 partition vs {} partitions...'.format(i))
@@ -542,16 +527,9 @@ for i in lst_num_partitions:
     # Get data with additional batch effects added and corrected
     partition_other_file = os.path.join(
         compendia_dir,
-        "Partition_corrected_"+str(i)+"_0.txt.xz")
+        "Partition_corrected_"+str(i)+"_0")
 
-    partition_other = pd.read_table(
-        partition_other_file,
-        header=0,
-        index_col=0,
-        sep='\t')
-    
-    # Transpose data to df: sample x gene
-    partition_other = partition_other.T
+    partition_other = compendium_io.read_compendium(partition_other_file)
     
     # Simulated data with i batch effects that are corrected
     partition_data_df =  partition_other
@@ -41,7 +41,7 @@ from sklearn.decomposition import PCA
 import warnings
 warnings.filterwarnings(action='ignore')
 
-from simulate_expression_compendia_modules import pipeline
+from simulate_expression_compendia_modules import pipeline, compendium_io
 from ponyo import utils, train_vae_modules
 
 from numpy.random import seed
@@ -341,13 +341,9 @@ all_data_df = pd.DataFrame()
 # Get batch 1 data
 experiment_1_file = os.path.join(
     compendia_dir,
-    "Experiment_1_0.txt.xz")
+    "Experiment_1_0")
 
-experiment_1 = pd.read_table(
-    experiment_1_file,
-    header=0,
-    index_col=0,
-    sep='\t')
+experiment_1 = compendium_io.read_compendium(experiment_1_file)
 
 
 for i in lst_num_experiments:
@@ -365,13 +361,9 @@ for i in lst_num_experiments:
     # Get data with additional batch effects added
     experiment_other_file = os.path.join(
         compendia_dir,
-        "Experiment_"+str(i)+"_0.txt.xz")
+        "Experiment_"+str(i)+"_0")
 
-    experiment_other = pd.read_table(
-        experiment_other_file,
-        header=0,
-        index_col=0,
-        sep='\t')
+    experiment_other = compendium_io.read_compendium(experiment_other_file)
     
     # Simulated data with i batch effects
     experiment_data_df =  experiment_other
@@ -478,16 +470,9 @@ all_corrected_data_df = pd.DataFrame()
 # Get batch 1 data
 experiment_1_file = os.path.join(
     compendia_dir,
-    "Experiment_corrected_1_0.txt.xz")
+    "Experiment_corrected_1_0")
 
-experiment_1 = pd.read_table(
-    experiment_1_file,
-    header=0,
-    index_col=0,
-    sep='\t')
-
-# Transpose data to df: sample x gene
-experiment_1 = experiment_1.T
+experiment_1 = compendium_io.read_compendium(experiment_1_file)
 
 for i in lst_num_experiments:
     print('Plotting PCA of 1 experiment vs {} experiments...'.format(i))
@@ -507,16 +492,9 @@ for i in lst_num_experiments:
     # Get data with additional batch effects added and corrected
     experiment_other_file = os.path.join(
         compendia_dir,
-        "Experiment_corrected_"+str(i)+"_0.txt.xz")
+        "Experiment_corrected_"+str(i)+"_0")
 
-    experiment_other = pd.read_table(
-        experiment_other_file,
-        header=0,
-        index_col=0,
-        sep='\t')
-    
-    # Transpose data to df: sample x gene
-    experiment_other = experiment_other.T
+    experiment_other = compendium_io.read_compendium(experiment_other_file)
     
     # Simulated data with i batch effects that are corrected
     experiment_data_df =  experiment_other
@@ -0,0 +1,302 @@
+"""
+Author: Alexandra Lee
+Date Created: 17 October 2026
+
+Content-addressed cache of the outputs of the simulation stages (simulated
+compendia, technical variation added and corrected compendia).
+
+Each output is stored in a directory named by the hash of the stage and
+everything the output depends on (e.g. hashes of the input files and of the
+trained VAE model, the run, the number of experiments and the correction
+method). Stages whose output is already cached are skipped. When the cache
+grows beyond its disk budget, the least recently used outputs are evicted.
+"""
+
+import os
+import glob
+import json
+import uuid
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+
+# Hashes of files computed by `file_hash`, by (file, size, modification time)
+_file_hashes = {}
+
+
+class ArtifactCache:
+    """
+    Cache of stage outputs stored in <cache_dir>
+
+    Arguments
+    ----------
+    cache_dir: str
+        Directory where outputs are stored
+
+    max_bytes: int or None
+        Disk budget of the cache. If None the cache is not evicted
+    """
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def key(self, stage, params):
+        """
+        Returns the key of the output of <stage>, which is the hash of the
+        stage and its <params>. Callable values of <params> are called to get
+        the value to hash, so that expensive hashes are only computed when
+        the cache is used
+        """
+        params = {
+            name: value() if callable(value) else value
+            for name, value in params.items()
+        }
+        description = json.dumps(
+            {"stage": stage, "params": params}, sort_keys=True, default=str
+        )
+
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def artifact_dir(self, key):
+        """
+        Returns the directory where the output with <key> is stored
+        """
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key):
+        """
+        Returns the directory of the cached output with <key>, or None if the
+        output is not cached. The output is marked as most recently used
+        """
+        artifact_dir = self.artifact_dir(key)
+        if not os.path.exists(artifact_dir):
+            return None
+
+        os.utime(artifact_dir)
+        return artifact_dir
+
+    def put(self, key, save):
+        """
+        Store an output with <key> by calling <save> with the directory to
+        write the output to. The output is written to a temporary directory
+        that is then renamed, so that concurrent runs never see a partially
+        written output
+
+        Returns
+        --------
+        Directory of the cached output
+        """
+        artifact_dir = self.artifact_dir(key)
+        tmp_dir = os.path.join(self.cache_dir, "tmp-" + uuid.uuid4().hex)
+        os.makedirs(tmp_dir)
+
+        try:
+            save(tmp_dir)
+            os.makedirs(os.path.dirname(artifact_dir), exist_ok=True)
+            os.rename(tmp_dir, artifact_dir)
+        except OSError:
+            # The same output was stored by a concurrent run
+            if not os.path.exists(artifact_dir):
+                raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self.evict(keep=key)
+
+        return artifact_dir
+
+    def evict(self, keep=None):
+        """
+        Delete the least recently used outputs until the size of the cache is
+        below its disk budget
+
+        Arguments
+        ----------
+        keep: str
+            Key of an output that should not be evicted
+        """
+        if self.max_bytes is None:
+            return
+
+        artifacts = []
+        for artifact_dir in glob.glob(os.path.join(self.cache_dir, "??", "*")):
+            artifacts.append(
+                (os.path.getmtime(artifact_dir), _dir_size(artifact_dir), artifact_dir)
+            )
+
+        total_bytes = sum(size for _, size, _ in artifacts)
+
+        for _, size, artifact_dir in sorted(artifacts):
+            if total_bytes <= self.max_bytes:
+                break
+            if os.path.basename(artifact_dir) == keep:
+                continue
+
+            shutil.rmtree(artifact_dir, ignore_errors=True)
+            total_bytes -= size
+
+
+def _dir_size(dirname):
+    return sum(
+        os.path.getsize(os.path.join(root, filename))
+        for root, _, filenames in os.walk(dirname)
+        for filename in filenames
+    )
+
+
+def cached(cache, stage, params, compute, save, load):
+    """
+    Returns the output of a stage, loaded from <cache> if it was already
+    computed and computed (and stored in the cache) otherwise
+
+    Arguments
+    ----------
+    cache: ArtifactCache or None
+        Cache to use. If None the output is always computed
+
+    stage: str
+        Name of the stage
+
+    params: dict
+        Everything the output of the stage depends on (see `ArtifactCache.key`)
+
+    compute: function
+        Function without arguments that computes the output
+
+    save: function
+        Function called with the output and the directory to save it to
+
+    load: function
+        Function called with the directory of a cached output that loads it
+    """
+    if cache is None:
+        return compute()
+
+    key = cache.key(stage, params)
+
+    artifact_dir = cache.get(key)
+    if artifact_dir is not None:
+        return load(artifact_dir)
+
+    output = compute()
+    cache.put(key, lambda out_dir: save(output, out_dir))
+
+    return output
+
+
+def file_hash(filename, block_size=2**20):
+    """
+    Returns the hash of the content of a file or, for a directory, of all
+    files in the directory. Hashes are reused as long as the size and
+    modification time of the file are unchanged
+
+    Arguments
+    ----------
+    filename: str
+        File or directory to hash
+
+    block_size: int
+        Number of bytes read at a time
+    """
+    if os.path.isdir(filename):
+        return _hash_strings(
+            [
+                os.path.relpath(path, filename) + file_hash(path)
+                for path in sorted(
+                    glob.glob(os.path.join(filename, "**"), recursive=True)
+                )
+                if os.path.isfile(path)
+            ]
+        )
+
+    stat = os.stat(filename)
+    signature = (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+
+    if signature not in _file_hashes:
+        sha = hashlib.sha256()
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                sha.update(block)
+
+        _file_hashes[signature] = sha.hexdigest()
+
+    return _file_hashes[signature]
+
+
+def _hash_strings(strings):
+    return hashlib.sha256("\n".join(strings).encode()).hexdigest()
+
+
+def array_hash(array):
+    """
+    Returns the hash of the dtype, shape and values of an array
+    """
+    array = np.asarray(array)
+
+    sha = hashlib.sha256(str((array.dtype.str, array.shape)).encode())
+    if array.dtype == object:
+        sha.update(json.dumps(array.tolist(), default=str).encode())
+    else:
+        sha.update(np.ascontiguousarray(array))
+
+    return sha.hexdigest()
+
+
+def frame_hash(data):
+    """
+    Returns the hash of the index, columns and values of a dataframe or series
+    """
+    if isinstance(data, pd.Series):
+        data = data.to_frame()
+
+    numeric_data = data.select_dtypes(include=np.number)
+    other_data = data.drop(columns=numeric_data.columns)
+
+    return _hash_strings(
+        [
+            array_hash(np.asarray(data.index, dtype=str)),
+            array_hash(np.asarray(data.columns, dtype=str)),
+            array_hash(numeric_data.values),
+        ]
+        + [array_hash(other_data[column].astype(str).values) for column in other_data]
+    )
+
+
+def save_frame(data, out_dir):
+    """
+    Save a dataframe or series to a cache directory
+    """
+    data.to_pickle(os.path.join(out_dir, "data.pkl"))
+
+
+def load_frame(artifact_dir):
+    """
+    Load a dataframe or series saved by `save_frame`
+    """
+    return pd.read_pickle(os.path.join(artifact_dir, "data.pkl"))
+
+
+def save_batch_effects(batch_effects, out_dir):
+    """
+    Save the (offsets, assignment) tuples returned by `add_experiments` or
+    `add_experiments_grped` to a cache directory
+    """
+    arrays = {}
+    for i, (offsets, assignment) in enumerate(batch_effects):
+        arrays[f"offsets_{i}"] = offsets
+        arrays[f"assignment_{i}"] = assignment
+
+    np.savez(os.path.join(out_dir, "batch_effects.npz"), **arrays)
+
+
+def load_batch_effects(artifact_dir):
+    """
+    Load the (offsets, assignment) tuples saved by `save_batch_effects`
+    """
+    with np.load(os.path.join(artifact_dir, "batch_effects.npz")) as arrays:
+        return [
+            (arrays[f"offsets_{i}"], arrays[f"assignment_{i}"])
+            for i in range(len(arrays.files) // 2)
+        ]
@@ -0,0 +1,195 @@
+"""
+Author: Alexandra Lee
+Date Created: 17 October 2026
+
+Checkpoints of the tasks of a simulation run, so that a run that was
+interrupted can be resumed without recomputing the tasks it completed.
+
+Each task is identified by its stage (e.g. "simulated_data", "batch_effects",
+"corrected", "svcca_Experiment" or "svcca_permuted") and, for tasks done per
+number of experiments/partitions, that number. The output of each completed
+task is saved in the directory of the run and recorded in the manifest of the
+run (`manifest.json`). Outputs and manifest are written to a temporary file
+that is then renamed, so an interrupted write never leaves a corrupt
+checkpoint.
+"""
+
+import os
+import json
+import shutil
+import pickle
+import hashlib
+
+MANIFEST_FILE = "manifest.json"
+
+# Config parameters that only change how a simulation is run, not its results
+EXECUTION_PARAMS = [
+    "iterations",
+    "num_cores",
+    "export_tsv",
+    "compression",
+    "save_intermediates",
+    "cache_dir",
+    "cache_max_gb",
+    "checkpoint",
+]
+
+
+class Checkpoints:
+    """
+    Checkpoints of the tasks of one simulation run
+
+    Arguments
+    ----------
+    checkpoint_dir: str
+        Directory where checkpoints of all runs of a simulation are stored
+
+    run: int
+        Unique core identifier of the run
+    """
+
+    def __init__(self, checkpoint_dir, run):
+        self.run_dir = os.path.join(checkpoint_dir, f"run_{run}")
+        os.makedirs(self.run_dir, exist_ok=True)
+
+    def task(self, stage, num_experiments=None):
+        """
+        Returns the name of a task
+        """
+        if num_experiments is None:
+            return stage
+        return f"{stage}_{num_experiments}"
+
+    def manifest(self):
+        """
+        Returns the manifest of the run, which maps each completed task to
+        the file containing its output
+        """
+        manifest_file = os.path.join(self.run_dir, MANIFEST_FILE)
+        if not os.path.exists(manifest_file):
+            return {}
+
+        with open(manifest_file) as f:
+            return json.load(f)
+
+    def done(self, stage, num_experiments=None):
+        """
+        Returns True if the task was completed
+        """
+        return self.task(stage, num_experiments) in self.manifest()
+
+    def load(self, stage, num_experiments=None):
+        """
+        Returns the output of a completed task
+        """
+        output_file = self.manifest()[self.task(stage, num_experiments)]
+
+        with open(os.path.join(self.run_dir, output_file), "rb") as f:
+            return pickle.load(f)
+
+    def save(self, stage, output, num_experiments=None):
+        """
+        Save the output of a task and record the task as completed
+        """
+        task = self.task(stage, num_experiments)
+        output_file = task + ".pickle"
+
+        _atomic_write(
+            os.path.join(self.run_dir, output_file),
+            lambda f: pickle.dump(output, f),
+        )
+
+        manifest = self.manifest()
+        manifest[task] = output_file
+
+        _atomic_write(
+            os.path.join(self.run_dir, MANIFEST_FILE),
+            lambda f: f.write(json.dumps(manifest, indent=1).encode()),
+        )
+
+
+def _atomic_write(filename, write):
+    tmp_file = filename + ".tmp"
+    with open(tmp_file, "wb") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, filename)
+
+
+def checkpointed(checkpoints, stage, compute, num_experiments=None):
+    """
+    Returns the output of a task, loaded from <checkpoints> if the task was
+    already completed and computed (and checkpointed) otherwise
+
+    Arguments
+    ----------
+    checkpoints: Checkpoints or None
+        Checkpoints of the run. If None the output is always computed
+
+    stage: str
+        Stage of the task
+
+    compute: function
+        Function without arguments that computes the output
+
+    num_experiments: int
+        Number of experiments/partitions of the task, for tasks done per
+        number of experiments/partitions
+    """
+    if checkpoints is None:
+        return compute()
+
+    if checkpoints.done(stage, num_experiments):
+        return checkpoints.load(stage, num_experiments)
+
+    output = compute()
+    checkpoints.save(stage, output, num_experiments)
+
+    return output
+
+
+def run_checkpoints(checkpoint_dir, run):
+    """
+    Returns the checkpoints of a run, or None if <checkpoint_dir> is None
+    """
+    if checkpoint_dir is None:
+        return None
+    return Checkpoints(checkpoint_dir, run)
+
+
+def simulation_checkpoint_dir(local_dir, name, params):
+    """
+    Returns the directory where checkpoints of a simulation are stored. The
+    directory depends on the parameters of the simulation, so that a run is
+    only resumed using checkpoints of a run with the same parameters.
+    Parameters in `EXECUTION_PARAMS` are ignored, so that e.g. an interrupted
+    simulation can be resumed using fewer cores
+
+    Arguments
+    ----------
+    local_dir: str
+        Parent directory on local machine to store intermediate results
+
+    name: str
+        Name of the simulation
+
+    params: dict
+        Parameters of the simulation
+    """
+    params = {
+        name: value for name, value in params.items() if name not in EXECUTION_PARAMS
+    }
+    params_hash = hashlib.sha256(
+        json.dumps(params, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+    return os.path.join(local_dir, "checkpoints", f"{name}_{params_hash[:12]}")
+
+
+def remove_checkpoints(checkpoint_dir):
+    """
+    Delete the checkpoints of a simulation once all of its runs are completed
+    """
+    if checkpoint_dir is not None:
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
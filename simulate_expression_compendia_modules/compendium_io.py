@@ -0,0 +1,634 @@
+"""
+Author: Alexandra Lee
+Date Created: 17 October 2026
+
+Scripts to store and load simulated compendia. Each compendium is saved as
+a binary store: a directory containing a float32 matrix (`matrix.npy`) that
+can be memory-mapped, plus sidecar files with the sample and gene ids.
+Compendia can optionally be exported as compressed tab-delimited text as
+well (see `table_io.py`).
+
+Compendia with technical variation added are delta-encoded: they only store
+the (partitions x genes) offsets and the partition assigned to each sample,
+together with a reference to the base compendium stored once per run.
+The experiment/partition maps of these compendia are stored as int16 codes
+aligned to the samples of the base compendium.
+
+All compendia are stored in a single canonical orientation (sample x gene),
+which is recorded in the metadata of the store. Readers can request either
+orientation and get a (zero-copy) view of the stored matrix.
+"""
+
+import os
+import json
+import numpy as np
+import pandas as pd
+from simulate_expression_compendia_modules import table_io
+
+STORE_EXT = ".compendium"
+MAP_EXT = ".npy"
+
+# Experiments/partitions are stored as integer codes of this type
+MAP_DTYPE = np.int16
+
+SAMPLE_X_GENE = "sample x gene"
+GENE_X_SAMPLE = "gene x sample"
+
+# Orientation that all compendia are stored in
+ORIENTATION = SAMPLE_X_GENE
+
+
+def compendium_file(compendium_dir, file_prefix, num_experiments, run):
+    """
+    Returns the file name (without extension) of a compendium, of the
+    form <file_prefix>_<num_experiments>_<run>
+
+    Arguments
+    ----------
+    compendium_dir: str
+        Directory where compendia are stored
+
+    file_prefix: str
+        File prefix to determine whether to use data before correction ("Experiment" or "Partition")
+        or after correction ("Experiment_corrected" or "Parition_corrected")
+
+    num_experiments: int
+        Number of experiments/partitions added to the compendium
+
+    run: int
+        Unique core identifier that is used to create unique filenames for intermediate files
+    """
+    return os.path.join(compendium_dir, f"{file_prefix}_{num_experiments}_{run}")
+
+
+def base_compendium_file(compendium_dir, file_prefix, run):
+    """
+    Returns the file name (without extension) of the base compendium that
+    delta-encoded compendia are stored relative to, of the form
+    <file_prefix>_base_<run>
+
+    Arguments
+    ----------
+    compendium_dir: str
+        Directory where compendia are stored
+
+    file_prefix: str
+        File prefix of the compendia ("Experiment" or "Partition")
+
+    run: int
+        Unique core identifier that is used to create unique filenames for intermediate files
+    """
+    return os.path.join(compendium_dir, f"{file_prefix}_base_{run}")
+
+
+def map_file(compendium_dir, file_prefix, num_experiments, run):
+    """
+    Returns the file name (without extension) of the map with the
+    experiment/partition each sample of a compendium is assigned to, of the
+    form <file_prefix>_map_<num_experiments>_<run>
+
+    Arguments
+    ----------
+    compendium_dir: str
+        Directory where compendia are stored
+
+    file_prefix: str
+        File prefix of the compendia ("Experiment" or "Partition")
+
+    num_experiments: int
+        Number of experiments/partitions added to the compendium
+
+    run: int
+        Unique core identifier that is used to create unique filenames for intermediate files
+    """
+    return os.path.join(compendium_dir, f"{file_prefix}_map_{num_experiments}_{run}")
+
+
+def _to_list(index):
+    # Convert numpy scalars so that ids can be stored as json
+    return [x.item() if isinstance(x, np.generic) else x for x in index]
+
+
+def create_compendium(out_file, shape):
+    """
+    Create an empty binary compendium store that can be filled in blocks.
+    Sample and gene ids are saved separately using `write_compendium_ids`
+
+    Arguments
+    ----------
+    out_file: str
+        File name of compendium without extension
+
+    shape: tuple
+        Shape (sample x gene) of the compendium
+
+    Returns
+    --------
+    Writable float32 memory map of the compendium matrix
+    """
+    store_dir = out_file + STORE_EXT
+    os.makedirs(store_dir, exist_ok=True)
+
+    with open(os.path.join(store_dir, "meta.json"), "w") as f:
+        json.dump(
+            {
+                "shape": list(shape),
+                "dtype": "float32",
+                "encoding": "dense",
+                "orientation": ORIENTATION,
+            },
+            f,
+        )
+
+    return np.lib.format.open_memmap(
+        os.path.join(store_dir, "matrix.npy"),
+        mode="w+",
+        dtype=np.float32,
+        shape=tuple(shape),
+    )
+
+
+def write_compendium_ids(out_file, samples, genes):
+    """
+    Save the sample and gene ids of a binary compendium store
+
+    Arguments
+    ----------
+    out_file: str
+        File name of compendium without extension
+
+    samples: list
+        Row ids of the compendium
+
+    genes: list
+        Column ids of the compendium
+    """
+    store_dir = out_file + STORE_EXT
+
+    with open(os.path.join(store_dir, "samples.json"), "w") as f:
+        json.dump(_to_list(samples), f)
+    with open(os.path.join(store_dir, "genes.json"), "w") as f:
+        json.dump(_to_list(genes), f)
+
+
+def write_compendium(
+    data,
+    out_file,
+    export_tsv=False,
+    float_format="%.3f",
+    compression=table_io.DEFAULT_COMPRESSION,
+    orientation=SAMPLE_X_GENE,
+):
+    """
+    Save expression data as a binary compendium store. The data is stored
+    in the canonical sample x gene orientation
+
+    Arguments
+    ----------
+    data: df
+        Dataframe containing gene expression data
+
+    out_file: str
+        File name of compendium without extension. The store is saved to
+        <out_file>.compendium and the optional text export to <out_file>.txt
+        with the extension of the codec added (e.g. <out_file>.txt.xz)
+
+    export_tsv: bool
+        True if the compendium should also be exported as a tab-delimited file
+
+    float_format: str
+        Format used to write values in the tab-delimited export
+
+    compression: str or dict
+        Compression codec of the tab-delimited export (see `table_io.py`)
+
+    orientation: str
+        Orientation of <data>. Either "sample x gene" or "gene x sample"
+    """
+    if _check_orientation(orientation) != ORIENTATION:
+        data = data.T
+
+    matrix = create_compendium(out_file, data.shape)
+    matrix[:] = data.values
+    matrix.flush()
+    del matrix
+
+    write_compendium_ids(out_file, data.index, data.columns)
+
+    if export_tsv:
+        table_io.write_table(
+            data,
+            table_io.table_file(out_file, compression),
+            compression,
+            float_format=float_format,
+        )
+
+
+def write_delta_compendium(
+    base_file,
+    offsets,
+    assignment,
+    out_file,
+    export_tsv=False,
+    float_format="%.3f",
+    compression=table_io.DEFAULT_COMPRESSION,
+):
+    """
+    Save a compendium with technical variation added as offsets relative to
+    a base compendium. The compendium is equal to
+    base + offsets[assignment], where row i of the base is shifted by the
+    offsets of the partition it is assigned to.
+
+    Arguments
+    ----------
+    base_file: str
+        File name (without extension) of the base compendium. Must be stored
+        in the same directory as <out_file>
+
+    offsets: array
+        Array of shape (number of partitions, number of genes) containing the
+        shift added to each partition
+
+    assignment: array
+        Array of length (number of samples) with the partition each row of
+        the base compendium is assigned to
+
+    out_file: str
+        File name of compendium without extension
+
+    export_tsv: bool
+        True if the compendium should also be exported as a tab-delimited file
+
+    float_format: str
+        Format used to write values in the tab-delimited export
+
+    compression: str or dict
+        Compression codec of the tab-delimited export (see `table_io.py`)
+    """
+    store_dir = out_file + STORE_EXT
+    os.makedirs(store_dir, exist_ok=True)
+
+    offsets = np.asarray(offsets, dtype=np.float32)
+    assignment = np.asarray(assignment, dtype=MAP_DTYPE)
+
+    np.save(os.path.join(store_dir, "offsets.npy"), offsets)
+    np.save(os.path.join(store_dir, "assignment.npy"), assignment)
+
+    with open(os.path.join(store_dir, "meta.json"), "w") as f:
+        json.dump(
+            {
+                "shape": [len(assignment), offsets.shape[1]],
+                "dtype": "float32",
+                "encoding": "delta",
+                "orientation": ORIENTATION,
+                "base": os.path.basename(base_file),
+            },
+            f,
+        )
+
+    if export_tsv:
+        export_compendium(out_file, float_format=float_format, compression=compression)
+
+
+def write_partition_map(assignment, out_file):
+    """
+    Save the experiment/partition each sample is assigned to as an array of
+    int16 codes. The array is aligned to the samples (rows) of the base
+    compendium of the run, which is shared by all compendia and maps
+
+    Arguments
+    ----------
+    assignment: array
+        Array of length (number of samples) with the experiment/partition
+        each sample is assigned to
+
+    out_file: str
+        File name of map without extension
+    """
+    assignment = np.asarray(assignment)
+    if len(assignment) > 0 and assignment.max() > np.iinfo(MAP_DTYPE).max:
+        raise ValueError(
+            f"Cannot store more than {np.iinfo(MAP_DTYPE).max + 1} experiments/partitions"
+        )
+
+    np.save(out_file + MAP_EXT, assignment.astype(MAP_DTYPE))
+
+
+def partition_map(assignment, samples):
+    """
+    Returns the experiment/partition each sample is assigned to as a
+    categorical series of codes, the form used by the correction methods.
+    Categories are the codes as strings ("0", "1", ...), since rpy2 only
+    converts categoricals with string categories to R factors
+
+    Arguments
+    ----------
+    assignment: array
+        Array of length (number of samples) with the experiment/partition
+        each sample is assigned to
+
+    samples: list
+        Sample ids the map is aligned to
+    """
+    assignment = np.asarray(assignment)
+    num_partitions = assignment.max() + 1 if len(assignment) > 0 else 0
+    labels = pd.Categorical.from_codes(
+        assignment, categories=np.arange(num_partitions).astype(str)
+    )
+
+    return pd.Series(labels.remove_unused_categories(), index=samples)
+
+
+def read_partition_map(map_file, samples):
+    """
+    Load an experiment/partition map saved by `write_partition_map`
+
+    Arguments
+    ----------
+    map_file: str
+        File name of map without extension
+
+    samples: list
+        Sample ids the map is aligned to
+
+    Returns
+    --------
+    Categorical series with the experiment/partition code of each sample
+    """
+    return partition_map(np.load(map_file + MAP_EXT), samples)
+
+
+def _check_orientation(orientation):
+    if orientation not in [SAMPLE_X_GENE, GENE_X_SAMPLE]:
+        raise ValueError(
+            f"Unknown orientation {orientation}. "
+            f"Expected '{SAMPLE_X_GENE}' or '{GENE_X_SAMPLE}'"
+        )
+    return orientation
+
+
+def _read_meta(compendium_file):
+    with open(os.path.join(compendium_file + STORE_EXT, "meta.json")) as f:
+        meta = json.load(f)
+    meta.setdefault("encoding", "dense")
+    meta.setdefault("orientation", ORIENTATION)
+    return meta
+
+
+def read_compendium_ids(compendium_file):
+    """
+    Load the sample and gene ids of a compendium
+
+    Arguments
+    ----------
+    compendium_file: str
+        File name of compendium without extension
+
+    Returns
+    --------
+    samples: list
+        Row ids of the compendium
+
+    genes: list
+        Column ids of the compendium
+    """
+    meta = _read_meta(compendium_file)
+    if meta["encoding"] == "delta":
+        compendium_file = os.path.join(os.path.dirname(compendium_file), meta["base"])
+
+    store_dir = compendium_file + STORE_EXT
+
+    with open(os.path.join(store_dir, "samples.json")) as f:
+        samples = json.load(f)
+    with open(os.path.join(store_dir, "genes.json")) as f:
+        genes = json.load(f)
+
+    return samples, genes
+
+
+def read_delta_compendium(compendium_file, mmap_mode="r"):
+    """
+    Load the components of a delta-encoded compendium without reconstructing
+    the compendium
+
+    Arguments
+    ----------
+    compendium_file: str
+        File name of compendium without extension
+
+    mmap_mode: str or None
+        Mode used to memory-map the base matrix (see `numpy.load`)
+
+    Returns
+    --------
+    base: array
+        Base expression matrix (sample x gene)
+
+    offsets: array
+        Shift added to each partition (partition x gene)
+
+    assignment: array
+        Partition each sample is assigned to
+
+    samples: list
+        Row ids of the compendium
+
+    genes: list
+        Column ids of the compendium
+    """
+    meta = _read_meta(compendium_file)
+    if meta["encoding"] != "delta":
+        raise ValueError(f"{compendium_file} is not a delta-encoded compendium")
+
+    store_dir = compendium_file + STORE_EXT
+    base_file = os.path.join(os.path.dirname(compendium_file), meta["base"])
+
+    base, samples, genes = read_compendium_array(base_file, mmap_mode)
+    offsets = np.load(os.path.join(store_dir, "offsets.npy"))
+    assignment = np.load(os.path.join(store_dir, "assignment.npy"))
+
+    return base, offsets, assignment, samples, genes
+
+
+def iter_compendium_blocks(compendium_file, block_size=1000):
+    """
+    Iterate over blocks of rows of a compendium. Delta-encoded compendia are
+    reconstructed one block at a time, so only <block_size> rows are held in
+    memory.
+
+    Arguments
+    ----------
+    compendium_file: str
+        File name of compendium without extension
+
+    block_size: int
+        Number of rows per block
+
+    Returns
+    --------
+    Generator of (start row, block of rows) tuples
+    """
+    if _read_meta(compendium_file)["encoding"] == "delta":
+        base, offsets, assignment, _, _ = read_delta_compendium(compendium_file)
+        for start in range(0, base.shape[0], block_size):
+            stop = start + block_size
+            yield start, base[start:stop] + offsets[assignment[start:stop]]
+    else:
+        matrix, _, _ = read_compendium_array(compendium_file)
+        for start in range(0, matrix.shape[0], block_size):
+            yield start, matrix[start : start + block_size]
+
+
+def read_compendium_genes(compendium_file, start, stop):
+    """
+    Load the values of a block of genes of a compendium. Delta-encoded
+    compendia are reconstructed for these genes only, so only the values of
+    the block are held in memory
+
+    Arguments
+    ----------
+    compendium_file: str
+        File name of compendium without extension
+
+    start: int
+        First gene of the block
+
+    stop: int
+        Last gene of the block (excluded)
+
+    Returns
+    --------
+    Array (gene x sample) with the values of the genes
+    """
+    if _read_meta(compendium_file)["encoding"] == "delta":
+        base, offsets, assignment, _, _ = read_delta_compendium(compendium_file)
+        block = base[:, start:stop] + offsets[assignment, start:stop]
+    else:
+        matrix, _, _ = read_compendium_array(compendium_file)
+        block = np.array(matrix[:, start:stop])
+
+    return block.T
+
+
+def read_compendium_array(compendium_file, mmap_mode="r", orientation=SAMPLE_X_GENE):
+    """
+    Load the matrix stored in a binary compendium store together with its
+    sample and gene ids. Delta-encoded compendia are reconstructed in memory.
+
+    Arguments
+    ----------
+    compendium_file: str
+        File name of compendium without extension
+
+    mmap_mode: str or None
+        Mode used to memory-map the matrix (see `numpy.load`). If None the
+        matrix is read into memory
+
+    orientation: str
+        Orientation of the returned matrix. Either "sample x gene" or
+        "gene x sample". If it differs from the stored orientation, a
+        transposed view of the stored matrix is returned without copying
+
+    Returns
+    --------
+    matrix: array
+        Expression matrix stored as float32
+
+    samples: list
+        Sample ids of the matrix
+
+    genes: list
+        Gene ids of the matrix
+    """
+    meta = _read_meta(compendium_file)
+
+    if meta["encoding"] == "delta":
+        base, offsets, assignment, samples, genes = read_delta_compendium(
+            compendium_file, mmap_mode
+        )
+        matrix = base + offsets[assignment]
+    else:
+        store_dir = compendium_file + STORE_EXT
+
+        matrix = np.load(os.path.join(store_dir, "matrix.npy"), mmap_mode=mmap_mode)
+        samples, genes = read_compendium_ids(compendium_file)
+
+    if _check_orientation(orientation) != meta["orientation"]:
+        matrix = matrix.T
+
+    return matrix, samples, genes
+
+
+def read_compendium(compendium_file, mmap_mode="r", orientation=SAMPLE_X_GENE):
+    """
+    Load a binary compendium store as a dataframe. By default the dataframe
+    of a dense compendium is backed by a read-only memory map of the stored
+    matrix.
+
+    Arguments
+    ----------
+    compendium_file: str
+        File name of compendium without extension
+
+    mmap_mode: str or None
+        Mode used to memory-map the matrix (see `numpy.load`). If None the
+        matrix is read into memory
+
+    orientation: str
+        Orientation of the returned dataframe. Either "sample x gene" or
+        "gene x sample" (see `read_compendium_array`)
+
+    Returns
+    --------
+    Dataframe containing gene expression data
+    """
+    matrix, samples, genes = read_compendium_array(
+        compendium_file, mmap_mode, orientation
+    )
+
+    if orientation == GENE_X_SAMPLE:
+        return pd.DataFrame(matrix, index=genes, columns=samples, copy=False)
+
+    return pd.DataFrame(matrix, index=samples, columns=genes, copy=False)
+
+
+def export_compendium(
+    compendium_file,
+    out_file=None,
+    float_format="%.3f",
+    compression=table_io.DEFAULT_COMPRESSION,
+    block_size=1000,
+):
+    """
+    Export a binary compendium store as a compressed tab-delimited file.
+    The compendium is written in blocks of rows, so only <block_size> rows
+    are held in memory
+
+    Arguments
+    ----------
+    compendium_file: str
+        File name of compendium without extension
+
+    out_file: str
+        File to write. Defaults to <compendium_file>.txt with the extension
+        of the codec added
+
+    float_format: str
+        Format used to write values
+
+    compression: str or dict
+        Compression codec (see `table_io.py`)
+
+    block_size: int
+        Number of rows written at a time
+    """
+    if out_file is None:
+        out_file = table_io.table_file(compendium_file, compression)
+
+    samples, genes = read_compendium_ids(compendium_file)
+
+    with table_io.open_file(out_file, "w", compression) as f:
+        for start, block in iter_compendium_blocks(compendium_file, block_size):
+            pd.DataFrame(
+                block, index=samples[start : start + len(block)], columns=genes
+            ).to_csv(f, sep="\t", float_format=float_format, header=start == 0)
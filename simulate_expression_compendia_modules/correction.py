@@ -0,0 +1,715 @@
+"""
+Author: Alexandra Lee
+Date Created: 17 October 2026
+
+Noise correction methods implemented in numpy/scipy, so that compendia can be
+corrected without converting them to and from R objects.
+
+`remove_batch_effect` is a port of limma's `removeBatchEffect`: a linear model
+with the batch covariates (sum-to-zero contrasts of each batch factor) and the
+design is fit to each gene, and the fitted batch effects are subtracted.
+With a single batch factor and no other covariates (the designs of the
+simulations), the fitted batch effect of a sample is the mean of its batch
+minus the mean of the batch means, so the data is corrected from batch means
+in O(samples x genes) without fitting the model.
+
+`combat` is a port of sva's `ComBat`: the data is standardized per gene, and
+the mean and variance of each batch are shrunk towards priors estimated
+across genes (empirical Bayes) before being removed.
+
+Both corrections can read and correct compendia in blocks of genes in a
+thread pool (`remove_batch_effect_blocks` and `combat_blocks`), so that only
+a few blocks of a compendium are held in memory at a time.
+
+Correction methods, selected by name using the "correction_method" config
+parameter, are registered in `METHODS`: the R packages ("limma" and
+"combat"), their numpy ports ("limma_numpy" and "combat_numpy") and "none",
+which leaves the data uncorrected. R is only started when an R method is
+first used.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import linalg, sparse
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+# Tolerance used to detect columns of a design matrix that are linearly
+# dependent on the previous columns (the default of R's `lm.fit`)
+RANK_TOLERANCE = 1e-7
+
+# Convergence criterion of the iterative estimation of the batch effects of
+# ComBat with parametric priors (the default of sva's `it.sol`)
+COMBAT_CONVERGENCE = 1e-4
+
+# Number of genes read and corrected at a time by the blocked corrections
+# (see `remove_batch_effect_blocks` and `combat_blocks`)
+CORRECTION_BLOCK_SIZE = 2048
+
+# Number of genes whose batch effects are estimated at a time by ComBat with
+# non-parametric priors, which bounds the memory used by the likelihoods of
+# the batch effects of all genes (genes x block size)
+COMBAT_BLOCK_SIZE = 1024
+
+
+def _factor_codes(factor):
+    # Code of the level of each sample. Levels are ordered as the categories
+    # of a categorical, as R orders the levels of a factor, and unused levels
+    # are dropped
+    return np.unique(pd.Categorical(factor).codes, return_inverse=True)[1]
+
+
+def _map_blocks(function, num_genes, block_size, num_threads):
+    # Results of <function>(start, stop) for each block of <block_size> genes,
+    # in order, computed in <num_threads> threads
+    starts = range(0, num_genes, block_size)
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        return list(
+            executor.map(
+                lambda start: function(start, min(start + block_size, num_genes)),
+                starts,
+            )
+        )
+
+
+def group_means(x, codes):
+    """
+    Returns the mean of each group of samples, as an array (gene x groups),
+    without building the design matrix of the groups
+
+    Arguments
+    ----------
+    x: array
+        Gene expression data (gene x sample)
+
+    codes: array
+        Group of each sample, from 0 to the number of groups - 1
+    """
+    indicators = sparse.csr_matrix(
+        (np.ones(len(codes)), (np.arange(len(codes)), codes))
+    )
+
+    return np.asarray(indicators.T.dot(x.T)).T / np.bincount(codes)
+
+
+def sum_contrasts(factor):
+    """
+    Returns the covariates of a factor coded with sum-to-zero contrasts (R's
+    `contr.sum`), as used by limma's `removeBatchEffect`: an array
+    (samples x levels - 1) where column j is 1 for the samples of level j, -1
+    for the samples of the last level and 0 otherwise
+
+    Arguments
+    ----------
+    factor: array, series or categorical
+        Level of each sample
+    """
+    codes = _factor_codes(factor)
+    num_levels = codes.max() + 1
+
+    covariates = np.zeros((len(codes), num_levels - 1))
+    covariates[codes < num_levels - 1, codes[codes < num_levels - 1]] = 1
+    covariates[codes == num_levels - 1] = -1
+
+    return covariates
+
+
+def _independent_columns(X):
+    # Columns of <X> that are not linearly dependent on the previous columns,
+    # the columns whose coefficients R's `lm.fit` estimates (the others are
+    # NA, and set to 0 by `removeBatchEffect`)
+    norms = np.linalg.norm(X, axis=0)
+    basis = np.zeros((X.shape[0], 0))
+    independent = []
+
+    for j in range(X.shape[1]):
+        residual = X[:, j] - basis @ (basis.T @ X[:, j])
+        residual -= basis @ (basis.T @ residual)
+        residual_norm = np.linalg.norm(residual)
+
+        if residual_norm > RANK_TOLERANCE * norms[j]:
+            basis = np.column_stack([basis, residual / residual_norm])
+            independent.append(j)
+
+    return np.array(independent, dtype=int)
+
+
+def remove_batch_effect(x, batch=None, batch2=None, covariates=None, design=None):
+    """
+    Removes batch effects from expression data, as limma's
+    `removeBatchEffect`. Values are assumed to be finite
+
+    Arguments
+    ----------
+    x: array or df
+        Gene expression data (gene x sample)
+
+    batch: array, series or categorical
+        Batch of each sample
+
+    batch2: array, series or categorical
+        Second batch of each sample
+
+    covariates: array
+        Array (samples x covariates) of numeric covariates to remove
+
+    design: array
+        Design matrix (samples x covariates) of the effects to preserve. By
+        default only the mean of each gene is preserved
+
+    Returns
+    --------
+    Array with corrected gene expression data (gene x sample)
+    """
+    x = np.asarray(x, dtype=float)
+
+    if batch is not None and batch2 is None and covariates is None and design is None:
+        codes = _factor_codes(batch)
+        batch_means = group_means(x, codes)
+
+        return x - batch_means[:, codes] + batch_means.mean(axis=1, keepdims=True)
+
+    X_batch = [
+        sum_contrasts(factor) for factor in (batch, batch2) if factor is not None
+    ]
+    if covariates is not None:
+        X_batch.append(np.asarray(covariates, dtype=float).reshape(x.shape[1], -1))
+
+    if len(X_batch) == 0:
+        return x.copy()
+
+    X_batch = np.column_stack(X_batch)
+
+    if design is None:
+        design = np.ones((x.shape[1], 1))
+    design = np.asarray(design, dtype=float).reshape(x.shape[1], -1)
+
+    X = np.column_stack([design, X_batch])
+    independent = _independent_columns(X)
+
+    coefficients = linalg.lstsq(X[:, independent], x.T)[0]
+
+    # Coefficients of the batch covariates, 0 for those that are not estimable
+    beta = np.zeros((X.shape[1], x.shape[0]))
+    beta[independent] = coefficients
+    beta = beta[design.shape[1] :]
+
+    return x - (X_batch @ beta).T
+
+
+def remove_batch_effect_blocks(
+    read_block,
+    write_block,
+    num_genes,
+    batch=None,
+    batch2=None,
+    covariates=None,
+    design=None,
+    num_threads=None,
+    block_size=CORRECTION_BLOCK_SIZE,
+):
+    """
+    Removes batch effects from expression data, as limma's
+    `removeBatchEffect`, reading and correcting the data in blocks of genes.
+    Genes are corrected independently, so blocks are read and corrected in
+    <num_threads> threads and only about <num_threads> blocks are held in
+    memory
+
+    Arguments
+    ----------
+    read_block: function
+        Function called with the first and last (excluded) gene of a block
+        that returns the data of the block as an array (gene x sample)
+
+    write_block: function
+        Function called with the first and last (excluded) gene of a block
+        and its corrected data (gene x sample)
+
+    num_genes: int
+        Number of genes of the data
+
+    batch, batch2, covariates, design:
+        Batch effects to remove and effects to preserve (see
+        `remove_batch_effect`)
+
+    num_threads: int
+        Number of threads. By default, the default number of threads of
+        `ThreadPoolExecutor`
+
+    block_size: int
+        Number of genes read and corrected at a time
+    """
+    _map_blocks(
+        lambda start, stop: write_block(
+            start,
+            stop,
+            remove_batch_effect(
+                read_block(start, stop), batch, batch2, covariates, design
+            ),
+        ),
+        num_genes,
+        block_size,
+        num_threads,
+    )
+
+
+def _postmean(g_hat, g_bar, n, d_star, t2):
+    return (t2 * n * g_hat + d_star * g_bar) / (t2 * n + d_star)
+
+
+def _postvar(sum2, n, a, b):
+    return (0.5 * sum2 + b) / (n / 2 + a - 1)
+
+
+def _parametric_batch_effects(g_hat, within, d_hat, n, g_bar, t2, a, b):
+    # Posterior batch effects of all genes for parametric priors, iterating
+    # between the posterior mean and variance until they converge (sva's
+    # `it.sol`). The sum of squared residuals of a gene given a mean batch
+    # effect is computed from its batch mean and within-batch sum of squares
+    g_old, d_old = g_hat, d_hat
+
+    change = 1
+    while change > COMBAT_CONVERGENCE:
+        g_new = _postmean(g_hat, g_bar, n, d_old, t2)
+        sum2 = within + n * (g_hat - g_new) ** 2
+        d_new = _postvar(sum2, n, a, b)
+
+        change = max(
+            np.max(np.abs(g_new - g_old) / g_old), np.max(np.abs(d_new - d_old) / d_old)
+        )
+        g_old, d_old = g_new, d_new
+
+    return g_new, d_new
+
+
+def _nonparametric_batch_effects(g_hat, within, d_hat, n, start, stop):
+    # Posterior batch effects of genes <start> to <stop> for non-parametric
+    # priors: the average of the batch effects of all other genes, weighted by
+    # the likelihood of the data of the gene given each of them (sva's
+    # `int.eprior`). Likelihoods are normalized in log space so that they do
+    # not underflow
+
+    # Sum of squared residuals of each gene of the block (columns) given the
+    # mean batch effect of each gene (rows)
+    resid2 = (
+        within[None, start:stop] + n * (g_hat[None, start:stop] - g_hat[:, None]) ** 2
+    )
+    log_likelihood = -n / 2 * np.log(2 * np.pi * d_hat[:, None]) - resid2 / (
+        2 * d_hat[:, None]
+    )
+
+    # The batch effects of a gene are not used as prior of its own
+    block = np.arange(stop - start)
+    log_likelihood[start + block, block] = -np.inf
+
+    weights = np.exp(log_likelihood - log_likelihood.max(axis=0))
+    weights /= weights.sum(axis=0)
+
+    return g_hat @ weights, d_hat @ weights
+
+
+def _combat_design(codes, mod):
+    # Batch indicators and covariates to preserve
+    design = np.zeros((len(codes), codes.max() + 1))
+    design[np.arange(len(codes)), codes] = 1
+
+    if mod is not None:
+        mod = np.asarray(mod, dtype=float).reshape(len(codes), -1)
+        design = np.column_stack([design, mod[:, ~np.all(mod == 1, axis=0)]])
+
+    return design
+
+
+def _combat_standardize(data, codes, design):
+    # Standardized data of genes (rows of <data>), with the mean and pooled
+    # variance of each gene used to standardize it
+    num_batches = codes.max() + 1
+    batch_sizes = np.bincount(codes)
+
+    # Without covariates, the coefficients are the batch means
+    if design.shape[1] == num_batches:
+        B_hat = group_means(data, codes).T
+        covariate_effects = 0
+    else:
+        B_hat = linalg.solve(design.T @ design, design.T @ data.T)
+        covariate_effects = (design[:, num_batches:] @ B_hat[num_batches:]).T
+    grand_mean = (batch_sizes / len(codes)) @ B_hat[:num_batches]
+
+    var_pooled = ((data - B_hat[codes].T - covariate_effects) ** 2).mean(axis=1)
+
+    stand_mean = grand_mean[:, None] + covariate_effects
+    s_data = (data - stand_mean) / np.sqrt(var_pooled)[:, None]
+
+    return s_data, stand_mean, var_pooled
+
+
+def _combat_statistics(x, codes, design):
+    # Genes of <x> that are corrected, those that are not constant within a
+    # batch, and the mean and within-batch sum of squares of each batch of
+    # their standardized data (batches x genes). These are the only
+    # statistics of the data that the posterior batch effects depend on
+    batch_sizes = np.bincount(codes)
+    keep = np.ones(x.shape[0], dtype=bool)
+    for i in np.flatnonzero(batch_sizes > 1):
+        keep &= x[:, codes == i].var(axis=1) != 0
+
+    s_data = _combat_standardize(x[keep], codes, design)[0]
+    gamma_hat = group_means(s_data, codes).T
+    within = group_means((s_data - gamma_hat[codes].T) ** 2, codes).T
+    within *= batch_sizes[:, None]
+
+    return keep, gamma_hat, within
+
+
+def _combat_posteriors(
+    gamma_hat, within, batch_sizes, par_prior, mean_only, num_threads
+):
+    # Posterior mean and variance of the batch effects (batches x genes)
+    if mean_only:
+        delta_hat = np.ones_like(gamma_hat)
+    else:
+        delta_hat = within / (batch_sizes[:, None] - 1)
+
+    gamma_bar = gamma_hat.mean(axis=1)
+    t2 = gamma_hat.var(axis=1, ddof=1)
+
+    if par_prior and not mean_only:
+        delta_mean = delta_hat.mean(axis=1)
+        delta_var = delta_hat.var(axis=1, ddof=1)
+        a_prior = (2 * delta_var + delta_mean**2) / delta_var
+        b_prior = (delta_mean * delta_var + delta_mean**3) / delta_var
+
+    gamma_star = np.empty_like(gamma_hat)
+    delta_star = np.empty_like(delta_hat)
+
+    for i, n in enumerate(batch_sizes):
+        if par_prior and mean_only:
+            gamma_star[i] = _postmean(gamma_hat[i], gamma_bar[i], 1, 1, t2[i])
+            delta_star[i] = 1
+        elif par_prior:
+            gamma_star[i], delta_star[i] = _parametric_batch_effects(
+                gamma_hat[i],
+                within[i],
+                delta_hat[i],
+                n,
+                gamma_bar[i],
+                t2[i],
+                a_prior[i],
+                b_prior[i],
+            )
+        else:
+            blocks = _map_blocks(
+                partial(
+                    _nonparametric_batch_effects,
+                    gamma_hat[i],
+                    within[i],
+                    delta_hat[i],
+                    n,
+                ),
+                gamma_hat.shape[1],
+                COMBAT_BLOCK_SIZE,
+                num_threads,
+            )
+            gamma_star[i] = np.concatenate([g_star for g_star, _ in blocks])
+            delta_star[i] = np.concatenate([d_star for _, d_star in blocks])
+
+    return gamma_star, delta_star
+
+
+def combat_blocks(
+    read_block,
+    write_block,
+    num_genes,
+    batch,
+    mod=None,
+    par_prior=True,
+    mean_only=False,
+    num_threads=None,
+    block_size=CORRECTION_BLOCK_SIZE,
+):
+    """
+    Removes batch effects from expression data using empirical Bayes, as sva's
+    `ComBat`, reading and correcting the data in blocks of genes.
+
+    The posterior batch effects of a gene only depend on its data through the
+    mean and within-batch sum of squares of each batch, so the data is read
+    twice: a first pass gathers these statistics for all genes (batches x
+    genes) and a second pass corrects each block of genes using the posterior
+    batch effects. Blocks are read and corrected in <num_threads> threads, so
+    only about <num_threads> blocks are held in memory. Values are assumed to
+    be finite
+
+    Arguments
+    ----------
+    read_block: function
+        Function called with the first and last (excluded) gene of a block
+        that returns the data of the block as an array (gene x sample)
+
+    write_block: function
+        Function called with the first and last (excluded) gene of a block
+        and its corrected data (gene x sample)
+
+    num_genes: int
+        Number of genes of the data
+
+    batch: array, series or categorical
+        Batch of each sample
+
+    mod: array
+        Design matrix (samples x covariates) of the effects to preserve,
+        besides the mean of each gene. A column of ones is ignored
+
+    par_prior: bool
+        True if the batch effects follow parametric priors (normal for their
+        mean, inverse gamma for their variance), False if the prior of the
+        batch effects of a gene is the batch effects of all other genes
+
+    mean_only: bool
+        True if only the mean of each batch should be adjusted, not its
+        variance. Always True if a batch has a single sample
+
+    num_threads: int
+        Number of threads. By default, the default number of threads of
+        `ThreadPoolExecutor`
+
+    block_size: int
+        Number of genes read and corrected at a time
+    """
+    codes = _factor_codes(batch)
+    batch_sizes = np.bincount(codes)
+    design = _combat_design(codes, mod)
+
+    if np.any(batch_sizes == 1):
+        mean_only = True
+
+    # First pass: statistics of the batch effects of each gene
+    statistics = _map_blocks(
+        lambda start, stop: _combat_statistics(read_block(start, stop), codes, design),
+        num_genes,
+        block_size,
+        num_threads,
+    )
+    keep = np.concatenate([block_keep for block_keep, _, _ in statistics])
+    gamma_hat = np.concatenate([gamma for _, gamma, _ in statistics], axis=1)
+    within = np.concatenate([block_within for _, _, block_within in statistics], axis=1)
+    del statistics
+
+    gamma_star, delta_star = _combat_posteriors(
+        gamma_hat, within, batch_sizes, par_prior, mean_only, num_threads
+    )
+
+    # Position of each corrected gene in the posterior batch effects
+    position = np.cumsum(keep) - 1
+
+    # Second pass: adjust the standardized data, and undo the standardization.
+    # Genes that are constant within a batch are not corrected
+    def adjust(start, stop):
+        data = np.array(read_block(start, stop), dtype=float)
+        block_keep = keep[start:stop]
+        genes = position[start:stop][block_keep]
+
+        s_data, stand_mean, var_pooled = _combat_standardize(
+            data[block_keep], codes, design
+        )
+        corrected = (s_data - gamma_star[:, genes][codes].T) / np.sqrt(
+            delta_star[:, genes][codes].T
+        )
+        data[block_keep] = corrected * np.sqrt(var_pooled)[:, None] + stand_mean
+
+        write_block(start, stop, data)
+
+    _map_blocks(adjust, num_genes, block_size, num_threads)
+
+
+def combat(
+    x,
+    batch,
+    mod=None,
+    par_prior=True,
+    mean_only=False,
+    num_threads=None,
+    block_size=CORRECTION_BLOCK_SIZE,
+):
+    """
+    Removes batch effects from expression data using empirical Bayes, as sva's
+    `ComBat` (see `combat_blocks`). Values are assumed to be finite
+
+    Arguments
+    ----------
+    x: array or df
+        Gene expression data (gene x sample)
+
+    batch: array, series or categorical
+        Batch of each sample
+
+    mod: array
+        Design matrix (samples x covariates) of the effects to preserve,
+        besides the mean of each gene. A column of ones is ignored
+
+    par_prior: bool
+        True if the batch effects follow parametric priors, False otherwise
+
+    mean_only: bool
+        True if only the mean of each batch should be adjusted, not its
+        variance. Always True if a batch has a single sample
+
+    num_threads: int
+        Number of threads the data is corrected in, <block_size> genes at a
+        time. By default, the default number of threads of
+        `ThreadPoolExecutor`
+
+    block_size: int
+        Number of genes corrected at a time
+
+    Returns
+    --------
+    Array with corrected gene expression data (gene x sample)
+    """
+    x = np.asarray(x, dtype=float)
+    corrected_x = np.empty_like(x)
+
+    def write_block(start, stop, block):
+        corrected_x[start:stop] = block
+
+    combat_blocks(
+        lambda start, stop: x[start:stop],
+        write_block,
+        x.shape[0],
+        batch,
+        mod,
+        par_prior,
+        mean_only,
+        num_threads,
+        block_size,
+    )
+
+    return corrected_x
+
+
+# Embedded R packages imported so far (see `_r_package`)
+_r_packages = {}
+
+
+def _r_package(name):
+    # Import an R package with rpy2. The embedded R session is only started,
+    # and the conversion of pandas objects activated, when the first R
+    # package is imported, so runs that do not use an R correction method
+    # never start R
+    if name not in _r_packages:
+        from rpy2.robjects.packages import importr
+        from rpy2.robjects import pandas2ri
+
+        pandas2ri.activate()
+        _r_packages[name] = importr(name)
+
+    return _r_packages[name]
+
+
+def _limma(experiment_data, batch):
+    return _r_package("limma").removeBatchEffect(experiment_data, batch=batch)
+
+
+def _sva_combat(experiment_data, batch):
+    return _r_package("sva").ComBat(np.array(experiment_data), batch=batch)
+
+
+def _limma_numpy(experiment_data, batch):
+    return remove_batch_effect(experiment_data, batch=batch)
+
+
+def _combat_numpy(experiment_data, batch):
+    return combat(experiment_data, batch=batch)
+
+
+def _no_correction(experiment_data, batch):
+    return np.array(experiment_data)
+
+
+def _no_correction_blocks(
+    read_block,
+    write_block,
+    num_genes,
+    batch,
+    num_threads=None,
+    block_size=CORRECTION_BLOCK_SIZE,
+):
+    _map_blocks(
+        lambda start, stop: write_block(start, stop, read_block(start, stop)),
+        num_genes,
+        block_size,
+        num_threads,
+    )
+
+
+# Correction methods by name (see `register_method`)
+METHODS = {}
+
+
+def register_method(name, correct, correct_blocks=None):
+    """
+    Register a noise correction method, so that it can be selected using the
+    "correction_method" config parameter
+
+    Arguments
+    ----------
+    name: str
+        Name of the method
+
+    correct: function
+        Function called with expression data (gene x sample df) and the
+        experiment/partition of each sample (categorical series) that returns
+        the corrected data (gene x sample array, or object convertible to an
+        array)
+
+    correct_blocks: function
+        Function that corrects a compendium in blocks of genes, called with
+        the same arguments as `remove_batch_effect_blocks` (read_block,
+        write_block, num_genes, batch) and the number of threads as keyword
+        argument (num_threads). None if the method can only correct data in
+        memory
+    """
+    METHODS[name] = (correct, correct_blocks)
+
+
+def _method(name):
+    if name not in METHODS:
+        raise ValueError(
+            f"Unknown correction method {name}, expected one of {sorted(METHODS)}"
+        )
+
+    return METHODS[name]
+
+
+def correct(experiment_data, batch, correction_method):
+    """
+    Returns expression data corrected using a registered correction method
+
+    Arguments
+    ----------
+    experiment_data: df
+        Gene expression data (gene x sample)
+
+    batch: series
+        Experiment/partition of each sample
+
+    correction_method: str
+        Name of the correction method (see `register_method`)
+    """
+    return _method(correction_method)[0](experiment_data, batch)
+
+
+def block_correction(correction_method):
+    """
+    Returns the function that corrects compendia in blocks of genes using a
+    registered correction method, or None if the method can only correct data
+    in memory (see `register_method`)
+    """
+    return _method(correction_method)[1]
+
+
+register_method("limma", _limma)
+register_method("combat", _sva_combat)
+register_method("limma_numpy", _limma_numpy, remove_batch_effect_blocks)
+register_method("combat_numpy", _combat_numpy, combat_blocks)
+register_method("none", _no_correction, _no_correction_blocks)
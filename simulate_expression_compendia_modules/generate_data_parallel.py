@@ -14,13 +14,23 @@ import random
 import pandas as pd
 import numpy as np
 import warnings
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
-from rpy2.robjects.packages import importr
-from rpy2.robjects import pandas2ri
+from simulate_expression_compendia_modules import (
+    artifact_cache,
+    checkpoint,
+    compendium_io,
+    correction,
+    table_io,
+)
 
-limma = importr("limma")
-sva = importr("sva")
-pandas2ri.activate()
+# Standard deviation of the shift added to each experiment/partition
+NOISE_SCALE = 0.2
+
+# Number of samples permuted at a time by `permute_rows`, which bounds the
+# memory used by the random sort keys
+PERMUTE_BLOCK_SIZE = 64
 
 
 def fxn():
@@ -32,7 +42,30 @@ with warnings.catch_warnings():
     fxn()
 
 
-def permute_data(simulated_data):
+def permute_rows(values, rng=None, block_size=PERMUTE_BLOCK_SIZE):
+    """
+    Shuffles the values within each row of <values> (2-D array) in place,
+    each row independently. Rows are shuffled <block_size> rows at a time by
+    sorting uniform random keys, which gives every permutation of a row the
+    same probability. If <rng> is None, the keys are drawn from a random
+    state seeded from Python's `random` module, which the permutations were
+    drawn from originally, so the global numpy random state (and the
+    technical variation drawn from it afterwards) is left unchanged
+    """
+    if rng is None:
+        uniform = np.random.RandomState(random.getrandbits(32)).random_sample
+    else:
+        uniform = rng.random
+
+    for start in range(0, values.shape[0], block_size):
+        block = values[start : start + block_size]
+        order = np.argsort(uniform(block.shape), axis=1)
+        block[:] = np.take_along_axis(block, order, axis=1)
+
+    return values
+
+
+def permute_data(simulated_data, rng=None, inplace=False):
     """
     Permute the simulated data
 
@@ -41,26 +74,51 @@ def permute_data(simulated_data):
     simulated_data: df
         Dataframe containing simulated gene expression data
 
+    rng: numpy.random.Generator
+        Random number generator to use. If None, permutations are drawn using
+        Python's `random` module, without drawing from the global numpy random
+        state (see `permute_rows`)
+
+    inplace: bool
+        True if the values of <simulated_data> should be permuted in place
+        instead of a copy, so that the compendium is not held twice in memory.
+        <simulated_data> must not have an "experiment_id" column. Default is
+        False
+
     Returns
     --------
     permuted simulated dataframe. This data will be used as a
     negative control in similarity analysis.
     """
 
+    if inplace:
+        if "experiment_id" in list(simulated_data.columns):
+            raise ValueError(
+                "Data with an experiment_id column cannot be permuted in place"
+            )
+
+        values = simulated_data.values
+        if not values.flags.writeable:
+            values = values.copy()
+
+        # Shuffle values within each sample (row)
+        # Each sample treated independently
+        permute_rows(values, rng)
+
+        # Values of data with columns of several dtypes are a copy
+        if not np.shares_memory(values, simulated_data.values):
+            simulated_data.loc[:, :] = values
+
+        return simulated_data
+
     if "experiment_id" in list(simulated_data.columns):
         simulated_data_tmp = simulated_data.drop(columns="experiment_id", inplace=False)
     else:
-        simulated_data_tmp = simulated_data.copy()
+        simulated_data_tmp = simulated_data
 
     # Shuffle values within each sample (row)
     # Each sample treated independently
-    shuffled_simulated_arr = []
-    num_samples = simulated_data.shape[0]
-
-    for i in range(num_samples):
-        row = list(simulated_data_tmp.values[i])
-        shuffled_simulated_row = random.sample(row, len(row))
-        shuffled_simulated_arr.append(shuffled_simulated_row)
+    shuffled_simulated_arr = permute_rows(np.array(simulated_data_tmp.values), rng)
 
     shuffled_simulated_data = pd.DataFrame(
         shuffled_simulated_arr,
@@ -71,9 +129,171 @@ def permute_data(simulated_data):
     return shuffled_simulated_data
 
 
-def add_experiments_io(
-    simulated_data, num_experiments, run, local_dir, dataset_name, analysis_name
-):
+def draw_batch_effects(num_units, num_genes, num_experiments, order=None, rng=None):
+    """
+    Randomly partitions <num_units> samples (or experiments) into
+    <num_experiments> partitions of almost equal size and draws the shift
+    of all genes added to each partition, sampled from a gaussian
+    distribution centered around 0
+
+    Arguments
+    ----------
+    num_units: int
+        Number of samples (or experiments) to partition
+
+    num_genes: int
+        Number of genes
+
+    num_experiments: int
+        Number of partitions
+
+    order: array
+        Order of the units before they are shuffled. Default is 0..num_units-1
+
+    rng: numpy.random.Generator
+        Random number generator to use. If None, the global numpy random
+        state is used
+
+    Returns
+    --------
+    offsets: array
+        Shift added to each partition (number of partitions x genes)
+
+    assignment: array
+        Partition each unit is assigned to
+    """
+    if rng is None:
+        rng = np.random
+
+    offsets = np.zeros((num_experiments, num_genes))
+    assignment = np.zeros(num_units, dtype=int)
+
+    if num_experiments > 1:
+        if order is None:
+            order = np.arange(num_units)
+        order = np.array(order)
+
+        # Shuffle units
+        rng.shuffle(order)
+
+        # Partition units
+        # Note: Same partition sizes as 'array_split', which returns
+        # num_units % num_experiments partitions with one extra unit
+        sizes = np.full(num_experiments, num_units // num_experiments)
+        sizes[: num_units % num_experiments] += 1
+        assignment[order] = np.repeat(np.arange(num_experiments), sizes)
+
+        # Scalar to shift gene expression data, drawn for all partitions at once
+        offsets = rng.normal(0.0, NOISE_SCALE, [num_experiments, num_genes])
+
+    return offsets, assignment
+
+
+def experiment_row_index(experiment_ids):
+    """
+    Factorizes the experiment id of each sample into integer codes and builds
+    a CSR-style index from each experiment to its samples (rows), so that the
+    samples of any set of experiments are found by array lookups instead of
+    scanning all experiment ids
+
+    Arguments
+    ----------
+    experiment_ids: array
+        Experiment id of each sample
+
+    Returns
+    --------
+    unique_ids: array
+        Experiment ids, in order of appearance
+
+    indptr: array
+        The rows of experiment e are rows[indptr[e]:indptr[e + 1]]
+
+    rows: array
+        Rows of the samples, grouped by experiment
+    """
+    codes, unique_ids = pd.factorize(np.asarray(experiment_ids))
+
+    rows = np.argsort(codes, kind="stable")
+    indptr = np.zeros(len(unique_ids) + 1, dtype=np.intp)
+    np.cumsum(np.bincount(codes, minlength=len(unique_ids)), out=indptr[1:])
+
+    return unique_ids, indptr, rows
+
+
+def sample_assignment(experiment_assignment, indptr, rows):
+    """
+    Returns the partition each sample is assigned to, given the partition
+    <experiment_assignment> each experiment is assigned to and the index
+    returned by `experiment_row_index`
+    """
+    assignment = np.empty(len(rows), dtype=experiment_assignment.dtype)
+    assignment[rows] = np.repeat(experiment_assignment, np.diff(indptr))
+
+    return assignment
+
+
+def add_batch_effects(data, offsets, assignment):
+    """
+    Returns <data> (samples x genes array) with the shift of the partition
+    each sample is assigned to added, i.e. data + offsets[assignment],
+    computed with a single gather into the output array
+    """
+    noisy = np.take(offsets, assignment, axis=0).astype(
+        np.result_type(data, offsets), copy=False
+    )
+    noisy += data
+
+    return noisy
+
+
+def inject_batch_effects(data, num_experiments, groups=None, rng=None):
+    """
+    Adds technical variation of <num_experiments> experiments to gene
+    expression data (see `add_experiments`). Unlike `add_experiments` the
+    data is returned with the technical variation added
+
+    Arguments
+    ----------
+    data: array or df
+        Gene expression data (samples x genes)
+
+    num_experiments: int
+        Number of experiments/partitions to add
+
+    groups: array
+        Experiment id of each sample. If given, samples from the same
+        experiment are kept in the same partition (see `add_experiments_grped`)
+
+    rng: numpy.random.Generator
+        Random number generator to use. If None, the global numpy random
+        state is used
+
+    Returns
+    --------
+    noisy: array
+        Gene expression data with technical variation added
+
+    assignment: array
+        Experiment/partition each sample is assigned to
+    """
+    data = np.asarray(data)
+
+    if groups is None:
+        offsets, assignment = draw_batch_effects(
+            data.shape[0], data.shape[1], num_experiments, rng=rng
+        )
+    else:
+        group_ids, indptr, rows = experiment_row_index(groups)
+        offsets, group_assignment = draw_batch_effects(
+            len(group_ids), data.shape[1], num_experiments, rng=rng
+        )
+        assignment = sample_assignment(group_assignment, indptr, rows)
+
+    return add_batch_effects(data, offsets, assignment), assignment
+
+
+def add_experiments(simulated_data, num_experiments, streams=None):
     """
     Say we are interested in identifying genes that differentiate between
     disease vs normal states. However our dataset includes samples from
@@ -101,138 +321,483 @@ def add_experiments_io(
         List of different numbers of experiments to add to
         simulated data
 
-    run: int
-        Unique core identifier that is used to create unique filenames for intermediate files
+    streams: RandomStreams
+        Random number streams of the run (see `random_streams.py`). If None,
+        the global numpy random state is used
 
-    local_dir: str
-        Parent directory on local machine to store intermediate results
+    Returns
+    --------
+    List of (offsets, assignment) tuples, one per element of <num_experiments>.
+    offsets is an array (number of experiments x genes) containing the shift
+    added to each experiment and assignment is an array with the experiment each
+    sample (row of simulated data) is assigned to. The simulated data with
+    experiments added is simulated_data + offsets[assignment]
+    """
+    return list(_iter_experiments(simulated_data, num_experiments, streams))
 
-    dataset_name: str
-        Name of analysis directory. Either "Human" or "Pseudomonas"
 
-    analysis_name: str
-        Parent directory where simulated data with experiments/partitionings are be stored.
-        Format of the directory name is <dataset>_<sample/experiment>_lvl_sim
+def add_experiments_grped(simulated_data, num_partitions, streams=None):
+    """
+    Similar to `add_experiments` we will model technical variation in our
+    simulated data. In this case, we will keep track of which samples
+    are associated with an experiment.
 
-    Output
+    To do this we will:
+    1. Partition our simulated data into <num_partitions>
+        Here we are keeping track of experiment id and partitioning
+        such that all samples from an experiment are in the same
+        partition.
+
+        Note: Partition sizes will be different since experiment
+        sizes are different per experiment.
+    2. For each partition we will shift all genes using a vector of values
+    sampled from a gaussian distribution centered around 0.
+    3. Repeat this for each partition
+    4. Append all partitions together
+
+    Arguments
+    ----------
+    simulated_data: df
+        Dataframe containing simulated gene expression data and
+        an "experiment_id" column
+
+    num_partitions: list
+        List of different numbers of partitions to add
+        technical variations to
+
+    streams: RandomStreams
+        Random number streams of the run (see `random_streams.py`). If None,
+        the global numpy random state is used
+
+    Returns
     --------
-    Files of simulated data with different numbers of experiments added are save to file.
-    Each file is named as "Experiment_<number of experiments added>"
+    List of (offsets, assignment) tuples, one per element of <num_partitions>.
+    offsets is an array (number of partitions x genes) containing the shift
+    added to each partition and assignment is an array with the partition each
+    sample (row of simulated data) is assigned to. The simulated data with
+    partitions added is simulated_data + offsets[assignment]
     """
-    analysis_dir = os.path.join(
-        local_dir, "experiment_simulated", dataset_name + "_" + analysis_name
-    )
+    return list(_iter_experiments_grped(simulated_data, num_partitions, streams))
 
-    if not os.path.exists(analysis_dir):
-        print("Creating new directory: \n {}".format(analysis_dir))
-        os.makedirs(analysis_dir, exist_ok=True)
 
+def _iter_experiments(simulated_data, num_experiments, streams=None):
     # Add batch effects
     num_genes = simulated_data.shape[1]
 
-    # Create an array of the simulated data indices
-    simulated_ind = np.array(simulated_data.index)
+    # Samples are shuffled starting from their order in the simulated data
+    # for the first number of experiments and from sorted order afterwards.
+    # With streams, each number of experiments has its own stream, so samples
+    # are always shuffled from sorted order for its draw not to depend on the
+    # other numbers of experiments
+    sorted_order = np.argsort(np.array(simulated_data.index), kind="stable")
+    order = sorted_order if streams is not None else np.arange(len(sorted_order))
 
     for i in num_experiments:
         print("Creating simulated data with {} experiments..".format(i))
 
-        experiment_file = os.path.join(
-            analysis_dir, "Experiment_" + str(i) + "_" + str(run) + ".txt.xz"
+        yield draw_batch_effects(
+            simulated_data.shape[0], num_genes, i, order, _batch_effects_rng(streams, i)
         )
+        order = sorted_order
+
+
+def _iter_experiments_grped(simulated_data, num_partitions, streams=None):
+    # Add batch effects
+    num_genes = simulated_data.shape[1] - 1
+
+    # Index from each experiment to its samples, built once for all
+    # numbers of partitions
+    experiment_ids, indptr, rows = experiment_row_index(simulated_data["experiment_id"])
+
+    for i in num_partitions:
+        print("Creating simulated data with {} partitions..".format(i))
 
-        experiment_map_file = os.path.join(
-            analysis_dir, "Experiment_map_" + str(i) + "_" + str(run) + ".txt.xz"
+        # Partition experiments, so that all samples from an experiment are
+        # in the same partition
+        offsets, experiment_assignment = draw_batch_effects(
+            len(experiment_ids), num_genes, i, rng=_batch_effects_rng(streams, i)
         )
 
-        # Create dataframe with grouping
-        experiment_data_map = simulated_data.copy()
+        yield offsets, sample_assignment(experiment_assignment, indptr, rows)
 
-        if i == 1:
-            simulated_data.to_csv(experiment_file, sep="\t", compression="xz")
 
-            # Add experiment id to map dataframe
-            experiment_data_map["experiment"] = str(i)
-            experiment_data_map_df = pd.DataFrame(
-                data=experiment_data_map["experiment"], index=simulated_ind.sort()
-            )
+def _batch_effects_rng(streams, num_experiments):
+    if streams is None:
+        return None
+    return streams.generator("batch_effects", num_experiments)
 
-            experiment_data_map_df.to_csv(
-                experiment_map_file, sep="\t", compression="xz"
-            )
 
-        else:
-            experiment_data = simulated_data.copy()
-
-            # Shuffle indices
-            np.random.shuffle(simulated_ind)
-
-            # Partition indices to batch
-            # Note: 'array_split' will chunk data into almost equal sized chunks.
-            # Returns arrays of size N % i and one array with the remainder
-            partition = np.array_split(simulated_ind, i)
-
-            for j in range(i):
-                # Scalar to shift gene expressiond data
-                stretch_factor = np.random.normal(0.0, 0.2, [1, num_genes])
-
-                # Tile stretch_factor to be able to add to batches
-                num_samples_per_experiment = len(partition[j])
-                stretch_factor_tile = pd.DataFrame(
-                    pd.np.tile(stretch_factor, (num_samples_per_experiment, 1)),
-                    index=experiment_data.loc[partition[j].tolist()].index,
-                    columns=experiment_data.loc[partition[j].tolist()].columns,
-                )
+def iter_experiments(simulated_data, num_experiments, prefetch=True, streams=None):
+    """
+    Adds technical variation to simulated data one number of
+    experiments/partitions at a time, using `add_experiments_grped` if the
+    data has an "experiment_id" column or `add_experiments` otherwise.
 
-                # Add experiments
-                experiment_data.loc[partition[j].tolist()] = (
-                    experiment_data.loc[partition[j].tolist()] + stretch_factor_tile
-                )
+    Compendia are yielded as they are created, so that only a couple of
+    compendia are in memory at a time instead of the compendia of all
+    numbers of experiments/partitions. With <prefetch>, the next compendium
+    is created in a background thread while the current one is used.
 
-                # Add experiment id to map dataframe
-                experiment_data_map.loc[partition[j], "experiment"] = str(j)
+    Note: Without <streams>, the technical variation of each number of
+    experiments/partitions is drawn from the global numpy random state when
+    the previous compendium is yielded, so using the global numpy random
+    state while consuming the compendia changes the technical variation drawn
 
-            experiment_data_map_df = pd.DataFrame(
-                data=experiment_data_map["experiment"], index=simulated_ind.sort()
+    Arguments
+    ----------
+    simulated_data: df
+        Dataframe containing simulated gene expression data
+
+    num_experiments: list
+        List of different numbers of experiments/partitions to add to
+        simulated data
+
+    prefetch: bool
+        True if the next compendium should be created while the current one
+        is used
+
+    streams: RandomStreams
+        Random number streams of the run (see `random_streams.py`). If None,
+        the global numpy random state is used
+
+    Yields
+    --------
+    (number of experiments/partitions, noisy, assignment) tuples, where noisy
+    is an array of the simulated data with technical variation added and
+    assignment is an array with the experiment/partition each sample is
+    assigned to
+    """
+    if "experiment_id" in list(simulated_data.columns):
+        data = simulated_data.drop(columns="experiment_id").values
+        batch_effects = _iter_experiments_grped(
+            simulated_data, num_experiments, streams
+        )
+    else:
+        data = simulated_data.values
+        batch_effects = _iter_experiments(simulated_data, num_experiments, streams)
+
+    for i, (noisy, assignment) in zip(
+        num_experiments, iter_compendia(data, batch_effects, prefetch)
+    ):
+        yield i, noisy, assignment
+
+
+def iter_compendia(data, batch_effects, prefetch=True):
+    """
+    Adds each technical variation of <batch_effects> to gene expression data
+    (see `add_batch_effects`), yielding the compendia as they are created.
+    With <prefetch>, the next compendium is created in a background thread
+    while the current one is used, so only a couple of compendia are in
+    memory at a time
+
+    Arguments
+    ----------
+    data: array
+        Gene expression data (samples x genes)
+
+    batch_effects: iterable
+        (offsets, assignment) tuples of the technical variation to add (see
+        `add_experiments`). The next tuple is taken when the current compendium
+        is yielded
+
+    prefetch: bool
+        True if the next compendium should be created while the current one
+        is used
+
+    Yields
+    --------
+    (noisy, assignment) tuples, where noisy is an array of <data> with the
+    technical variation added
+    """
+    if not prefetch:
+        for offsets, assignment in batch_effects:
+            yield add_batch_effects(data, offsets, assignment), assignment
+        return
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = None
+        for offsets, assignment in batch_effects:
+            noisy = executor.submit(add_batch_effects, data, offsets, assignment)
+            if pending is not None:
+                yield pending[0].result(), pending[1]
+            pending = (noisy, assignment)
+
+        if pending is not None:
+            yield pending[0].result(), pending[1]
+
+
+def add_experiments_cached(
+    simulated_data, num_experiments, run, cache=None, checkpoints=None, streams=None
+):
+    """
+    Adds technical variation to simulated data using `add_experiments_grped`
+    if the data has an "experiment_id" column, or `add_experiments` otherwise.
+    The technical variation is loaded from <cache> if it was already added
+    to the same simulated data, or from <checkpoints> if it was already added
+    before the run was interrupted
+
+    Arguments
+    ----------
+    simulated_data: df
+        Dataframe containing simulated gene expression data
+
+    num_experiments: list
+        List of different numbers of experiments/partitions to add to
+        simulated data
+
+    run: int
+        Unique core identifier that is used to create unique filenames for intermediate files
+
+    cache: ArtifactCache
+        Cache of outputs that were already computed (see `artifact_cache.py`).
+        If None, the technical variation is always added
+
+    checkpoints: Checkpoints
+        Checkpoints of the run (see `checkpoint.py`). If None, the technical
+        variation is not checkpointed
+
+    streams: RandomStreams
+        Random number streams of the run (see `random_streams.py`). If None,
+        the global numpy random state is used
+
+    Returns
+    --------
+    List of (offsets, assignment) tuples (see `add_experiments`)
+    """
+    if "experiment_id" in list(simulated_data.columns):
+        add_fn = add_experiments_grped
+    else:
+        add_fn = add_experiments
+
+    return checkpoint.checkpointed(
+        checkpoints,
+        "batch_effects",
+        partial(
+            artifact_cache.cached,
+            cache,
+            "batch_effects",
+            {
+                "simulated_data": partial(artifact_cache.frame_hash, simulated_data),
+                "num_experiments": list(num_experiments),
+                "run": run,
+                "seed": None if streams is None else streams.entropy,
+            },
+            partial(add_fn, simulated_data, num_experiments, streams),
+            artifact_cache.save_batch_effects,
+            artifact_cache.load_batch_effects,
+        ),
+    )
+
+
+def save_batch_effects(
+    simulated_data,
+    batch_effects,
+    num_experiments,
+    analysis_dir,
+    file_prefix,
+    map_colname,
+    run,
+    export_tsv=False,
+    compression="xz",
+):
+    """
+    Save compendia with technical variation added by `add_experiments` or
+    `add_experiments_grped`. The simulated data is saved once as
+    "<file_prefix>_base" and each compendium as the shifts added relative to it.
+    The experiment/partition assigned to each sample is saved to
+    "<file_prefix>_map_<number of experiments/partitions added>"
+
+    Arguments
+    ----------
+    simulated_data: df
+        Dataframe containing simulated gene expression data (without
+        "experiment_id" column)
+
+    batch_effects: list
+        (offsets, assignment) tuples returned by `add_experiments` or
+        `add_experiments_grped`
+
+    num_experiments: list
+        List of different numbers of experiments/partitions that were added to
+        simulated data
+
+    analysis_dir: str
+        Directory where compendia are stored
+
+    file_prefix: str
+        Either "Experiment" or "Partition"
+
+    map_colname: str
+        Name of column in map file. Either "experiment" or "partition"
+
+    run: int
+        Unique core identifier that is used to create unique filenames for intermediate files
+
+    export_tsv: bool
+        True if compendia should also be exported as tab-delimited files
+
+    compression: str or dict
+        Compression codec used for tab-delimited outputs (see `table_io.py`)
+    """
+    if not os.path.exists(analysis_dir):
+        print("Creating new directory: \n {}".format(analysis_dir))
+        os.makedirs(analysis_dir, exist_ok=True)
+
+    # Save simulated data once. Compendia with technical variation added
+    # are stored as offsets relative to this base compendium
+    base_file = compendium_io.base_compendium_file(analysis_dir, file_prefix, run)
+    compendium_io.write_compendium(simulated_data, base_file)
+
+    for i, (offsets, assignment) in zip(num_experiments, batch_effects):
+        experiment_file = compendium_io.compendium_file(
+            analysis_dir, file_prefix, i, run
+        )
+
+        experiment_map_file = compendium_io.map_file(analysis_dir, file_prefix, i, run)
+
+        if i == 1:
+            compendium_io.write_delta_compendium(
+                base_file,
+                offsets,
+                assignment,
+                experiment_file,
+                export_tsv,
+                float_format=None,
+                compression=compression,
+            )
+        else:
+            compendium_io.write_delta_compendium(
+                base_file,
+                offsets,
+                assignment,
+                experiment_file,
+                export_tsv,
+                compression=compression,
             )
 
-            # Save
-            experiment_data.to_csv(
-                experiment_file, float_format="%.3f", sep="\t", compression="xz"
+        # Save the experiment/partition of each sample as codes aligned to
+        # the samples of the base compendium
+        compendium_io.write_partition_map(assignment, experiment_map_file)
+
+        if export_tsv:
+            experiment_data_map_df = pd.DataFrame(
+                data={map_colname: assignment}, index=simulated_data.index
             )
 
-            experiment_data_map_df.to_csv(
-                experiment_map_file, sep="\t", compression="xz"
+            table_io.write_table(
+                experiment_data_map_df,
+                table_io.table_file(experiment_map_file, compression),
+                compression,
             )
 
 
-def add_experiments_grped_io(
-    simulated_data, num_partitions, run, local_dir, dataset_name, analysis_name
+def add_experiments_io(
+    simulated_data,
+    num_experiments,
+    run,
+    local_dir,
+    dataset_name,
+    analysis_name,
+    export_tsv=False,
+    compression="xz",
+    cache=None,
+    checkpoints=None,
+    streams=None,
 ):
     """
-    Similar to `add_experiments_io` we will model technical variation in our
-    simulated data. In this case, we will keep track of which samples
-    are associated with an experiment.
+    Adds technical variation to simulated data using `add_experiments`
+    and saves the resulting compendia to file.
 
-    To do this we will:
-    1. Partition our simulated data into <num_partitions>
-        Here we are keeping track of experiment id and partitioning
-        such that all samples from an experiment are in the same
-        partition.
+    Arguments
+    ----------
+    simulated_data: df
+        Dataframe containing simulated gene expression data
+
+    num_experiments: list
+        List of different numbers of experiments to add to
+        simulated data
+
+    run: int
+        Unique core identifier that is used to create unique filenames for intermediate files
+
+    local_dir: str
+        Parent directory on local machine to store intermediate results
+
+    dataset_name: str
+        Name of analysis directory. Either "Human" or "Pseudomonas"
+
+    analysis_name: str
+        Parent directory where simulated data with experiments/partitionings are be stored.
+        Format of the directory name is <dataset>_<sample/experiment>_lvl_sim
+
+    export_tsv: bool
+        True if compendia should also be exported as tab-delimited files
+
+    compression: str or dict
+        Compression codec used for tab-delimited outputs (see `table_io.py`)
+
+    cache: ArtifactCache
+        Cache of outputs that were already computed (see `artifact_cache.py`).
+        If None, all outputs are computed
+
+    checkpoints: Checkpoints
+        Checkpoints of the run (see `checkpoint.py`). If None, no checkpoints
+        are saved
+
+    streams: RandomStreams
+        Random number streams of the run (see `random_streams.py`). If None,
+        the global numpy random state is used
+
+    Output
+    --------
+    Files of simulated data with different numbers of experiments added are save to file.
+    Each file is named as "Experiment_<number of experiments added>" and stores the
+    shifts added relative to the simulated data, which is saved once as "Experiment_base"
+    """
+    analysis_dir = os.path.join(
+        local_dir, "experiment_simulated", dataset_name + "_" + analysis_name
+    )
+
+    batch_effects = add_experiments_cached(
+        simulated_data, num_experiments, run, cache, checkpoints, streams
+    )
+
+    save_batch_effects(
+        simulated_data,
+        batch_effects,
+        num_experiments,
+        analysis_dir,
+        "Experiment",
+        "experiment",
+        run,
+        export_tsv,
+        compression,
+    )
 
-        Note: Partition sizes will be different since experiment
-        sizes are different per experiment.
-    2. For each partition we will shift all genes using a vector of values
-    sampled from a gaussian distribution centered around 0.
-    3. Repeat this for each partition
-    4. Append all partitions together
 
-    This function will return the files with compendia with different numbers
-    of technical variation added with one file per compendia.
+def add_experiments_grped_io(
+    simulated_data,
+    num_partitions,
+    run,
+    local_dir,
+    dataset_name,
+    analysis_name,
+    export_tsv=False,
+    compression="xz",
+    cache=None,
+    checkpoints=None,
+    streams=None,
+):
+    """
+    Adds technical variation to simulated data, keeping samples from the same
+    experiment together, using `add_experiments_grped` and saves the resulting
+    compendia to file.
 
     Arguments
     ----------
-    simulated_data_file: str
-        File containing simulated gene expression data
+    simulated_data: df
+        Dataframe containing simulated gene expression data and
+        an "experiment_id" column
 
     num_partitions: list
         List of different numbers of partitions to add
@@ -251,119 +816,230 @@ def add_experiments_grped_io(
         Parent directory where simulated data with experiments/partitionings are be stored.
         Format of the directory name is <dataset>_<sample/experiment>_lvl_sim
 
+    export_tsv: bool
+        True if compendia should also be exported as tab-delimited files
+
+    compression: str or dict
+        Compression codec used for tab-delimited outputs (see `table_io.py`)
+
+    cache: ArtifactCache
+        Cache of outputs that were already computed (see `artifact_cache.py`).
+        If None, all outputs are computed
+
+    checkpoints: Checkpoints
+        Checkpoints of the run (see `checkpoint.py`). If None, no checkpoints
+        are saved
+
+    streams: RandomStreams
+        Random number streams of the run (see `random_streams.py`). If None,
+        the global numpy random state is used
+
 
     Output
     --------
     Files of simulated data with different numbers of experiments added are saved to file.
-    Each file is named as "Experiment_<number of experiments added>"
+    Each file is named as "Partition_<number of partitions added>" and stores the
+    shifts added relative to the simulated data, which is saved once as "Partition_base"
     """
 
     analysis_dir = os.path.join(
         local_dir, "partition_simulated", dataset_name + "_" + analysis_name
     )
 
-    if not os.path.exists(analysis_dir):
-        print("Creating new directory: \n {}".format(analysis_dir))
-        os.makedirs(analysis_dir, exist_ok=True)
+    batch_effects = add_experiments_cached(
+        simulated_data, num_partitions, run, cache, checkpoints, streams
+    )
 
-    # Add batch effects
-    num_genes = simulated_data.shape[1] - 1
+    save_batch_effects(
+        simulated_data.drop(columns="experiment_id"),
+        batch_effects,
+        num_partitions,
+        analysis_dir,
+        "Partition",
+        "partition",
+        run,
+        export_tsv,
+        compression,
+    )
 
-    # Create an array of the simulated data indices
-    simulated_ind = np.array(simulated_data.index)
 
-    for i in num_partitions:
-        print("Creating simulated data with {} partitions..".format(i))
+def apply_correction(experiment_data, experiment_map, correction_method):
+    """
+    This function uses the limma or sva R package, or their numpy ports (see
+    `correction.py`), to correct for the technical variation we added using
+    <add_experiments> or <add_experiments_grped>
 
-        partition_file = os.path.join(
-            analysis_dir, "Partition_" + str(i) + "_" + str(run) + ".txt.xz"
-        )
+    Arguments
+    ----------
+    experiment_data: df
+        Dataframe containing gene expression data with technical variation
+        added (gene x sample)
 
-        partition_map_file = os.path.join(
-            analysis_dir, "Partition_map_" + str(i) + "_" + str(run) + ".txt.xz"
-        )
+    experiment_map: series
+        Categorical series with the experiment/partition code that each
+        sample is assigned to (see `compendium_io.partition_map`)
 
-        # Create dataframe with grouping
-        partition_data_map = simulated_data.copy()
+    correction_method: str
+        Noise correction method. Either "limma", "limma_numpy", "combat",
+        "combat_numpy" or "none", or any method registered in `correction.py`
 
-        if i == 1:
-            simulated_data_out = simulated_data.drop(columns="experiment_id")
-            simulated_data_out.to_csv(partition_file, sep="\t", compression="xz")
+    Returns
+    --------
+    Dataframe with corrected gene expression data (gene x sample)
+    """
+    # Correct for technical variation
+    corrected_experiment_data = correction.correct(
+        experiment_data, experiment_map, correction_method
+    )
 
-            # Add experiment id to map dataframe
-            partition_data_map["partition"] = str(i)
+    # Convert R object to pandas df
+    # corrected_experiment_data_df = pandas2ri.ri2py_dataframe(
+    #    corrected_experiment_data)
+    corrected_experiment_data_df = pd.DataFrame(
+        np.asarray(corrected_experiment_data),
+        index=experiment_data.index,
+        columns=experiment_data.columns,
+    )
 
-            partition_data_map_df = pd.DataFrame(
-                data=partition_data_map["partition"], index=simulated_ind.sort()
-            )
+    return corrected_experiment_data_df
 
-            partition_data_map_df.to_csv(partition_map_file, sep="\t", compression="xz")
 
-        else:
-            partition_data = simulated_data.copy()
-
-            # Shuffle experiment ids
-            experiment_ids = simulated_data["experiment_id"].unique()
-            np.random.shuffle(experiment_ids)
-
-            # Partition experiment ids
-            # Note: 'array_split' will chunk data into almost equal sized chunks.
-            # Returns arrays of size N % i and one array with the remainder
-            partition = np.array_split(experiment_ids, i)
-
-            for j in range(i):
-                # Randomly select experiment ids
-                # selected_experiment_ids = partition[j]
-
-                # Get sample ids associated with experiment ids
-                sample_ids = list(
-                    simulated_data[
-                        simulated_data["experiment_id"].isin(partition[j])
-                    ].index
-                )
+def apply_correction_cached(
+    experiment_data, experiment_map, correction_method, cache=None
+):
+    """
+    Corrects for technical variation using `apply_correction`. The corrected
+    data is loaded from <cache> if the same data was already corrected using
+    the same method
 
-                # Scalar to shift gene expressiond data
-                stretch_factor = np.random.normal(0.0, 0.2, [1, num_genes])
+    Arguments
+    ----------
+    experiment_data: df
+        Dataframe containing gene expression data with technical variation
+        added (gene x sample)
 
-                # Tile stretch_factor to be able to add to batches
-                num_samples_per_partition = len(sample_ids)
+    experiment_map: series
+        Categorical series with the experiment/partition code that each
+        sample is assigned to (see `compendium_io.partition_map`)
 
-                if j == 0:
-                    # Drop experiment_id label to do calculation
-                    partition_data.drop(columns="experiment_id", inplace=True)
+    correction_method: str
+        Noise correction method. Either "limma", "limma_numpy", "combat",
+        "combat_numpy" or "none", or any method registered in `correction.py`
 
-                stretch_factor_tile = pd.DataFrame(
-                    pd.np.tile(stretch_factor, (num_samples_per_partition, 1)),
-                    index=partition_data.loc[sample_ids].index,
-                    columns=partition_data.loc[sample_ids].columns,
-                )
+    cache: ArtifactCache
+        Cache of outputs that were already computed (see `artifact_cache.py`).
+        If None, the data is always corrected
 
-                # Add noise to partition
-                partition_data.loc[sample_ids] = (
-                    partition_data.loc[sample_ids] + stretch_factor_tile
-                )
+    Returns
+    --------
+    Dataframe with corrected gene expression data (gene x sample)
+    """
+    return artifact_cache.cached(
+        cache,
+        "corrected",
+        {
+            "experiment_data": partial(artifact_cache.frame_hash, experiment_data),
+            "experiment_map": partial(artifact_cache.frame_hash, experiment_map),
+            "correction_method": correction_method,
+        },
+        partial(apply_correction, experiment_data, experiment_map, correction_method),
+        artifact_cache.save_frame,
+        artifact_cache.load_frame,
+    )
 
-                # Add partition id to map dataframe
-                partition_data_map.loc[sample_ids, "partition"] = str(j)
 
-            partition_data_map_df = pd.DataFrame(
-                data=partition_data_map["partition"], index=simulated_ind.sort()
-            )
+def apply_correction_blocks(
+    experiment_file,
+    experiment_map_file,
+    correction_method,
+    corrected_file,
+    export_tsv=False,
+    compression="xz",
+    num_threads=None,
+):
+    """
+    Corrects for technical variation using a correction method that can
+    correct compendia in blocks of genes (see `correction.py`), reading the
+    compendium and writing the corrected compendium in blocks of genes
+    (`correction.CORRECTION_BLOCK_SIZE`) in a thread pool. Only a few blocks
+    of the compendium are held in memory at a time, rather than copies of the
+    whole compendium. ComBat reads the compendium twice (see
+    `correction.combat_blocks`).
 
-            # Save
-            partition_data.to_csv(
-                partition_file, float_format="%.3f", sep="\t", compression="xz"
-            )
+    Corrected compendia are not cached (see `apply_correction_cached`), since
+    hashing the compendium would read it as well
+
+    Arguments
+    ----------
+    experiment_file: str
+        File name of the compendium with technical variation added, without
+        extension
+
+    experiment_map_file: str
+        File name of the experiment/partition map of the compendium, without
+        extension
+
+    correction_method: str
+        Noise correction method. Any method registered in `correction.py`
+        that can correct compendia in blocks of genes
+
+    corrected_file: str
+        File name of the corrected compendium, without extension
+
+    export_tsv: bool
+        True if the corrected compendium should also be exported as a
+        tab-delimited file
+
+    compression: str or dict
+        Compression codec of the tab-delimited export (see `table_io.py`)
+
+    num_threads: int
+        Number of threads. By default, the default number of threads of
+        `ThreadPoolExecutor`
+    """
+    samples, genes = compendium_io.read_compendium_ids(experiment_file)
+    experiment_map = compendium_io.read_partition_map(experiment_map_file, samples)
+
+    corrected_matrix = compendium_io.create_compendium(
+        corrected_file, (len(samples), len(genes))
+    )
+
+    def write_block(start, stop, block):
+        corrected_matrix[:, start:stop] = block.T
+
+    correction.block_correction(correction_method)(
+        partial(compendium_io.read_compendium_genes, experiment_file),
+        write_block,
+        len(genes),
+        experiment_map,
+        num_threads=num_threads,
+    )
 
-            partition_data_map_df.to_csv(partition_map_file, sep="\t", compression="xz")
+    corrected_matrix.flush()
+    del corrected_matrix
+    compendium_io.write_compendium_ids(corrected_file, samples, genes)
+
+    if export_tsv:
+        compendium_io.export_compendium(corrected_file, compression=compression)
 
 
 def apply_correction_io(
-    local_dir, run, dataset_name, analysis_name, num_experiments, correction_method
+    local_dir,
+    run,
+    dataset_name,
+    analysis_name,
+    num_experiments,
+    correction_method,
+    export_tsv=False,
+    compression="xz",
+    cache=None,
+    checkpoints=None,
+    num_threads=None,
 ):
     """
-    This function uses the limma or sva R package to correct for the technical variation
-    we added using <add_experiments_io> or <add_experiments_grped_io>
+    This function uses the limma or sva R package, or their numpy ports (see
+    `correction.py`), to correct for the technical variation we added using
+    <add_experiments_io> or <add_experiments_grped_io>
 
     This function will return the corrected gene expression files
 
@@ -387,127 +1063,150 @@ def apply_correction_io(
         technical variations to
 
     correction_method: str
-        Noise correction method. Either "limma" or "combat"
+        Noise correction method. Either "limma", "limma_numpy", "combat",
+        "combat_numpy" or "none", or any method registered in `correction.py`
+
+    export_tsv: bool
+        True if corrected compendia should also be exported as tab-delimited files
+
+    compression: str or dict
+        Compression codec used for tab-delimited outputs (see `table_io.py`)
 
+    cache: ArtifactCache
+        Cache of outputs that were already computed (see `artifact_cache.py`).
+        If None, all outputs are computed
+
+    checkpoints: Checkpoints
+        Checkpoints of the run (see `checkpoint.py`). Numbers of experiments/
+        partitions that were already corrected before the run was interrupted
+        are skipped. If None, all numbers of experiments/partitions are corrected
+
+    num_threads: int
+        Number of threads that compendia are corrected in by the methods that
+        correct them in blocks of genes (see `apply_correction_blocks`). By
+        default, the default number of threads of `ThreadPoolExecutor`
 
     Returns
     --------
     Files of simulated data with different numbers of experiments added and corrected are saved to file.
     Each file is named as "Experiment_<number of experiments added>".
-    Note: After the data is corrected, the dimensions are now gene x sample
+    Note: Corrected data is saved in the same sample x gene orientation as the
+    uncorrected data
     """
 
     for i in range(len(num_experiments)):
 
+        if checkpoints is not None and checkpoints.done(
+            "corrected", num_experiments[i]
+        ):
+            continue
+
         if "sample" in analysis_name:
             print("Correcting for {} experiments..".format(num_experiments[i]))
 
-            experiment_file = os.path.join(
-                local_dir,
-                "experiment_simulated",
-                dataset_name + "_" + analysis_name,
-                f"Experiment_{num_experiments[i]}_{run}.txt.xz",
+            experiment_file = compendium_io.compendium_file(
+                os.path.join(
+                    local_dir,
+                    "experiment_simulated",
+                    dataset_name + "_" + analysis_name,
+                ),
+                "Experiment",
+                num_experiments[i],
+                run,
             )
 
-            experiment_map_file = os.path.join(
-                local_dir,
-                "experiment_simulated",
-                dataset_name + "_" + analysis_name,
-                f"Experiment_map_{num_experiments[i]}_{run}.txt.xz",
+            experiment_map_file = compendium_io.map_file(
+                os.path.join(
+                    local_dir,
+                    "experiment_simulated",
+                    dataset_name + "_" + analysis_name,
+                ),
+                "Experiment",
+                num_experiments[i],
+                run,
             )
 
-            # Read in data
-            # data transposed to form gene x sample for R package
-            experiment_data = pd.read_csv(
-                experiment_file, header=0, index_col=0, sep="\t"
-            ).T
-
-            experiment_map = pd.read_csv(
-                experiment_map_file, header=0, index_col=0, sep="\t"
-            )["experiment"]
+            experiment_corrected_file = compendium_io.compendium_file(
+                os.path.join(
+                    local_dir,
+                    "experiment_simulated",
+                    dataset_name + "_" + analysis_name,
+                ),
+                "Experiment_corrected",
+                num_experiments[i],
+                run,
+            )
         else:
             print("Correcting for {} Partition..".format(num_experiments[i]))
 
-            experiment_file = os.path.join(
-                local_dir,
-                "partition_simulated",
-                dataset_name + "_" + analysis_name,
-                f"Partition_{num_experiments[i]}_{run}.txt.xz",
+            experiment_file = compendium_io.compendium_file(
+                os.path.join(
+                    local_dir, "partition_simulated", dataset_name + "_" + analysis_name
+                ),
+                "Partition",
+                num_experiments[i],
+                run,
             )
 
-            experiment_map_file = os.path.join(
-                local_dir,
-                "partition_simulated",
-                dataset_name + "_" + analysis_name,
-                f"Partition_map_{num_experiments[i]}_{run}.txt.xz",
+            experiment_map_file = compendium_io.map_file(
+                os.path.join(
+                    local_dir,
+                    "partition_simulated",
+                    dataset_name + "_" + analysis_name,
+                ),
+                "Partition",
+                num_experiments[i],
+                run,
             )
 
-            # Read in data
-            # data transposed to form gene x sample for R package
-            experiment_data = pd.read_csv(
-                experiment_file, header=0, index_col=0, sep="\t"
-            ).T
-
-            experiment_map = pd.read_csv(
-                experiment_map_file, header=0, index_col=0, sep="\t"
-            )["partition"]
+            experiment_corrected_file = compendium_io.compendium_file(
+                os.path.join(
+                    local_dir, "partition_simulated", dataset_name + "_" + analysis_name
+                ),
+                "Partition_corrected",
+                num_experiments[i],
+                run,
+            )
 
-        if i == 0:
-            corrected_experiment_data_df = experiment_data.copy()
+        if i > 0 and correction.block_correction(correction_method) is not None:
+            # Corrected in gene blocks, without loading the compendium
+            apply_correction_blocks(
+                experiment_file,
+                experiment_map_file,
+                correction_method,
+                experiment_corrected_file,
+                export_tsv,
+                compression,
+                num_threads,
+            )
 
         else:
-            # Correct for technical variation
-            if correction_method == "limma":
-                corrected_experiment_data = limma.removeBatchEffect(
-                    experiment_data, batch=experiment_map
-                )
-
-                # Convert R object to pandas df
-                # corrected_experiment_data_df = pandas2ri.ri2py_dataframe(
-                #    corrected_experiment_data)
-                corrected_experiment_data_df = pd.DataFrame(corrected_experiment_data)
+            # Read in data
+            # data viewed as gene x sample for R package
+            experiment_data = compendium_io.read_compendium(
+                experiment_file, orientation=compendium_io.GENE_X_SAMPLE
+            )
 
-            if correction_method == "combat":
-                corrected_experiment_data = sva.ComBat(
-                    np.array(experiment_data), batch=experiment_map
-                )
+            experiment_map = compendium_io.read_partition_map(
+                experiment_map_file, experiment_data.columns
+            )
 
-                # Convert R object to pandas df
-                # corrected_experiment_data_df = pandas2ri.ri2py_dataframe(
-                #    corrected_experiment_data
-                # )
-                corrected_experiment_data_df = pd.DataFrame(corrected_experiment_data)
+            if i == 0:
+                corrected_experiment_data_df = experiment_data.copy()
 
-                corrected_experiment_data_df.columns = experiment_data.columns
+            else:
+                corrected_experiment_data_df = apply_correction_cached(
+                    experiment_data, experiment_map, correction_method, cache
+                )
 
-        if "sample" in analysis_name:
             # Write out corrected files
-            experiment_corrected_file = os.path.join(
-                local_dir,
-                "experiment_simulated",
-                dataset_name + "_" + analysis_name,
-                f"Experiment_corrected_{num_experiments[i]}_{run}.txt.xz",
-            )
-
-            corrected_experiment_data_df.to_csv(
+            compendium_io.write_compendium(
+                corrected_experiment_data_df,
                 experiment_corrected_file,
-                float_format="%.3f",
-                sep="\t",
-                compression="xz",
+                export_tsv,
+                compression=compression,
+                orientation=compendium_io.GENE_X_SAMPLE,
             )
 
-        else:
-            # Write out corrected files
-            experiment_corrected_file = os.path.join(
-                local_dir,
-                "partition_simulated",
-                dataset_name + "_" + analysis_name,
-                f"Partition_corrected_{num_experiments[i]}_{run}.txt.xz",
-            )
-
-            corrected_experiment_data_df.to_csv(
-                experiment_corrected_file,
-                float_format="%.3f",
-                sep="\t",
-                compression="xz",
-            )
+        if checkpoints is not None:
+            checkpoints.save("corrected", experiment_corrected_file, num_experiments[i])
@@ -7,9 +7,18 @@ Scripts called by analysis notebooks to run entire the entire analysis pipeline:
 2. Run simulation experiment, described in `simulations.py`
 """
 
-from simulate_expression_compendia_modules import simulations
+from simulate_expression_compendia_modules import (
+    simulations,
+    artifact_cache,
+    checkpoint,
+    generate_data_parallel,
+    results_store,
+    similarity_metric_parallel,
+    table_io,
+)
 from ponyo import utils
 import os
+import tempfile
 import pandas as pd
 import numpy as np
 import math
@@ -30,22 +39,115 @@ with warnings.catch_warnings():
     fxn()
 
 
-def transpose_data(data_file, out_file):
+def transpose_data(data_file, out_file, compression="infer", block_size=1000):
     """
     Transpose and save expression data so that it is of the form sample x gene
 
+    The data is transposed out-of-core in a single pass over <data_file>:
+    blocks of <block_size> genes are read at a time and saved transposed, as
+    float64 arrays, to a temporary directory next to <out_file>, which needs
+    as much free disk space as the data itself. The arrays are then memory
+    mapped and exported to <out_file> in blocks of <block_size> samples.
+    <out_file> is a text table, as read by the simulations, not an array.
+    Memory holds at most <block_size> genes x all samples while reading and
+    <block_size> samples x all genes while exporting.
+
     Arguments
     ----------
     data_file: str
-        File containing gene expression
+        File containing gene expression (gene x sample). The compression codec
+        of the file is detected automatically
 
     out_file: str
         File containing transposed gene expression
+
+    compression: str or dict
+        Compression codec used to write <out_file> (see `table_io.py`).
+        By default the codec is inferred from the extension of <out_file>
+
+    block_size: int
+        Maximum number of rows read or written at a time
     """
-    # Read data
-    data = pd.read_csv(data_file, header=0, sep="\t", index_col=0)
+    with tempfile.TemporaryDirectory(
+        dir=os.path.dirname(os.path.abspath(out_file))
+    ) as tmp_dir:
+        # Save blocks of genes as blocks of columns of the transposed data
+        genes = []
+        block_files = []
+        with table_io.open_file(data_file) as f:
+            try:
+                for data_block in pd.read_csv(
+                    f, header=0, sep="\t", index_col=0, chunksize=block_size
+                ):
+                    samples = list(data_block.columns)
+                    block_files.append(
+                        os.path.join(tmp_dir, f"genes_{len(block_files)}.npy")
+                    )
+                    np.save(
+                        block_files[-1],
+                        np.ascontiguousarray(data_block.values.T, dtype=np.float64),
+                    )
+
+                    genes.extend(data_block.index)
+            except pd.errors.EmptyDataError:
+                pass
+
+        if len(genes) == 0:
+            raise ValueError(f"{data_file} does not contain any genes")
+
+        # Write blocks of samples
+        gene_blocks = [np.load(block_file, mmap_mode="r") for block_file in block_files]
+        with table_io.open_file(out_file, "w", compression) as f:
+            for start in range(0, len(samples), block_size):
+                stop = min(start + block_size, len(samples))
+                pd.DataFrame(
+                    np.hstack([gene_block[start:stop] for gene_block in gene_blocks]),
+                    index=samples[start:stop],
+                    columns=genes,
+                ).to_csv(f, sep="\t", header=start == 0)
+
+        del gene_blocks
+
+
+def _noise_scales(params):
+    """
+    Returns the noise scales of the technical variation to sweep, set by the
+    "noise_scales" config parameter, including the default noise scale
+    (`generate_data_parallel.NOISE_SCALE`). Returns None if no sweep is set,
+    or if numbers of experiments/partitions are swept instead ("dense_sweep")
+    """
+    if params.get("noise_scales") is None or params.get("dense_sweep", False):
+        return None
+
+    return sorted(
+        set(float(scale) for scale in params["noise_scales"])
+        | {generate_data_parallel.NOISE_SCALE}
+    )
+
 
-    data.T.to_csv(out_file, sep="\t", compression="xz")
+def _noise_scale_results(results, noise_scales):
+    """
+    Returns the results of the runs of a simulation per noise scale, each in
+    the form of the results of a simulation without noise scale sweep (with
+    a "score" column)
+    """
+    if noise_scales is None:
+        return {generate_data_parallel.NOISE_SCALE: results}
+
+    return {
+        scale: [
+            tuple(
+                (
+                    output[[scale]].rename(columns={scale: "score"})
+                    if isinstance(output, pd.DataFrame)
+                    else output
+                )
+                for output in result
+            )
+            for result in results
+        ]
+        for scale in noise_scales
+    }
 
 
 def run_simulation(config_file, input_data_file, corrected, experiment_ids_file=None):
@@ -84,6 +186,40 @@ def run_simulation(config_file, input_data_file, corrected, experiment_ids_file=
     sample_id_colname = params["metadata_colname"]
     iterations = params["iterations"]
     num_cores = params["num_cores"]
+    export_tsv = params.get("export_tsv", False)
+    compression = params.get("compression", table_io.DEFAULT_COMPRESSION)
+    in_memory = params.get("in_memory", False)
+    save_intermediates = params.get("save_intermediates", False)
+    seed = params.get("seed")
+    noise_scales = _noise_scales(params)
+    num_permutations = params.get("num_permutations")
+    low_rank_svcca = params.get("low_rank_svcca", False)
+    dense_sweep = params.get("dense_sweep", False)
+
+    if params.get("cache_dir") is not None:
+        cache_max_gb = params.get("cache_max_gb")
+        cache = artifact_cache.ArtifactCache(
+            params["cache_dir"],
+            None if cache_max_gb is None else int(cache_max_gb * 1e9),
+        )
+    else:
+        cache = None
+
+    if params.get("checkpoint", False):
+        flow = "corrected" if corrected else "uncorrected"
+        checkpoint_dir = checkpoint.simulation_checkpoint_dir(
+            local_dir,
+            f"{dataset_name}_{simulation_type}_{flow}_{correction_method}",
+            {
+                **params,
+                "input_data_file": input_data_file,
+                "experiment_ids_file": experiment_ids_file,
+                "corrected": corrected,
+                "in_memory": in_memory,
+            },
+        )
+    else:
+        checkpoint_dir = None
 
     if "sample" in simulation_type:
         num_simulated_samples = params["num_simulated_samples"]
@@ -159,6 +295,17 @@ def run_simulation(config_file, input_data_file, corrected, experiment_ids_file=
                 input_data_file,
                 local_dir,
                 base_dir,
+                export_tsv=export_tsv,
+                compression=compression,
+                in_memory=in_memory,
+                save_intermediates=save_intermediates,
+                cache=cache,
+                checkpoint_dir=checkpoint_dir,
+                seed=seed,
+                noise_scales=noise_scales,
+                num_permutations=num_permutations,
+                low_rank_svcca=low_rank_svcca,
+                dense_sweep=dense_sweep,
             )
             for i in iterations
         )
@@ -186,12 +333,28 @@ def run_simulation(config_file, input_data_file, corrected, experiment_ids_file=
                 sample_id_colname,
                 local_dir,
                 base_dir,
+                export_tsv=export_tsv,
+                compression=compression,
+                in_memory=in_memory,
+                save_intermediates=save_intermediates,
+                cache=cache,
+                checkpoint_dir=checkpoint_dir,
+                seed=seed,
+                noise_scales=noise_scales,
+                num_permutations=num_permutations,
+                low_rank_svcca=low_rank_svcca,
+                dense_sweep=dense_sweep,
             )
             for i in iterations
         )
 
-    # permuted score
-    permuted_score = results[0][0]
+    # Results of each noise scale. Summaries are of the default noise scale
+    results_per_scale = _noise_scale_results(results, noise_scales)
+    results = results_per_scale[generate_data_parallel.NOISE_SCALE]
+
+    # permuted score. If a null distribution of permuted scores was
+    # calculated, this is the mean of the null distribution of the first run
+    permuted_score = np.mean(results[0][0])
 
     # Concatenate output dataframes
     all_svcca_scores = pd.DataFrame()
@@ -226,6 +389,50 @@ def run_simulation(config_file, input_data_file, corrected, experiment_ids_file=
     ci.to_pickle(ci_file)
     np.save(similarity_permuted_file, permuted_score)
 
+    if num_permutations is not None:
+        # Null distribution of permuted scores of all runs and its thresholds
+        permuted_null = np.concatenate([results[i][0] for i in iterations])
+        np.save(similarity_permuted_file + "_null", permuted_null)
+        similarity_metric_parallel.null_thresholds(permuted_null).to_pickle(
+            similarity_permuted_file + "_thresholds.pickle"
+        )
+
+    # Save raw scores of all runs
+    if "sample" in simulation_type:
+        num_simulated = num_simulated_samples
+    else:
+        num_simulated = num_simulated_experiments
+
+    store_file = results_store.results_store_file(base_dir, dataset_name)
+    for noise_scale, scale_results in results_per_scale.items():
+        results_store.write_scores(
+            store_file,
+            results_store.iteration_scores(
+                {i: scale_results[i][1] for i in iterations}
+            ),
+            dataset_name,
+            simulation_type,
+            correction_method,
+            "corrected" if corrected else "uncorrected",
+            num_simulated,
+            noise_scale,
+        )
+        results_store.write_scores(
+            store_file,
+            results_store.iteration_scores(
+                {i: scale_results[i][0] for i in iterations}
+            ),
+            dataset_name,
+            simulation_type,
+            correction_method,
+            "permuted" if num_permutations is None else "permuted_null",
+            num_simulated,
+            noise_scale,
+        )
+
+    # All runs are completed
+    checkpoint.remove_checkpoints(checkpoint_dir)
+
 
 def run_experiment_effect_simulation(
     config_file,
@@ -270,6 +477,40 @@ def run_experiment_effect_simulation(
     sample_id_colname = params["metadata_colname"]
     iterations = params["iterations"]
     num_cores = params["num_cores"]
+    export_tsv = params.get("export_tsv", False)
+    compression = params.get("compression", table_io.DEFAULT_COMPRESSION)
+    in_memory = params.get("in_memory", False)
+    save_intermediates = params.get("save_intermediates", False)
+    seed = params.get("seed")
+    noise_scales = _noise_scales(params)
+    num_permutations = params.get("num_permutations")
+    low_rank_svcca = params.get("low_rank_svcca", False)
+    dense_sweep = params.get("dense_sweep", False)
+
+    if params.get("cache_dir") is not None:
+        cache_max_gb = params.get("cache_max_gb")
+        cache = artifact_cache.ArtifactCache(
+            params["cache_dir"],
+            None if cache_max_gb is None else int(cache_max_gb * 1e9),
+        )
+    else:
+        cache = None
+
+    if params.get("checkpoint", False):
+        checkpoint_dir = checkpoint.simulation_checkpoint_dir(
+            local_dir,
+            f"{dataset_name}_{simulation_type}_experiment_effect_{correction_method}",
+            {
+                **params,
+                "input_data_file": input_data_file,
+                "experiment_ids_file": experiment_ids_file,
+                "num_simulated_experiments": num_simulated_experiments,
+                "lst_num_partitions": lst_num_partitions,
+                "in_memory": in_memory,
+            },
+        )
+    else:
+        checkpoint_dir = None
 
     # Output files
     base_dir = os.path.abspath(os.pardir)
@@ -291,12 +532,28 @@ def run_experiment_effect_simulation(
             sample_id_colname,
             local_dir,
             base_dir,
+            export_tsv=export_tsv,
+            compression=compression,
+            in_memory=in_memory,
+            save_intermediates=save_intermediates,
+            cache=cache,
+            checkpoint_dir=checkpoint_dir,
+            seed=seed,
+            noise_scales=noise_scales,
+            num_permutations=num_permutations,
+            low_rank_svcca=low_rank_svcca,
+            dense_sweep=dense_sweep,
         )
         for i in iterations
     )
 
-    # permuted score
-    permuted_score = results[0][0]
+    # Results of each noise scale. Summaries are of the default noise scale
+    results_per_scale = _noise_scale_results(results, noise_scales)
+    results = results_per_scale[generate_data_parallel.NOISE_SCALE]
+
+    # permuted score. If a null distribution of permuted scores was
+    # calculated, this is the mean of the null distribution of the first run
+    permuted_score = np.mean(results[0][0])
 
     # Concatenate output dataframes
     uncorrected_svcca_scores = pd.DataFrame()
@@ -362,6 +619,31 @@ def run_experiment_effect_simulation(
     print("corrected_confidence interval")
     print(ci_corrected)
 
+    # Save raw scores of all runs
+    store_file = results_store.results_store_file(base_dir, dataset_name)
+    permuted_flow = "permuted" if num_permutations is None else "permuted_null"
+    for noise_scale, scale_results in results_per_scale.items():
+        for flow, position in [
+            (permuted_flow, 0),
+            ("uncorrected", 1),
+            ("corrected", 2),
+        ]:
+            results_store.write_scores(
+                store_file,
+                results_store.iteration_scores(
+                    {i: scale_results[i][position] for i in iterations}
+                ),
+                dataset_name,
+                simulation_type,
+                correction_method,
+                flow,
+                num_simulated_experiments,
+                noise_scale,
+            )
+
+    # All runs are completed
+    checkpoint.remove_checkpoints(checkpoint_dir)
+
     return (
         uncorrected_mean_scores,
         ci_uncorrected,
@@ -0,0 +1,81 @@
+"""
+Author: Alexandra Lee
+Date Created: 17 October 2026
+
+Independent random number streams for each task of a simulation run.
+
+Each (run, stage, number of experiments/partitions) task gets its own
+counter-based random number generator, derived from the seed of the
+simulation using `numpy.random.SeedSequence` spawn keys. The numbers drawn by
+a task therefore do not depend on which other tasks were run before it or on
+which worker it is run, so tasks can be split across workers without changing
+results.
+"""
+
+import numpy as np
+
+# Stages that draw random numbers. The position of a stage is part of the
+# spawn key of its streams, so new stages should only be appended
+STAGES = [
+    "simulate",
+    "permute",
+    "batch_effects",
+    "svcca",
+    "svcca_permuted",
+    "permuted_null",
+]
+
+
+class RandomStreams:
+    """
+    Random number streams of the tasks of one simulation run
+
+    Arguments
+    ----------
+    seed: int
+        Seed of the simulation
+
+    run: int
+        Unique core identifier of the run
+    """
+
+    def __init__(self, seed, run):
+        self.entropy = seed
+        self.run = run
+
+    def seed_sequence(self, stage, num_experiments=None):
+        """
+        Returns the `SeedSequence` of a task. This is the same seed sequence
+        as returned by successive `SeedSequence(seed).spawn` calls for the
+        run, stage and number of experiments/partitions, without spawning the
+        sequences of the other tasks
+        """
+        spawn_key = (self.run, STAGES.index(stage))
+        if num_experiments is not None:
+            spawn_key += (int(num_experiments),)
+
+        return np.random.SeedSequence(self.entropy, spawn_key=spawn_key)
+
+    def generator(self, stage, num_experiments=None):
+        """
+        Returns the random number generator of a task
+        """
+        return np.random.Generator(
+            np.random.Philox(self.seed_sequence(stage, num_experiments))
+        )
+
+    def seed(self, stage, num_experiments=None):
+        """
+        Returns an integer seed of a task, for code that does not take a
+        random number generator (e.g. ponyo or scikit-learn)
+        """
+        return int(self.seed_sequence(stage, num_experiments).generate_state(1)[0])
+
+
+def run_streams(seed, run):
+    """
+    Returns the random number streams of a run, or None if <seed> is None
+    """
+    if seed is None:
+        return None
+    return RandomStreams(seed, run)
@@ -0,0 +1,274 @@
+"""
+Author: Alexandra Lee
+Date Created: 17 October 2026
+
+Store of the raw similarity scores of all simulation runs, so that summaries
+(mean scores, confidence intervals) can be computed without rerunning the
+simulations.
+
+Scores are stored in a SQLite database with one row per (dataset, simulation
+type, correction method, flow, number of simulated samples/experiments, noise
+scale of the technical variation, run, number of experiments/partitions). The
+flow is either "uncorrected", "corrected", "permuted" or "permuted_null" (the
+scores of the permutations of the null distribution of each run). Permuted
+scores do not depend on the number of experiments/partitions, which is stored
+as NULL.
+"""
+
+import os
+import sqlite3
+import pandas as pd
+import numpy as np
+
+KEY_COLUMNS = [
+    "dataset_name",
+    "simulation_type",
+    "correction_method",
+    "flow",
+    "num_simulated",
+    "noise_scale",
+]
+
+SCORE_COLUMNS = ["iteration", "num_experiments", "score"]
+
+CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS scores (
+    dataset_name TEXT NOT NULL,
+    simulation_type TEXT NOT NULL,
+    correction_method TEXT NOT NULL,
+    flow TEXT NOT NULL,
+    num_simulated INTEGER NOT NULL,
+    noise_scale REAL NOT NULL,
+    iteration INTEGER NOT NULL,
+    num_experiments INTEGER,
+    score REAL NOT NULL
+)
+"""
+
+CREATE_INDEX = """
+CREATE INDEX IF NOT EXISTS scores_key ON scores (
+    dataset_name,
+    simulation_type,
+    correction_method,
+    flow,
+    num_simulated,
+    noise_scale,
+    num_experiments
+)
+"""
+
+
+def results_store_file(base_dir, dataset_name):
+    """
+    Returns the file of the results store of a dataset
+    """
+    return os.path.join(
+        base_dir,
+        dataset_name,
+        "results",
+        "saved_variables",
+        dataset_name + "_svcca_scores.sqlite",
+    )
+
+
+def iteration_scores(scores):
+    """
+    Returns the scores of all runs of a simulation as a dataframe with
+    "iteration", "num_experiments" and "score" columns (see `write_scores`)
+
+    Arguments
+    ----------
+    scores: dict
+        Maps each run to either its similarity scores dataframe, indexed by
+        number of experiments/partitions (as returned by the simulations in
+        `simulations.py`), or its permuted score or array of the scores of
+        the permutations of its null distribution
+    """
+    if all(isinstance(score, pd.DataFrame) for score in scores.values()):
+        return pd.concat(
+            {iteration: score["score"] for iteration, score in scores.items()},
+            names=["iteration", "num_experiments"],
+        ).reset_index()
+
+    permuted_scores = [np.atleast_1d(score) for score in scores.values()]
+
+    return pd.DataFrame(
+        {
+            "iteration": np.repeat(
+                list(scores.keys()), [len(score) for score in permuted_scores]
+            ),
+            "score": np.concatenate(permuted_scores),
+        }
+    )
+
+
+def _connect(store_file):
+    connection = sqlite3.connect(store_file)
+    connection.execute(CREATE_TABLE)
+    connection.execute(CREATE_INDEX)
+
+    return connection
+
+
+def _where(filters):
+    unknown = set(filters) - set(KEY_COLUMNS + SCORE_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown columns {sorted(unknown)}")
+
+    if not filters:
+        return "", []
+
+    clause = " AND ".join(f"{column} = ?" for column in filters)
+
+    return " WHERE " + clause, list(filters.values())
+
+
+def write_scores(
+    store_file,
+    scores,
+    dataset_name,
+    simulation_type,
+    correction_method,
+    flow,
+    num_simulated,
+    noise_scale,
+):
+    """
+    Save the raw similarity scores of a simulation. Scores previously saved
+    for the same simulation and flow are replaced
+
+    Arguments
+    ----------
+    store_file: str
+        File of the results store
+
+    scores: df
+        Dataframe with "iteration", "num_experiments" and "score" columns.
+        For permuted scores, the "num_experiments" column can be omitted
+
+    dataset_name: str
+        Name for analysis directory. Either "Human" or "Pseudomonas"
+
+    simulation_type: str
+        Type of simulation (e.g. "sample_lvl_sim" or "experiment_lvl_sim")
+
+    correction_method: str
+        Noise correction method used. Either 'limma', 'limma_numpy',
+        'combat', 'combat_numpy' or 'none'
+
+    flow: str
+        Either "uncorrected", "corrected", "permuted" or "permuted_null"
+
+    num_simulated: int
+        Number of simulated samples/experiments
+
+    noise_scale: float
+        Standard deviation of the technical variation added
+    """
+    key = {
+        "dataset_name": dataset_name,
+        "simulation_type": simulation_type,
+        "correction_method": correction_method,
+        "flow": flow,
+        "num_simulated": int(num_simulated),
+        "noise_scale": float(noise_scale),
+    }
+
+    scores = scores.reindex(columns=SCORE_COLUMNS)
+    rows = [
+        tuple(key.values())
+        + (
+            int(iteration),
+            None if pd.isnull(num_experiments) else int(num_experiments),
+            float(score),
+        )
+        for iteration, num_experiments, score in scores.itertuples(index=False)
+    ]
+
+    where, values = _where(key)
+
+    with _connect(store_file) as connection:
+        connection.execute("DELETE FROM scores" + where, values)
+        connection.executemany(
+            f"INSERT INTO scores ({', '.join(KEY_COLUMNS + SCORE_COLUMNS)}) "
+            f"VALUES ({', '.join(['?'] * len(KEY_COLUMNS + SCORE_COLUMNS))})",
+            rows,
+        )
+
+    connection.close()
+
+
+def read_scores(store_file, **filters):
+    """
+    Returns the raw similarity scores matching <filters>
+
+    Arguments
+    ----------
+    store_file: str
+        File of the results store
+
+    filters:
+        Values of columns of the scores to select
+        (e.g. dataset_name="Pseudomonas", flow="corrected")
+    """
+    where, values = _where(filters)
+
+    connection = _connect(store_file)
+    scores = pd.read_sql_query(
+        f"SELECT * FROM scores{where} "
+        "ORDER BY num_simulated, noise_scale, num_experiments, iteration",
+        connection,
+        params=values,
+    )
+    connection.close()
+
+    return scores
+
+
+def summarize_scores(store_file, z=1.96, **filters):
+    """
+    Returns the mean similarity score, its standard error and confidence
+    interval per simulation, flow and number of experiments/partitions. Sums
+    are aggregated by the database, so raw scores are not loaded
+
+    Arguments
+    ----------
+    store_file: str
+        File of the results store
+
+    z: float
+        z-score of the confidence interval. Default is a 95% confidence interval
+
+    filters:
+        Values of columns of the scores to select (see `read_scores`)
+
+    Returns
+    --------
+    Dataframe with "count", "score", "std_err", "ymin" and "ymax" columns
+    """
+    where, values = _where(filters)
+    group_columns = ", ".join(KEY_COLUMNS + ["num_experiments"])
+
+    connection = _connect(store_file)
+    sums = pd.read_sql_query(
+        f"SELECT {group_columns}, COUNT(*) AS count, SUM(score) AS total, "
+        f"SUM(score * score) AS total_squares FROM scores{where} "
+        f"GROUP BY {group_columns} ORDER BY {group_columns}",
+        connection,
+        params=values,
+    )
+    connection.close()
+
+    summary = sums[KEY_COLUMNS + ["num_experiments", "count"]].copy()
+    summary["score"] = sums["total"] / sums["count"]
+
+    # Sample variance
+    variance = (sums["total_squares"] - sums["count"] * summary["score"] ** 2) / (
+        sums["count"] - 1
+    )
+    summary["std_err"] = (variance.clip(lower=0) / sums["count"]) ** 0.5
+
+    summary["ymin"] = summary["score"] - z * summary["std_err"]
+    summary["ymax"] = summary["score"] + z * summary["std_err"]
+
+    return summary
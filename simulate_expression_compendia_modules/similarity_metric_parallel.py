@@ -6,12 +6,36 @@ Scripts to compare simulated compendium with simulated compendia with noise adde
 """
 
 from sklearn.decomposition import PCA
-from simulate_expression_compendia_modules import cca_core
+from sklearn.utils import check_random_state
+from scipy.sparse.linalg import ArpackError, eigsh
+from simulate_expression_compendia_modules import (
+    cca_core,
+    checkpoint,
+    compendium_io,
+    correction,
+    generate_data_parallel,
+)
 import os
 import pandas as pd
 import numpy as np
 import warnings
 
+# Maximum number of values of the permuted compendia scored at a time by
+# `permuted_null_scores`
+PERMUTATION_BATCH_VALUES = 2**25
+
+# Number of power iterations of the randomized PCA of permuted compendia, as
+# used by scikit-learn's randomized PCA solver
+PCA_POWER_ITERATIONS = 7
+PCA_OVERSAMPLES = 10
+
+# Maximum number of samples of compendia whose PCA is calculated from an
+# exact eigendecomposition of their Gram matrix, instead of subspace iteration
+GRAM_EIGH_MAX_SAMPLES = 2000
+
+# Levels of the empirical thresholds of the null distribution of permuted scores
+NULL_LEVELS = [0.95, 0.99]
+
 
 def fxn():
     warnings.warn("deprecated", DeprecationWarning)
@@ -69,24 +93,511 @@ def read_data(simulated_data, file_prefix, run, local_dir, dataset_name, analysi
         )
 
     # Get compendium with 1 experiment or partitioning
-    compendium_1_file = os.path.join(
-        compendium_dir, file_prefix + "_1" + "_" + str(run) + ".txt.xz"
+    compendium_1_file = compendium_io.compendium_file(
+        compendium_dir, file_prefix, 1, run
     )
 
-    compendium_1 = pd.read_csv(compendium_1_file, header=0, index_col=0, sep="\t")
-
-    # Transpose compendium df because output format
-    # for correction method is swapped
-    if file_prefix.split("_")[-1] == "corrected":
-        compendium_1 = compendium_1.T
+    compendium_1 = compendium_io.read_compendium(compendium_1_file)
 
     return [simulated_data_numeric, compendium_dir, compendium_1]
 
 
+def svcca_score(compendium_1, compendium_other, use_pca, num_PCs, random_state=None):
+    """
+    Calculate the SVCCA similarity score between two compendia
+
+    Arguments
+    ----------
+    compendium_1: df
+        Dataframe containing gene expression data (sample x gene)
+
+    compendium_other: df
+        Dataframe containing gene expression data (sample x gene) to compare
+        against <compendium_1>
+
+    use_pca: bool
+        True if want to represent expression data in top PCs before
+        calculating similarity
+
+    num_PCs: int
+        Number of top PCs to use to represent expression data
+
+    random_state: int
+        Seed of the PCA solver. If None, the global numpy random state is used
+
+    Returns
+    --------
+    Mean of the canonical correlations between the two compendia
+    """
+    if use_pca:
+        # Both PCA solvers draw from the same random state, so that they do
+        # not use the same random projections
+        random_state = check_random_state(random_state)
+
+        # PCA projection
+        pca = PCA(n_components=num_PCs, random_state=random_state)
+
+        original_data_PCAencoded = pca.fit_transform(compendium_1)
+
+        original_data_df = pd.DataFrame(
+            original_data_PCAencoded, index=compendium_1.index
+        )
+        # Train new PCA model to encode expression data into DIFFERENT latent space
+        pca_new = PCA(n_components=num_PCs, random_state=random_state)
+        noisy_original_data_PCAencoded = pca_new.fit_transform(compendium_other)
+        noisy_original_data_df = pd.DataFrame(
+            noisy_original_data_PCAencoded, index=compendium_other.index
+        )
+
+    else:
+        original_data_df = compendium_1
+        noisy_original_data_df = compendium_other
+
+    # SVCCA
+    svcca_results = cca_core.get_cca_similarity(
+        original_data_df.T, noisy_original_data_df.T, verbose=False
+    )
+
+    return np.mean(svcca_results["cca_coef1"])
+
+
+def _orthonormal_basis(data):
+    """
+    Returns an orthonormal basis of the column space of each matrix of
+    <data> (array of matrices)
+    """
+    basis, _, _ = np.linalg.svd(data, full_matrices=False)
+
+    return basis
+
+
+def basis_similarity(reference_basis, bases):
+    """
+    Returns the SVCCA similarity score between representations given by
+    orthonormal bases of their (centered) sample space: the mean of the
+    canonical correlations, which are the singular values of the product of
+    the bases. <bases> can be a single basis or an array of bases
+    """
+    correlations = np.linalg.svd(np.matmul(reference_basis.T, bases), compute_uv=False)
+
+    return np.clip(correlations, 0, 1).mean(axis=-1)
+
+
+def _pca_bases(data, num_PCs, rng=None):
+    """
+    Returns orthonormal bases (permutation x sample x PC) of the top
+    <num_PCs> principal components of each compendium of <data>
+    (permutation x sample x gene), computed in a batch by randomized subspace
+    iteration
+    """
+    normal = np.random.standard_normal if rng is None else rng.standard_normal
+
+    centered = data - data.mean(axis=1, keepdims=True)
+    centered_T = centered.transpose(0, 2, 1)
+
+    basis = np.matmul(centered, normal((data.shape[2], num_PCs + PCA_OVERSAMPLES)))
+    for _ in range(PCA_POWER_ITERATIONS):
+        basis = _orthonormal_basis(basis)
+        basis = np.matmul(centered, np.matmul(centered_T, basis))
+    basis = _orthonormal_basis(basis)
+
+    # Top principal components within the subspace
+    components, _, _ = np.linalg.svd(
+        np.matmul(basis.transpose(0, 2, 1), centered), full_matrices=False
+    )
+
+    return np.matmul(basis, components[:, :, :num_PCs])
+
+
+def permuted_null_scores(
+    simulated_data,
+    num_permutations,
+    use_pca,
+    num_PCs,
+    rng=None,
+    random_state=None,
+):
+    """
+    Calculate the SVCCA similarity scores between a compendium and
+    <num_permutations> permutations of it (see
+    `generate_data_parallel.permute_data`), which form the null distribution
+    of the similarity scores.
+
+    Permutations are generated and scored in batches. The PCA of the
+    compendium and the whitening of its representation are calculated once
+    and reused for every permutation. Since the representations are whitened,
+    the canonical correlations are the singular values of the product of
+    the orthonormal bases of the two representations, as calculated by
+    `svcca_score` (up to the regularization of `cca_core`)
+
+    Arguments
+    ----------
+    simulated_data: df
+        Dataframe containing gene expression data (sample x gene)
+
+    num_permutations: int
+        Number of permutations to score
+
+    use_pca: bool
+        True if want to represent expression data in top PCs before
+        calculating similarity
+
+    num_PCs: int
+        Number of top PCs to use to represent expression data
+
+    rng: numpy.random.Generator
+        Random number generator of the permutations and of the PCA of the
+        permutations. If None, the global numpy random state is used
+
+    random_state: int
+        Seed of the PCA solver of the compendium. If None, the global numpy
+        random state is used
+
+    Returns
+    --------
+    Array of the similarity scores of the permutations
+    """
+    values = np.asarray(simulated_data.values, dtype=float)
+
+    # Whitened representation of the compendium
+    if use_pca:
+        pca = PCA(n_components=num_PCs, random_state=random_state)
+        reference_basis = _orthonormal_basis(pca.fit_transform(values))
+    else:
+        reference_basis = _orthonormal_basis(values - values.mean(axis=0))
+
+    batch_size = max(1, PERMUTATION_BATCH_VALUES // values.size)
+    scores = []
+
+    for start in range(0, num_permutations, batch_size):
+        num_batch = min(batch_size, num_permutations - start)
+
+        permuted = np.repeat(values[np.newaxis], num_batch, axis=0)
+        generate_data_parallel.permute_rows(permuted.reshape(-1, values.shape[1]), rng)
+
+        if use_pca:
+            permuted_bases = _pca_bases(permuted, num_PCs, rng)
+        else:
+            permuted_bases = _orthonormal_basis(
+                permuted - permuted.mean(axis=1, keepdims=True)
+            )
+
+        scores.append(basis_similarity(reference_basis, permuted_bases))
+
+    return np.concatenate(scores)
+
+
+def base_decomposition(simulated_data):
+    """
+    Returns the decomposition of a compendium used by `low_rank_pca_basis`
+    to calculate the PCA of the compendium with technical variation added:
+    the compendium centered per gene and its Gram matrix (sample x sample)
+
+    Arguments
+    ----------
+    simulated_data: df or array
+        Gene expression data (sample x gene)
+    """
+    centered = np.asarray(simulated_data, dtype=float)
+    centered = centered - centered.mean(axis=0)
+
+    return centered, np.matmul(centered, centered.T)
+
+
+def _gram_basis(gram, num_PCs, start=None):
+    # Top eigenvectors of a Gram matrix are the top PC scores, normalized.
+    # Only the top eigenvectors are calculated (by Lanczos iteration to
+    # machine precision, from a random direction, since constant directions
+    # are in the null space of centered data), unless they are almost all
+    # eigenvectors or the Gram matrix has fewer than <num_PCs> nonzero
+    # eigenvalues (e.g. of corrected compendia with about one sample per
+    # experiment), whose other eigenvectors Lanczos iteration draws at random
+    if gram.shape[0] <= GRAM_EIGH_MAX_SAMPLES:
+        if num_PCs < gram.shape[0] - 1:
+            try:
+                eigenvalues, eigenvectors = eigsh(
+                    gram,
+                    k=num_PCs,
+                    which="LA",
+                    v0=np.random.RandomState(0).standard_normal(gram.shape[0]),
+                )
+                if eigenvalues[0] > (
+                    gram.shape[0] * np.finfo(gram.dtype).eps * eigenvalues[-1]
+                ):
+                    return eigenvectors[:, ::-1]
+            except ArpackError:
+                pass
+
+        _, eigenvectors = np.linalg.eigh(gram)
+
+        return eigenvectors[:, ::-1][:, :num_PCs]
+
+    return _subspace_basis(
+        lambda basis: np.matmul(gram, basis), gram.shape[0], num_PCs, start
+    )
+
+
+def _data_basis(centered, num_PCs, start=None):
+    # Top PC scores of centered data, normalized, without forming the Gram
+    # matrix of compendia whose PCA is calculated by subspace iteration
+    if centered.shape[0] <= GRAM_EIGH_MAX_SAMPLES:
+        return _gram_basis(np.matmul(centered, centered.T), num_PCs)
+
+    return _subspace_basis(
+        lambda basis: np.matmul(centered, np.matmul(centered.T, basis)),
+        centered.shape[0],
+        num_PCs,
+        start,
+    )
+
+
+def _subspace_basis(multiply_gram, num_samples, num_PCs, start=None):
+    # Subspace iteration of the Gram matrix (applied by <multiply_gram>) from
+    # <start> (e.g. the basis of a similar compendium), completed with random
+    # directions
+    basis = np.random.RandomState(0).standard_normal(
+        (num_samples, num_PCs + PCA_OVERSAMPLES)
+    )
+    if start is not None:
+        basis[:, : start.shape[1]] = start
+
+    for _ in range(PCA_POWER_ITERATIONS):
+        basis = _orthonormal_basis(multiply_gram(basis))
+
+    _, eigenvectors = np.linalg.eigh(np.matmul(basis.T, multiply_gram(basis)))
+
+    return np.matmul(basis, eigenvectors[:, ::-1][:, :num_PCs])
+
+
+def low_rank_pca_basis(decomposition, offsets, assignment, num_PCs, start=None):
+    """
+    Returns an orthonormal basis (sample x PC) of the top <num_PCs> principal
+    components of a compendium with technical variation added
+    (data + offsets[assignment], see `generate_data_parallel.add_batch_effects`),
+    without adding the technical variation to the compendium.
+
+    The technical variation is a low rank update Z S of the compendium, where
+    Z is the one-hot (sample x experiment/partition) assignment and S the
+    <offsets>. Centered per gene, the update is D = S[assignment] - m, where
+    m is the mean offset of the samples, and the Gram matrix of the centered
+    compendium with technical variation added is updated from the Gram
+    matrix G of the compendium:
+
+        G + W[:, assignment] + W[:, assignment]' + (S S')[assignment, assignment]
+
+    up to rank one terms in m, where W = (centered compendium) S'. Z is never
+    built: its products are gathers of the rows and columns of W and S S'.
+    For k experiments/partitions this costs genes x k x (samples + k / 2)
+    operations. Once this exceeds the cost of the PCA of the compendium with
+    technical variation added (genes x samples x samples / 2 operations for
+    its Gram matrix or, for compendia with more than `GRAM_EIGH_MAX_SAMPLES`
+    samples, genes x samples x 2 (`PCA_POWER_ITERATIONS` + 1)
+    (<num_PCs> + `PCA_OVERSAMPLES`) operations for its subspace iteration), the compendium is materialized and
+    decomposed instead, so the update never costs more than materializing
+    the compendium
+
+    Arguments
+    ----------
+    decomposition: tuple
+        Decomposition of the compendium, as returned by `base_decomposition`
+
+    offsets: array
+        Shift of all genes added to each experiment/partition
+        (experiment/partition x gene)
+
+    assignment: array
+        Experiment/partition of each sample
+
+    num_PCs: int
+        Number of top PCs to use to represent expression data
+
+    start: array
+        Basis of a similar compendium (e.g. with another number of
+        experiments/partitions), from which the PCA of compendia with more
+        than `GRAM_EIGH_MAX_SAMPLES` samples is started
+    """
+    centered, gram = decomposition
+    num_samples = centered.shape[0]
+    num_experiments = offsets.shape[0]
+
+    mean_offset = (
+        np.bincount(assignment, minlength=num_experiments) / num_samples
+    ).dot(offsets)
+
+    # Operations per gene of the update, and of the PCA of the compendium
+    # with technical variation added (Gram matrices X X' only need half of
+    # the products of X X')
+    update_cost = num_experiments * (num_samples + num_experiments / 2)
+    if num_samples <= GRAM_EIGH_MAX_SAMPLES:
+        materialized_cost = num_samples**2 / 2
+    else:
+        materialized_cost = (
+            2 * (PCA_POWER_ITERATIONS + 1) * num_samples * (num_PCs + PCA_OVERSAMPLES)
+        )
+
+    if update_cost >= materialized_cost:
+        noisy = centered + (offsets[assignment] - mean_offset)
+
+        return _data_basis(noisy, num_PCs, start)
+
+    # centered x D'
+    cross = np.matmul(centered, offsets.T)[:, assignment]
+    cross -= np.matmul(centered, mean_offset)[:, np.newaxis]
+
+    # D x D'
+    offsets_mean = np.matmul(offsets, mean_offset)[assignment]
+    offsets_gram = np.matmul(offsets, offsets.T)[np.ix_(assignment, assignment)]
+    offsets_gram -= offsets_mean[:, np.newaxis]
+    offsets_gram -= offsets_mean[np.newaxis, :]
+    offsets_gram += np.dot(mean_offset, mean_offset)
+
+    noisy_gram = gram + cross
+    noisy_gram += cross.T
+    noisy_gram += offsets_gram
+
+    return _gram_basis(noisy_gram, num_PCs, start)
+
+
+def _remove_partition_means(data, assignment):
+    # Subtracts from each row of <data> the mean of the rows of its partition
+    codes = np.unique(assignment, return_inverse=True)[1]
+
+    return data - correction.group_means(data.T, codes).T[codes]
+
+
+def limma_corrected_pca_basis(decomposition, assignment, num_PCs, start=None):
+    """
+    Returns an orthonormal basis (sample x PC) of the top <num_PCs> principal
+    components of a compendium with technical variation added and corrected
+    using limma (see `generate_data_parallel.apply_correction`), without
+    adding the technical variation or correcting the compendium.
+
+    With the experiments/partitions as batches, limma's removeBatchEffect
+    subtracts from each sample the mean of its experiment/partition and adds
+    the mean of the experiment/partition means, per gene. The shift added to
+    each experiment/partition cancels out, except for a shift of all samples
+    that is removed by centering. So the centered corrected compendium is
+    (I - P) B, where B is the centered compendium without technical
+    variation and P replaces each sample by the mean of its
+    experiment/partition, and its Gram matrix is (I - P) G (I - P). P is
+    applied by subtracting the means of the rows (and columns) of G within
+    each experiment/partition, which costs samples x samples operations
+    whatever the number of experiments/partitions, and does not depend on
+    the technical variation drawn
+
+    Arguments
+    ----------
+    decomposition: tuple
+        Decomposition of the compendium, as returned by `base_decomposition`
+
+    assignment: array
+        Experiment/partition of each sample
+
+    num_PCs: int
+        Number of top PCs to use to represent expression data
+
+    start: array
+        Basis of a similar compendium (see `low_rank_pca_basis`)
+    """
+    _, gram = decomposition
+
+    corrected_gram = _remove_partition_means(
+        _remove_partition_means(gram, assignment).T, assignment
+    )
+
+    return _gram_basis(corrected_gram, num_PCs, start)
+
+
+def null_thresholds(null_scores, levels=NULL_LEVELS):
+    """
+    Returns the empirical thresholds of the null distribution of similarity
+    scores <null_scores>: the quantile of the null distribution at each
+    level. A similarity score above the threshold of a level is significant
+    at that level
+    """
+    return pd.Series(
+        np.quantile(null_scores, levels), index=pd.Index(levels, name="level")
+    )
+
+
+def score_permuted(
+    simulated_data,
+    permuted_simulated_data,
+    use_pca,
+    num_PCs,
+    checkpoints=None,
+    streams=None,
+    num_permutations=None,
+):
+    """
+    Calculate the similarity score comparing the permuted data to the
+    simulated data or, if <num_permutations> is given, the null distribution
+    of similarity scores of <num_permutations> permutations of the simulated
+    data (see `permuted_null_scores`)
+
+    Arguments
+    ----------
+    simulated_data: df
+        Dataframe containing simulated gene expression data (sample x gene)
+
+    permuted_simulated_data: df
+        Dataframe containing permuted simulated gene expression data
+
+    use_pca: bool
+        True if want to represent expression data in top PCs before
+        calculating similarity
+
+    num_PCs: int
+        Number of top PCs to use to represent expression data
+
+    checkpoints: Checkpoints
+        Checkpoints of the run (see `checkpoint.py`). If None, the score is
+        always calculated
+
+    streams: RandomStreams
+        Random number streams of the run (see `random_streams.py`). If None,
+        the global numpy random state is used
+
+    num_permutations: int
+        Number of permutations of the null distribution. If None, only
+        <permuted_simulated_data> is scored
+
+    Returns
+    --------
+    Similarity score, or array of the similarity scores of the permutations
+    """
+    random_state = None if streams is None else streams.seed("svcca_permuted")
+
+    if num_permutations is None:
+        return checkpoint.checkpointed(
+            checkpoints,
+            "svcca_permuted",
+            lambda: svcca_score(
+                simulated_data,
+                permuted_simulated_data,
+                use_pca,
+                num_PCs,
+                random_state,
+            ),
+        )
+
+    return checkpoint.checkpointed(
+        checkpoints,
+        "svcca_permuted_null",
+        lambda: permuted_null_scores(
+            simulated_data,
+            num_permutations,
+            use_pca,
+            num_PCs,
+            None if streams is None else streams.generator("permuted_null"),
+            random_state,
+        ),
+    )
+
+
 def sim_svcca_io(
     simulated_data,
     permuted_simulated_data,
-    corrected,
     file_prefix,
     run,
     num_experiments,
@@ -95,6 +606,9 @@ def sim_svcca_io(
     local_dir,
     dataset_name,
     analysis_name,
+    checkpoints=None,
+    streams=None,
+    num_permutations=None,
 ):
     """
     We want to determine if adding multiple simulated experiments is able to capture the
@@ -129,9 +643,6 @@ def sim_svcca_io(
     permuted_simulated_data: df
         Dataframe containing permuted simulated gene expression data
 
-    corrected: bool
-        True if correction was applied
-
     file_prefix: str
         File prefix to determine whether to use data before correction ("Experiment" or "Partition")
         or after correction ("Experiment_corrected" or "Parition_corrected")
@@ -160,14 +671,29 @@ def sim_svcca_io(
         Parent directory where simulated data with experiments/partitionings are be stored.
         Format of the directory name is <dataset>_<sample/experiment>_lvl_sim
 
+    checkpoints: Checkpoints
+        Checkpoints of the run (see `checkpoint.py`). Scores that were already
+        calculated before the run was interrupted are loaded. If None, all
+        scores are calculated
+
+    streams: RandomStreams
+        Random number streams of the run (see `random_streams.py`). If None,
+        the global numpy random state is used
+
+    num_permutations: int
+        Number of permutations of the null distribution of similarity scores
+        (see `permuted_null_scores`). If None, only <permuted_simulated_data>
+        is scored
+
 
     Returns
     --------
     output_list: array
         Similarity scores for each number of experiment/partition added
 
-    permuted_svcca: float
-        Similarity score comparing the permuted data to the simulated data
+    permuted_svcca: float or array
+        Similarity score comparing the permuted data to the simulated data or,
+        if <num_permutations> is given, similarity scores of the permutations
 
     """
 
@@ -192,72 +718,38 @@ def sim_svcca_io(
             )
 
         # All experiments/partitions
-        compendium_other_file = os.path.join(
-            compendium_dir,
-            file_prefix + "_" + str(num_experiments[i]) + "_" + str(run) + ".txt.xz",
+        compendium_other_file = compendium_io.compendium_file(
+            compendium_dir, file_prefix, num_experiments[i], run
         )
 
-        compendium_other = pd.read_csv(
-            compendium_other_file, header=0, index_col=0, sep="\t"
-        )
-
-        # Transpose compendium df because output format
-        # for correction method is swapped
-        if corrected:
-            compendium_other = compendium_other.T
-
-        if use_pca:
-            # PCA projection
-            pca = PCA(n_components=num_PCs)
-
-            original_data_PCAencoded = pca.fit_transform(compendium_1)
-
-            original_data_df = pd.DataFrame(
-                original_data_PCAencoded, index=compendium_1.index
-            )
-            # Train new PCA model to encode expression data into DIFFERENT latent space
-            pca_new = PCA(n_components=num_PCs)
-            noisy_original_data_PCAencoded = pca_new.fit_transform(compendium_other)
-            noisy_original_data_df = pd.DataFrame(
-                noisy_original_data_PCAencoded, index=compendium_other.index
+        def compendium_score():
+            compendium_other = compendium_io.read_compendium(compendium_other_file)
+            return svcca_score(
+                compendium_1,
+                compendium_other,
+                use_pca,
+                num_PCs,
+                None if streams is None else streams.seed("svcca", num_experiments[i]),
             )
 
-        else:
-            original_data_df = compendium_1
-            noisy_original_data_df = compendium_other
-
-        # SVCCA
-        svcca_results = cca_core.get_cca_similarity(
-            original_data_df.T, noisy_original_data_df.T, verbose=False
+        output_list.append(
+            checkpoint.checkpointed(
+                checkpoints,
+                "svcca_" + file_prefix,
+                compendium_score,
+                num_experiments[i],
+            )
         )
 
-        output_list.append(np.mean(svcca_results["cca_coef1"]))
-
     # SVCCA of permuted data
-    if use_pca:
-        pca = PCA(n_components=num_PCs)
-        simulated_data_PCAencoded = pca.fit_transform(simulated_data)
-        simulated_data_PCAencoded_df = pd.DataFrame(
-            simulated_data_PCAencoded, index=simulated_data.index
-        )
-
-        pca_new = PCA(n_components=num_PCs)
-        shuffled_data_PCAencoded = pca_new.fit_transform(permuted_simulated_data)
-        shuffled_data_PCAencoded_df = pd.DataFrame(
-            shuffled_data_PCAencoded, index=permuted_simulated_data.index
-        )
-
-        svcca_results = cca_core.get_cca_similarity(
-            simulated_data_PCAencoded_df.T, shuffled_data_PCAencoded_df.T, verbose=False
-        )
-
-        permuted_svcca = np.mean(svcca_results["cca_coef1"])
-
-    else:
-        svcca_results = cca_core.get_cca_similarity(
-            simulated_data.T, permuted_simulated_data.T, verbose=False
-        )
-
-        permuted_svcca = np.mean(svcca_results["cca_coef1"])
+    permuted_svcca = score_permuted(
+        simulated_data,
+        permuted_simulated_data,
+        use_pca,
+        num_PCs,
+        checkpoints,
+        streams,
+        num_permutations,
+    )
 
     return output_list, permuted_svcca
@@ -9,12 +9,25 @@ using functions in `generate_data_parallel.py`
 from simulate_expression_compendia_modules import (
     similarity_metric_parallel,
     generate_data_parallel,
+    compendium_io,
+    artifact_cache,
+    checkpoint,
+    random_streams,
 )
 from ponyo import simulate_expression_data
+from functools import partial
+import os
 import pandas as pd
 import numpy as np
 import warnings
 
+# Number of numbers of experiments/partitions, spaced geometrically, that an
+# adaptive sweep (see `sweep_compendia`) starts from, and maximum difference
+# between the score of a number of experiments/partitions and its
+# interpolation from its neighbours below which the sweep is not refined
+SWEEP_INITIAL_POINTS = 10
+SWEEP_TOLERANCE = 0.01
+
 
 def fxn():
     warnings.warn("deprecated", DeprecationWarning)
@@ -40,6 +53,17 @@ def sample_level_simulation(
     input_file,
     local_dir,
     base_dir,
+    export_tsv=False,
+    compression="xz",
+    in_memory=False,
+    save_intermediates=False,
+    cache=None,
+    checkpoint_dir=None,
+    seed=None,
+    noise_scales=None,
+    num_permutations=None,
+    low_rank_svcca=False,
+    dense_sweep=False,
 ):
     """
     This function performs runs series of scripts that performs the following steps:
@@ -82,7 +106,8 @@ def sample_level_simulation(
         True if correction was applied
 
     correction_method: str
-        Noise correction method to use. Either 'limma' or 'combat
+        Noise correction method to use. Either 'limma', 'limma_numpy', 'combat',
+        'combat_numpy' or 'none' (see `correction.py`)
 
     use_pca: bool
         True if want to represent expression data in top PCs before
@@ -104,13 +129,66 @@ def sample_level_simulation(
     base_dir: str
         Root directory containing analysis subdirectories
 
+    export_tsv: bool
+        True if compendia should also be exported as tab-delimited files
+
+    compression: str or dict
+        Compression codec used for tab-delimited outputs (see `table_io.py`)
+
+    in_memory: bool
+        True if compendia should be passed directly between the steps instead
+        of being written to and read back from file (see `score_compendia`)
+
+    save_intermediates: bool
+        True if compendia should still be saved to file when <in_memory> is True
+
+    cache: ArtifactCache
+        Cache of outputs that were already computed (see `artifact_cache.py`).
+        If None, all outputs are computed
+
+    checkpoint_dir: str
+        Directory where checkpoints of the run are saved (see `checkpoint.py`).
+        If the run was interrupted, only the tasks that were not completed are
+        run again. If None, no checkpoints are saved
+
+    seed: int
+        Seed of the simulation. Each task of the run draws random numbers from
+        its own stream derived from the seed and the run (see
+        `random_streams.py`). If None, the global numpy random state is used
+
+    noise_scales: list
+        Standard deviations of the technical variation to add, all scored in
+        one pass from a single draw of the technical variation (see
+        `score_compendia`). Compendia are then passed in memory, as with
+        <in_memory>. If None, only the default noise scale is used
+
+    num_permutations: int
+        Number of permutations of the null distribution of similarity scores
+        (see `similarity_metric_parallel.permuted_null_scores`). If None, only
+        one permutation is scored
+
+    low_rank_svcca: bool
+        True if compendia without correction, or corrected using limma,
+        should be scored from the PCA of the simulated data updated with the
+        technical variation, without adding it to the simulated data (see
+        `score_compendia`). Compendia are then passed in memory, as with
+        <in_memory>. Default is False
+
+    dense_sweep: bool or str
+        True if every number of experiments/partitions up to the largest
+        number in <lst_num_experiments> should be scored, or "adaptive" if
+        the numbers scored should be refined where the scores bend (see
+        `sweep_compendia`). Compendia are then passed in memory, as with
+        <in_memory>. Default is False
+
     Returns
     --------
     similarity_score_df: df
         Similarity scores for each number of experiment/partition added per run
 
     permuted_scre: df
-        Similarity score comparing the permuted data to the simulated data per run
+        Similarity score comparing the permuted data to the simulated data per run,
+        or similarity scores of the permutations if <num_permutations> is given
 
     """
 
@@ -123,60 +201,131 @@ def sample_level_simulation(
     # `experiment_effect_simulation` function and `run_experiment_effect_simulation` in
     # pipeline.py. However we don't believe the trends
     # should change significantly having a matched compendia vs non-matched.
-    simulated_data = simulate_expression_data.simulate_by_random_sampling(
-        input_file,
-        NN_architecture,
-        dataset_name,
-        analysis_name,
-        num_simulated_samples,
-        local_dir,
-        base_dir,
+    checkpoints = checkpoint.run_checkpoints(checkpoint_dir, run)
+    streams = random_streams.run_streams(seed, run)
+
+    if streams is not None:
+        # ponyo draws from the global numpy random state
+        np.random.seed(streams.seed("simulate"))
+
+    simulated_data = checkpoint.checkpointed(
+        checkpoints,
+        "simulated_data",
+        partial(
+            artifact_cache.cached,
+            cache,
+            "simulated_data",
+            {
+                "input_file": partial(artifact_cache.file_hash, input_file),
+                "model": partial(
+                    artifact_cache.file_hash,
+                    os.path.join(base_dir, dataset_name, "models", NN_architecture),
+                ),
+                "num_simulated_samples": num_simulated_samples,
+                "run": run,
+                "seed": None if streams is None else streams.seed("simulate"),
+            },
+            partial(
+                simulate_expression_data.simulate_by_random_sampling,
+                input_file,
+                NN_architecture,
+                dataset_name,
+                analysis_name,
+                num_simulated_samples,
+                local_dir,
+                base_dir,
+            ),
+            artifact_cache.save_frame,
+            artifact_cache.load_frame,
+        ),
     )
 
     # Permute simulated data to be used as a negative control
-    permuted_data = generate_data_parallel.permute_data(simulated_data)
+    permuted_data = generate_data_parallel.permute_data(
+        simulated_data, None if streams is None else streams.generator("permute")
+    )
 
-    if not corrected:
-        # Add technical variation
-        generate_data_parallel.add_experiments_io(
+    if in_memory or noise_scales is not None or low_rank_svcca or dense_sweep:
+        # Note: In the corrected analysis technical variation is added to this
+        # simulated compendium directly, rather than to the compendium that was
+        # saved by the uncorrected analysis
+        flow = "corrected" if corrected else "uncorrected"
+        scores, permuted_score = score_compendia(
             simulated_data,
+            permuted_data,
             lst_num_experiments,
+            [flow],
+            correction_method,
+            use_pca,
+            num_PCs,
             run,
             local_dir,
             dataset_name,
             analysis_name,
+            save_intermediates,
+            export_tsv,
+            compression,
+            cache,
+            checkpoints,
+            streams,
+            noise_scales,
+            num_permutations,
+            low_rank_svcca,
+            dense_sweep,
         )
-
-    if corrected:
-        # Remove technical variation
-        generate_data_parallel.apply_correction_io(
-            local_dir,
+        batch_scores = scores[flow]
+
+    else:
+        if not corrected:
+            # Add technical variation
+            generate_data_parallel.add_experiments_io(
+                simulated_data,
+                lst_num_experiments,
+                run,
+                local_dir,
+                dataset_name,
+                analysis_name,
+                export_tsv,
+                compression,
+                cache=cache,
+                checkpoints=checkpoints,
+                streams=streams,
+            )
+
+        if corrected:
+            # Remove technical variation
+            generate_data_parallel.apply_correction_io(
+                local_dir,
+                run,
+                dataset_name,
+                analysis_name,
+                lst_num_experiments,
+                correction_method,
+                export_tsv,
+                compression,
+                cache=cache,
+                checkpoints=checkpoints,
+            )
+
+        # Calculate similarity between compendium and compendium + noise
+        batch_scores, permuted_score = similarity_metric_parallel.sim_svcca_io(
+            simulated_data,
+            permuted_data,
+            file_prefix,
             run,
+            lst_num_experiments,
+            use_pca,
+            num_PCs,
+            local_dir,
             dataset_name,
             analysis_name,
-            lst_num_experiments,
-            correction_method,
+            checkpoints=checkpoints,
+            streams=streams,
+            num_permutations=num_permutations,
         )
 
-    # Calculate similarity between compendium and compendium + noise
-    batch_scores, permuted_score = similarity_metric_parallel.sim_svcca_io(
-        simulated_data,
-        permuted_data,
-        corrected,
-        file_prefix,
-        run,
-        lst_num_experiments,
-        use_pca,
-        num_PCs,
-        local_dir,
-        dataset_name,
-        analysis_name,
-    )
-
     # Convert similarity scores to pandas dataframe
-    similarity_score_df = pd.DataFrame(
-        data={"score": batch_scores}, index=lst_num_experiments, columns=["score"]
-    )
+    similarity_score_df = _scores_frame(batch_scores, lst_num_experiments)
 
     similarity_score_df.index.name = "number of experiments"
     similarity_score_df
@@ -202,6 +351,17 @@ def experiment_level_simulation(
     sample_id_colname,
     local_dir,
     base_dir,
+    export_tsv=False,
+    compression="xz",
+    in_memory=False,
+    save_intermediates=False,
+    cache=None,
+    checkpoint_dir=None,
+    seed=None,
+    noise_scales=None,
+    num_permutations=None,
+    low_rank_svcca=False,
+    dense_sweep=False,
 ):
     """
     This function performs runs series of scripts that performs the following steps:
@@ -245,7 +405,8 @@ def experiment_level_simulation(
         True if correction was applied
 
     correction_method: str
-        Noise correction method to use. Either 'limma' or 'combat
+        Noise correction method to use. Either 'limma', 'limma_numpy', 'combat',
+        'combat_numpy' or 'none' (see `correction.py`)
 
     use_pca: bool
         True if want to represent expression data in top PCs before
@@ -273,13 +434,66 @@ def experiment_level_simulation(
     base_dir: str
         Root directory containing analysis subdirectories
 
+    export_tsv: bool
+        True if compendia should also be exported as tab-delimited files
+
+    compression: str or dict
+        Compression codec used for tab-delimited outputs (see `table_io.py`)
+
+    in_memory: bool
+        True if compendia should be passed directly between the steps instead
+        of being written to and read back from file (see `score_compendia`)
+
+    save_intermediates: bool
+        True if compendia should still be saved to file when <in_memory> is True
+
+    cache: ArtifactCache
+        Cache of outputs that were already computed (see `artifact_cache.py`).
+        If None, all outputs are computed
+
+    checkpoint_dir: str
+        Directory where checkpoints of the run are saved (see `checkpoint.py`).
+        If the run was interrupted, only the tasks that were not completed are
+        run again. If None, no checkpoints are saved
+
+    seed: int
+        Seed of the simulation. Each task of the run draws random numbers from
+        its own stream derived from the seed and the run (see
+        `random_streams.py`). If None, the global numpy random state is used
+
+    noise_scales: list
+        Standard deviations of the technical variation to add, all scored in
+        one pass from a single draw of the technical variation (see
+        `score_compendia`). Compendia are then passed in memory, as with
+        <in_memory>. If None, only the default noise scale is used
+
+    num_permutations: int
+        Number of permutations of the null distribution of similarity scores
+        (see `similarity_metric_parallel.permuted_null_scores`). If None, only
+        one permutation is scored
+
+    low_rank_svcca: bool
+        True if compendia without correction, or corrected using limma,
+        should be scored from the PCA of the simulated data updated with the
+        technical variation, without adding it to the simulated data (see
+        `score_compendia`). Compendia are then passed in memory, as with
+        <in_memory>. Default is False
+
+    dense_sweep: bool or str
+        True if every number of experiments/partitions up to the largest
+        number in <lst_num_experiments> should be scored, or "adaptive" if
+        the numbers scored should be refined where the scores bend (see
+        `sweep_compendia`). Compendia are then passed in memory, as with
+        <in_memory>. Default is False
+
     Returns
     --------
     similarity_score_df: df
         Similarity scores for each number of experiment/partition added per run
 
     permuted_scre: df
-        Similarity score comparing the permuted data to the simulated data per run
+        Similarity score comparing the permuted data to the simulated data per run,
+        or similarity scores of the permutations if <num_permutations> is given
     """
 
     # Generate simulated data
@@ -291,62 +505,137 @@ def experiment_level_simulation(
     # `experiment_effect_simulation` function and `run_experiment_effect_simulation` in
     # pipeline.py. However we don't believe the trends
     # should change significantly having a matched compendia vs non-matched.
-    simulated_data = simulate_expression_data.simulate_by_latent_transformation(
-        num_simulated_experiments,
-        input_file,
-        NN_architecture,
-        dataset_name,
-        analysis_name,
-        experiment_ids_file,
-        sample_id_colname,
-        local_dir,
-        base_dir,
+    checkpoints = checkpoint.run_checkpoints(checkpoint_dir, run)
+    streams = random_streams.run_streams(seed, run)
+
+    if streams is not None:
+        # ponyo draws from the global numpy random state
+        np.random.seed(streams.seed("simulate"))
+
+    simulated_data = checkpoint.checkpointed(
+        checkpoints,
+        "simulated_data",
+        partial(
+            artifact_cache.cached,
+            cache,
+            "simulated_data",
+            {
+                "input_file": partial(artifact_cache.file_hash, input_file),
+                "model": partial(
+                    artifact_cache.file_hash,
+                    os.path.join(base_dir, dataset_name, "models", NN_architecture),
+                ),
+                "experiment_ids_file": partial(
+                    artifact_cache.file_hash, experiment_ids_file
+                ),
+                "num_simulated_experiments": num_simulated_experiments,
+                "sample_id_colname": sample_id_colname,
+                "run": run,
+                "seed": None if streams is None else streams.seed("simulate"),
+            },
+            partial(
+                simulate_expression_data.simulate_by_latent_transformation,
+                num_simulated_experiments,
+                input_file,
+                NN_architecture,
+                dataset_name,
+                analysis_name,
+                experiment_ids_file,
+                sample_id_colname,
+                local_dir,
+                base_dir,
+            ),
+            artifact_cache.save_frame,
+            artifact_cache.load_frame,
+        ),
     )
 
     # Permute simulated data to be used as a negative control
-    permuted_data = generate_data_parallel.permute_data(simulated_data)
+    permuted_data = generate_data_parallel.permute_data(
+        simulated_data, None if streams is None else streams.generator("permute")
+    )
 
-    if not corrected:
-        # Add technical variation
-        generate_data_parallel.add_experiments_grped_io(
+    if in_memory or noise_scales is not None or low_rank_svcca or dense_sweep:
+        # Note: In the corrected analysis technical variation is added to this
+        # simulated compendium directly, rather than to the compendium that was
+        # saved by the uncorrected analysis
+        flow = "corrected" if corrected else "uncorrected"
+        scores, permuted_score = score_compendia(
             simulated_data,
+            permuted_data,
             lst_num_partitions,
+            [flow],
+            correction_method,
+            use_pca,
+            num_PCs,
             run,
             local_dir,
             dataset_name,
             analysis_name,
+            save_intermediates,
+            export_tsv,
+            compression,
+            cache,
+            checkpoints,
+            streams,
+            noise_scales,
+            num_permutations,
+            low_rank_svcca,
+            dense_sweep,
         )
-
-    if corrected:
-        # Remove technical variation
-        generate_data_parallel.apply_correction_io(
-            local_dir,
+        batch_scores = scores[flow]
+
+    else:
+        if not corrected:
+            # Add technical variation
+            generate_data_parallel.add_experiments_grped_io(
+                simulated_data,
+                lst_num_partitions,
+                run,
+                local_dir,
+                dataset_name,
+                analysis_name,
+                export_tsv,
+                compression,
+                cache=cache,
+                checkpoints=checkpoints,
+                streams=streams,
+            )
+
+        if corrected:
+            # Remove technical variation
+            generate_data_parallel.apply_correction_io(
+                local_dir,
+                run,
+                dataset_name,
+                analysis_name,
+                lst_num_partitions,
+                correction_method,
+                export_tsv,
+                compression,
+                cache=cache,
+                checkpoints=checkpoints,
+            )
+
+        # Calculate similarity between compendium and compendium + noise
+        batch_scores, permuted_score = similarity_metric_parallel.sim_svcca_io(
+            simulated_data,
+            permuted_data,
+            file_prefix,
             run,
+            lst_num_partitions,
+            use_pca,
+            num_PCs,
+            local_dir,
             dataset_name,
             analysis_name,
-            lst_num_partitions,
-            correction_method,
+            checkpoints=checkpoints,
+            streams=streams,
+            num_permutations=num_permutations,
         )
 
-    # Calculate similarity between compendium and compendium + noise
-    batch_scores, permuted_score = similarity_metric_parallel.sim_svcca_io(
-        simulated_data,
-        permuted_data,
-        corrected,
-        file_prefix,
-        run,
-        lst_num_partitions,
-        use_pca,
-        num_PCs,
-        local_dir,
-        dataset_name,
-        analysis_name,
-    )
-
     # Convert similarity scores to pandas dataframe
-    similarity_score_df = pd.DataFrame(
-        data={"score": batch_scores}, index=lst_num_partitions, columns=["score"]
-    )
+    similarity_score_df = _scores_frame(batch_scores, lst_num_partitions)
 
     similarity_score_df.index.name = "number of partitions"
 
@@ -369,6 +658,17 @@ def experiment_effect_simulation(
     sample_id_colname,
     local_dir,
     base_dir,
+    export_tsv=False,
+    compression="xz",
+    in_memory=False,
+    save_intermediates=False,
+    cache=None,
+    checkpoint_dir=None,
+    seed=None,
+    noise_scales=None,
+    num_permutations=None,
+    low_rank_svcca=False,
+    dense_sweep=False,
 ):
     """
     This function performs runs series of scripts that performs the following steps:
@@ -408,7 +708,8 @@ def experiment_effect_simulation(
         data
 
     correction_method: str
-        Noise correction method to use. Either 'limma' or 'combat
+        Noise correction method to use. Either 'limma', 'limma_numpy', 'combat',
+        'combat_numpy' or 'none' (see `correction.py`)
 
     use_pca: bool
         True if want to represent expression data in top PCs before
@@ -432,45 +733,184 @@ def experiment_effect_simulation(
     base_dir: str
         Root directory containing analysis subdirectories
 
+    export_tsv: bool
+        True if compendia should also be exported as tab-delimited files
+
+    compression: str or dict
+        Compression codec used for tab-delimited outputs (see `table_io.py`)
+
+    in_memory: bool
+        True if compendia should be passed directly between the steps instead
+        of being written to and read back from file (see `score_compendia`)
+
+    save_intermediates: bool
+        True if compendia should still be saved to file when <in_memory> is True
+
+    cache: ArtifactCache
+        Cache of outputs that were already computed (see `artifact_cache.py`).
+        If None, all outputs are computed
+
+    checkpoint_dir: str
+        Directory where checkpoints of the run are saved (see `checkpoint.py`).
+        If the run was interrupted, only the tasks that were not completed are
+        run again. If None, no checkpoints are saved
+
+    seed: int
+        Seed of the simulation. Each task of the run draws random numbers from
+        its own stream derived from the seed and the run (see
+        `random_streams.py`). If None, the global numpy random state is used
+
+    noise_scales: list
+        Standard deviations of the technical variation to add, all scored in
+        one pass from a single draw of the technical variation (see
+        `score_compendia`). Compendia are then passed in memory, as with
+        <in_memory>. If None, only the default noise scale is used
+
+    num_permutations: int
+        Number of permutations of the null distribution of similarity scores
+        (see `similarity_metric_parallel.permuted_null_scores`). If None, only
+        one permutation is scored
+
+    low_rank_svcca: bool
+        True if compendia without correction, or corrected using limma,
+        should be scored from the PCA of the simulated data updated with the
+        technical variation, without adding it to the simulated data (see
+        `score_compendia`). Compendia are then passed in memory, as with
+        <in_memory>. Default is False
+
+    dense_sweep: bool or str
+        True if every number of experiments/partitions up to the largest
+        number in <lst_num_experiments> should be scored, or "adaptive" if
+        the numbers scored should be refined where the scores bend (see
+        `sweep_compendia`). Compendia are then passed in memory, as with
+        <in_memory>. Default is False
+
     Returns
     --------
     similarity_score_df: df
         Similarity scores for each number of experiment/partition added per run
 
     permuted_scre: df
-        Similarity score comparing the permuted data to the simulated data per run
+        Similarity score comparing the permuted data to the simulated data per run,
+        or similarity scores of the permutations if <num_permutations> is given
     """
     # Generate simulated data
     # Note: Unlike the other simulations, we are using the same simulated dataset
     # for the uncorrected and corrected analysis.
-    np.random.seed(run * 3)
-    simulated_data = simulate_expression_data.simulate_by_latent_transformation(
-        num_simulated_experiments,
-        input_file,
-        NN_architecture,
-        dataset_name,
-        analysis_name,
-        experiment_ids_file,
-        sample_id_colname,
-        local_dir,
-        base_dir,
+    checkpoints = checkpoint.run_checkpoints(checkpoint_dir, run)
+    streams = random_streams.run_streams(seed, run)
+
+    if streams is not None:
+        simulate_seed = streams.seed("simulate")
+    else:
+        simulate_seed = run * 3
+    np.random.seed(simulate_seed)
+
+    simulated_data = checkpoint.checkpointed(
+        checkpoints,
+        "simulated_data",
+        partial(
+            artifact_cache.cached,
+            cache,
+            "simulated_data",
+            {
+                "input_file": partial(artifact_cache.file_hash, input_file),
+                "model": partial(
+                    artifact_cache.file_hash,
+                    os.path.join(base_dir, dataset_name, "models", NN_architecture),
+                ),
+                "experiment_ids_file": partial(
+                    artifact_cache.file_hash, experiment_ids_file
+                ),
+                "num_simulated_experiments": num_simulated_experiments,
+                "sample_id_colname": sample_id_colname,
+                "run": run,
+                "seed": simulate_seed,
+            },
+            partial(
+                simulate_expression_data.simulate_by_latent_transformation,
+                num_simulated_experiments,
+                input_file,
+                NN_architecture,
+                dataset_name,
+                analysis_name,
+                experiment_ids_file,
+                sample_id_colname,
+                local_dir,
+                base_dir,
+            ),
+            artifact_cache.save_frame,
+            artifact_cache.load_frame,
+        ),
     )
 
     # Permute simulated data to be used as a negative control
-    permuted_data = generate_data_parallel.permute_data(simulated_data)
+    permuted_data = generate_data_parallel.permute_data(
+        simulated_data, None if streams is None else streams.generator("permute")
+    )
+
+    if in_memory or noise_scales is not None or low_rank_svcca or dense_sweep:
+        scores, permuted_score = score_compendia(
+            simulated_data,
+            permuted_data,
+            lst_num_partitions,
+            ["uncorrected", "corrected"],
+            correction_method,
+            use_pca,
+            num_PCs,
+            run,
+            local_dir,
+            dataset_name,
+            analysis_name,
+            save_intermediates,
+            export_tsv,
+            compression,
+            cache,
+            checkpoints,
+            streams,
+            noise_scales,
+            num_permutations,
+            low_rank_svcca,
+            dense_sweep,
+        )
+
+        # Convert similarity scores to pandas dataframe
+        uncorrected_similarity_score_df = _scores_frame(
+            scores["uncorrected"], lst_num_partitions
+        )
+        corrected_similarity_score_df = _scores_frame(
+            scores["corrected"], lst_num_partitions
+        )
+
+        uncorrected_similarity_score_df.index.name = "number of partitions"
+        corrected_similarity_score_df.index.name = "number of partitions"
+
+        return (
+            permuted_score,
+            uncorrected_similarity_score_df,
+            corrected_similarity_score_df,
+        )
 
     # Add technical variation
     generate_data_parallel.add_experiments_grped_io(
-        simulated_data, lst_num_partitions, run, local_dir, dataset_name, analysis_name,
+        simulated_data,
+        lst_num_partitions,
+        run,
+        local_dir,
+        dataset_name,
+        analysis_name,
+        export_tsv,
+        compression,
+        cache=cache,
+        checkpoints=checkpoints,
+        streams=streams,
     )
 
     file_prefix = "Partition"
-    corrected = False
     # Calculate similarity between compendium and compendium + noise
     batch_scores, permuted_score = similarity_metric_parallel.sim_svcca_io(
         simulated_data,
         permuted_data,
-        corrected,
         file_prefix,
         run,
         lst_num_partitions,
@@ -479,6 +919,9 @@ def experiment_effect_simulation(
         local_dir,
         dataset_name,
         analysis_name,
+        checkpoints=checkpoints,
+        streams=streams,
+        num_permutations=num_permutations,
     )
 
     # Convert similarity scores to pandas dataframe
@@ -496,15 +939,17 @@ def experiment_effect_simulation(
         analysis_name,
         lst_num_partitions,
         correction_method,
+        export_tsv,
+        compression,
+        cache=cache,
+        checkpoints=checkpoints,
     )
 
     # Calculate similarity between compendium and compendium + noise
     file_prefix = "Partition_corrected"
-    corrected = True
     batch_scores, x_permuted_score = similarity_metric_parallel.sim_svcca_io(
         simulated_data,
         permuted_data,
-        corrected,
         file_prefix,
         run,
         lst_num_partitions,
@@ -513,6 +958,8 @@ def experiment_effect_simulation(
         local_dir,
         dataset_name,
         analysis_name,
+        checkpoints=checkpoints,
+        streams=streams,
     )
 
     # Convert similarity scores to pandas dataframe
@@ -529,3 +976,567 @@ def experiment_effect_simulation(
         corrected_similarity_score_df,
     )
 
+
+def _scores_frame(scores, lst_num_experiments):
+    """
+    Returns similarity scores as a dataframe indexed by number of
+    experiments/partitions with a "score" column or, for the scores of a
+    noise scale sweep, one column per noise scale (see `score_compendia`)
+    """
+    if isinstance(scores, pd.DataFrame):
+        return scores.copy()
+
+    return pd.DataFrame(
+        data={"score": scores}, index=lst_num_experiments, columns=["score"]
+    )
+
+
+def sweep_compendia(
+    simulated_data,
+    num_max,
+    flows,
+    correction_method,
+    num_PCs,
+    streams=None,
+    adaptive=False,
+    tolerance=SWEEP_TOLERANCE,
+):
+    """
+    Calculate similarity scores for every number of experiments/partitions
+    from 1 to <num_max>, without adding technical variation to or correcting
+    the simulated data.
+
+    The simulated data is decomposed once, and the PCA of each compendium is
+    updated from the decomposition (see
+    `similarity_metric_parallel.low_rank_pca_basis` and
+    `similarity_metric_parallel.limma_corrected_pca_basis`), starting from
+    the PCA of the reference compendium with 1 experiment/partition.
+
+    With <adaptive>, compendia are first scored for `SWEEP_INITIAL_POINTS`
+    numbers of experiments/partitions spaced geometrically. Each interval
+    between scored numbers is then halved, and both halves refined further,
+    as long as the score of its midpoint differs by more than <tolerance>
+    from its interpolation from the ends of the interval. Scores of numbers
+    that were not scored are interpolated, linearly in the log of the
+    number of experiments/partitions
+
+    Arguments
+    ----------
+    simulated_data: df
+        Dataframe containing simulated gene expression data. If it contains an
+        "experiment_id" column, technical variation is added per partition of
+        experiments (see `add_experiments_grped`), otherwise per experiment
+        (see `add_experiments`)
+
+    num_max: int
+        Largest number of experiments/partitions to score
+
+    flows: list
+        Similarity scores to calculate. Any of "uncorrected" and "corrected"
+
+    correction_method: str
+        Noise correction method to use. Only 'limma' or 'limma_numpy' can be
+        used, since limma is the only method with a closed form
+
+    num_PCs: int
+        Number of top PCs to use to represent expression data
+
+    streams: RandomStreams
+        Random number streams of the run (see `random_streams.py`). If None,
+        the global numpy random state is used
+
+    adaptive: bool
+        True if only the numbers of experiments/partitions needed to
+        interpolate the scores within <tolerance> should be scored
+
+    tolerance: float
+        Tolerance of the interpolation of the scores of an adaptive sweep
+
+    Returns
+    --------
+    scores: dict
+        Dataframe of the similarity scores (with a "score" column) for each
+        number of experiments/partitions from 1 to <num_max>, per flow
+    """
+    if "corrected" in flows and correction_method not in ["limma", "limma_numpy"]:
+        raise ValueError(
+            "Sweeps of corrected compendia can only use the limma correction"
+        )
+
+    if "experiment_id" in list(simulated_data.columns):
+        simulated_data_numeric = simulated_data.drop(columns="experiment_id")
+        add_experiments = generate_data_parallel.add_experiments_grped
+    else:
+        simulated_data_numeric = simulated_data
+        add_experiments = generate_data_parallel.add_experiments
+
+    decomposition = similarity_metric_parallel.base_decomposition(
+        simulated_data_numeric.values
+    )
+
+    # The compendium with 1 experiment/partition is the simulated data
+    # shifted by a constant, which centering removes
+    reference_basis = similarity_metric_parallel.low_rank_pca_basis(
+        decomposition,
+        np.zeros((1, simulated_data_numeric.shape[1])),
+        np.zeros(simulated_data_numeric.shape[0], dtype=int),
+        num_PCs,
+    )
+
+    scores = {flow: {} for flow in flows}
+
+    def score(lst_num_experiments):
+        batch_effects = add_experiments(simulated_data, lst_num_experiments, streams)
+
+        for i, (offsets, assignment) in zip(lst_num_experiments, batch_effects):
+            for flow in flows:
+                if flow == "uncorrected":
+                    basis = similarity_metric_parallel.low_rank_pca_basis(
+                        decomposition, offsets, assignment, num_PCs, reference_basis
+                    )
+                else:
+                    basis = similarity_metric_parallel.limma_corrected_pca_basis(
+                        decomposition, assignment, num_PCs, reference_basis
+                    )
+
+                scores[flow][i] = similarity_metric_parallel.basis_similarity(
+                    reference_basis, basis
+                )
+
+    if not adaptive:
+        score(list(range(1, num_max + 1)))
+    else:
+        lst_num_experiments = sorted(
+            set(np.geomspace(1, num_max, SWEEP_INITIAL_POINTS).round().astype(int))
+        )
+        score(lst_num_experiments)
+
+        intervals = list(zip(lst_num_experiments[:-1], lst_num_experiments[1:]))
+        while intervals:
+            intervals = [(start, end) for start, end in intervals if end - start > 1]
+            midpoints = [(start + end) // 2 for start, end in intervals]
+            score(midpoints)
+
+            refined = []
+            for (start, end), midpoint in zip(intervals, midpoints):
+                if any(
+                    abs(
+                        scores[flow][midpoint]
+                        - np.interp(
+                            np.log(midpoint),
+                            np.log([start, end]),
+                            [scores[flow][start], scores[flow][end]],
+                        )
+                    )
+                    > tolerance
+                    for flow in flows
+                ):
+                    refined += [(start, midpoint), (midpoint, end)]
+            intervals = refined
+
+        print(
+            "Scored {} of {} numbers of experiments/partitions".format(
+                len(scores[flows[0]]), num_max
+            )
+        )
+
+    lst_num_experiments = np.arange(1, num_max + 1)
+    sweep_scores = {}
+
+    for flow in flows:
+        scored = pd.Series(scores[flow]).sort_index()
+        sweep_scores[flow] = pd.DataFrame(
+            data={
+                "score": np.interp(
+                    np.log(lst_num_experiments),
+                    np.log(scored.index.values),
+                    scored.values,
+                )
+            },
+            index=lst_num_experiments,
+            columns=["score"],
+        )
+
+    return sweep_scores
+
+
+def score_compendia(
+    simulated_data,
+    permuted_data,
+    lst_num_experiments,
+    flows,
+    correction_method,
+    use_pca,
+    num_PCs,
+    run,
+    local_dir,
+    dataset_name,
+    analysis_name,
+    save_intermediates=False,
+    export_tsv=False,
+    compression="xz",
+    cache=None,
+    checkpoints=None,
+    streams=None,
+    noise_scales=None,
+    num_permutations=None,
+    low_rank_svcca=False,
+    dense_sweep=False,
+):
+    """
+    In-memory version of the add technical variation -> apply correction ->
+    calculate similarity steps. Compendia are passed directly between steps,
+    one number of experiments/partitions at a time, instead of being written
+    to and read back from file.
+
+    Arguments
+    ----------
+    simulated_data: df
+        Dataframe containing simulated gene expression data. If it contains an
+        "experiment_id" column, technical variation is added per partition of
+        experiments (see `add_experiments_grped`), otherwise per experiment
+        (see `add_experiments`)
+
+    permuted_data: df
+        Dataframe containing permuted simulated gene expression data
+
+    lst_num_experiments: list
+        List of different numbers of experiments/partitions to add to
+        simulated data. The first element is used as the reference compendium
+
+    flows: list
+        Similarity scores to calculate. Any of "uncorrected" (simulated data +
+        technical variation) and "corrected" (simulated data + technical
+        variation + noise correction)
+
+    correction_method: str
+        Noise correction method to use. Either 'limma', 'limma_numpy', 'combat',
+        'combat_numpy' or 'none' (see `correction.py`)
+
+    use_pca: bool
+        True if want to represent expression data in top PCs before
+        calculating similarity
+
+    num_PCs: int
+        Number of top PCs to use to represent expression data
+
+    run: int
+        Unique core identifier that is used to create unique filenames for intermediate files
+
+    local_dir: str
+        Parent directory on local machine to store intermediate results
+
+    dataset_name: str
+        Name for analysis directory. Either "Human" or "Pseudomonas"
+
+    analysis_name: str
+        Parent directory where simulated data with experiments/partitionings will be stored.
+        Format of the directory name is <dataset>_<sample/experiment>_lvl_sim
+
+    save_intermediates: bool
+        True if compendia should also be saved to file, as done by
+        `add_experiments_io` and `apply_correction_io`
+
+    export_tsv: bool
+        True if saved compendia should also be exported as tab-delimited files
+
+    compression: str or dict
+        Compression codec used for tab-delimited outputs (see `table_io.py`)
+
+    cache: ArtifactCache
+        Cache of outputs that were already computed (see `artifact_cache.py`).
+        If None, all outputs are computed
+
+    checkpoints: Checkpoints
+        Checkpoints of the run (see `checkpoint.py`). Scores that were already
+        calculated before the run was interrupted are loaded, skipping the
+        correction they required. If None, all scores are calculated
+
+    streams: RandomStreams
+        Random number streams of the run (see `random_streams.py`). If None,
+        the global numpy random state is used
+
+    noise_scales: list
+        Standard deviations of the technical variation to add. The technical
+        variation is drawn once per number of experiments/partitions and
+        scaled to each noise scale, so all noise scales are scored in one
+        pass. Compendia are only saved (see <save_intermediates>) for the
+        default noise scale. If None, only the default noise scale
+        (`generate_data_parallel.NOISE_SCALE`) is used
+
+    num_permutations: int
+        Number of permutations of the null distribution of similarity scores
+        (see `similarity_metric_parallel.permuted_null_scores`). If None, only
+        <permuted_data> is scored
+
+    low_rank_svcca: bool
+        True if compendia without correction should be scored without adding
+        the technical variation to the simulated data, using
+        `similarity_metric_parallel.low_rank_pca_basis`. The PCA of each
+        compendium is then exact and updated from a decomposition of the
+        simulated data calculated once, and the SVCCA score is calculated
+        from the PCA bases (see `similarity_metric_parallel.basis_similarity`).
+        Compendia corrected using limma are scored the same way, without
+        correcting them (see
+        `similarity_metric_parallel.limma_corrected_pca_basis`), unless
+        <save_intermediates> is True. Only used if <use_pca> is True. Default
+        is False
+
+    dense_sweep: bool or str
+        True if every number of experiments/partitions from 1 to the largest
+        number in <lst_num_experiments> should be scored, or "adaptive" if
+        only the numbers needed to interpolate the scores within
+        `SWEEP_TOLERANCE` should be scored (see `sweep_compendia`). Compendia
+        are then scored as with <low_rank_svcca>, and <noise_scales> and
+        <save_intermediates> are not used. Requires <use_pca>, since sweeps
+        only score the PCA of compendia. Default is False
+
+    Returns
+    --------
+    scores: dict
+        Similarity scores for each number of experiment/partition added, per
+        flow. If <noise_scales> is given, the scores of each flow are a
+        dataframe of the scores per number of experiments/partitions (rows)
+        and noise scale (columns)
+
+    permuted_score: float or array
+        Similarity score comparing the permuted data to the simulated data or,
+        if <num_permutations> is given, similarity scores of the permutations
+    """
+    if "experiment_id" in list(simulated_data.columns):
+        simulated_data_numeric = simulated_data.drop(columns="experiment_id")
+        subdir, file_prefix, map_colname = (
+            "partition_simulated",
+            "Partition",
+            "partition",
+        )
+    else:
+        simulated_data_numeric = simulated_data
+        subdir, file_prefix, map_colname = (
+            "experiment_simulated",
+            "Experiment",
+            "experiment",
+        )
+
+    analysis_dir = os.path.join(local_dir, subdir, dataset_name + "_" + analysis_name)
+
+    if dense_sweep:
+        if not use_pca:
+            raise ValueError("Dense sweeps can only score the PCA of compendia")
+
+        scores = checkpoint.checkpointed(
+            checkpoints,
+            "svcca_sweep_" + file_prefix,
+            partial(
+                sweep_compendia,
+                simulated_data,
+                max(lst_num_experiments),
+                flows,
+                correction_method,
+                num_PCs,
+                streams,
+                dense_sweep == "adaptive",
+            ),
+        )
+        permuted_score = similarity_metric_parallel.score_permuted(
+            simulated_data_numeric,
+            permuted_data,
+            use_pca,
+            num_PCs,
+            checkpoints,
+            streams,
+            num_permutations,
+        )
+
+        return scores, permuted_score
+
+    batch_effects = generate_data_parallel.add_experiments_cached(
+        simulated_data, lst_num_experiments, run, cache, checkpoints, streams
+    )
+
+    if save_intermediates:
+        generate_data_parallel.save_batch_effects(
+            simulated_data_numeric,
+            batch_effects,
+            lst_num_experiments,
+            analysis_dir,
+            file_prefix,
+            map_colname,
+            run,
+            export_tsv,
+            compression,
+        )
+
+    if noise_scales is None:
+        scales = [generate_data_parallel.NOISE_SCALE]
+    else:
+        scales = list(noise_scales)
+
+    scores = {(flow, scale): [] for flow in flows for scale in scales}
+    reference = {}
+
+    low_rank_svcca = low_rank_svcca and use_pca
+    if low_rank_svcca:
+        decomposition = similarity_metric_parallel.base_decomposition(
+            simulated_data_numeric.values
+        )
+        reference_basis = {}
+
+    # limma's correction removes the technical variation in closed form, so
+    # corrected compendia are scored without being corrected either (see
+    # `similarity_metric_parallel.limma_corrected_pca_basis`)
+    fused_limma = (
+        low_rank_svcca
+        and correction_method in ["limma", "limma_numpy"]
+        and "corrected" in flows
+        and not save_intermediates
+    )
+
+    # Compendia are only needed if they are not all scored from the
+    # decomposition of the simulated data
+    materialize = not low_rank_svcca or ("corrected" in flows and not fused_limma)
+    if materialize:
+        # Simulated data + technical variation, scaled to each noise scale. The
+        # next compendium is created while the current one is scored
+        compendia = generate_data_parallel.iter_compendia(
+            simulated_data_numeric.values,
+            (
+                (offsets * (scale / generate_data_parallel.NOISE_SCALE), assignment)
+                for offsets, assignment in batch_effects
+                for scale in scales
+            ),
+        )
+
+    for i, (offsets, assignment) in zip(lst_num_experiments, batch_effects):
+        print(
+            "Calculating SVCCA score for 1 {} vs {} {}s..".format(
+                map_colname, i, map_colname
+            )
+        )
+
+        if fused_limma:
+            # Does not depend on the noise scale
+            corrected_basis = similarity_metric_parallel.limma_corrected_pca_basis(
+                decomposition, assignment, num_PCs
+            )
+
+        for scale in scales:
+            # The basis of the compendium is only needed to score the
+            # uncorrected flow, and as the reference basis of both flows
+            if low_rank_svcca and (
+                "uncorrected" in flows or scale not in reference_basis
+            ):
+                basis = similarity_metric_parallel.low_rank_pca_basis(
+                    decomposition,
+                    offsets * (scale / generate_data_parallel.NOISE_SCALE),
+                    assignment,
+                    num_PCs,
+                )
+                if scale not in reference_basis:
+                    reference_basis[scale] = basis
+
+            if materialize:
+                experiment_data = pd.DataFrame(
+                    next(compendia)[0],
+                    index=simulated_data_numeric.index,
+                    columns=simulated_data_numeric.columns,
+                )
+
+                # The compendium with the first number of experiments/partitions
+                # is not corrected, so it is the reference compendium of both
+                # flows
+                if scale not in reference:
+                    reference[scale] = experiment_data
+
+            for flow in flows:
+                stage = "svcca_" + file_prefix
+                if flow == "corrected":
+                    stage += "_corrected"
+                if scale != generate_data_parallel.NOISE_SCALE:
+                    stage += f"_noise_{scale}"
+
+                if checkpoints is not None and checkpoints.done(stage, i):
+                    scores[flow, scale].append(checkpoints.load(stage, i))
+                    continue
+
+                if flow == "uncorrected" and low_rank_svcca:
+                    score = similarity_metric_parallel.basis_similarity(
+                        reference_basis[scale], basis
+                    )
+                elif fused_limma:
+                    # The reference compendium is not corrected
+                    score = similarity_metric_parallel.basis_similarity(
+                        reference_basis[scale],
+                        (
+                            reference_basis[scale]
+                            if i == lst_num_experiments[0]
+                            else corrected_basis
+                        ),
+                    )
+                else:
+                    if flow == "uncorrected" or experiment_data is reference[scale]:
+                        compendium = experiment_data
+                    else:
+                        # Correction is applied to data of the form gene x sample
+                        compendium = generate_data_parallel.apply_correction_cached(
+                            experiment_data.T,
+                            compendium_io.partition_map(
+                                assignment, experiment_data.index
+                            ),
+                            correction_method,
+                            cache,
+                        ).T
+
+                    if (
+                        flow == "corrected"
+                        and save_intermediates
+                        and scale == generate_data_parallel.NOISE_SCALE
+                    ):
+                        compendium_io.write_compendium(
+                            compendium,
+                            compendium_io.compendium_file(
+                                analysis_dir, file_prefix + "_corrected", i, run
+                            ),
+                            export_tsv,
+                            compression=compression,
+                        )
+
+                    score = similarity_metric_parallel.svcca_score(
+                        reference[scale],
+                        compendium,
+                        use_pca,
+                        num_PCs,
+                        None if streams is None else streams.seed("svcca", i),
+                    )
+
+                if checkpoints is not None:
+                    checkpoints.save(stage, score, i)
+
+                scores[flow, scale].append(score)
+
+    if materialize:
+        compendia.close()
+
+    if noise_scales is None:
+        scores = {flow: scores[flow, scales[0]] for flow in flows}
+    else:
+        scores = {
+            flow: pd.DataFrame(
+                {scale: scores[flow, scale] for scale in scales},
+                index=lst_num_experiments,
+            )
+            for flow in flows
+        }
+
+    # SVCCA of permuted data
+    permuted_score = similarity_metric_parallel.score_permuted(
+        simulated_data_numeric,
+        permuted_data,
+        use_pca,
+        num_PCs,
+        checkpoints,
+        streams,
+        num_permutations,
+    )
+
+    return scores, permuted_score
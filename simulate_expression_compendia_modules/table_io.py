@@ -0,0 +1,250 @@
+"""
+Author: Alexandra Lee
+Date Created: 17 October 2026
+
+Scripts to write and read tab-delimited outputs using different compression
+codecs. Supported codecs are "xz", "zstd", "lz4" and "none". The codec used
+to write a file is selected by the `compression` config parameter, while
+the codec of a file that is read is detected from its content, so files
+written with any codec (including existing xz archives) can be loaded.
+
+zstd compression is multi-threaded. The Python bindings of xz and lz4 only
+compress using a single thread.
+"""
+
+import io
+import os
+import lzma
+import pandas as pd
+
+# File extension used for each codec
+CODECS = {"xz": ".xz", "zstd": ".zst", "lz4": ".lz4", "none": ""}
+
+DEFAULT_COMPRESSION = "xz"
+
+# Magic bytes found at the start of files written with each codec
+MAGIC_BYTES = {
+    "xz": b"\xfd7zXZ\x00",
+    "zstd": b"\x28\xb5\x2f\xfd",
+    "lz4": b"\x04\x22\x4d\x18",
+}
+
+
+def parse_compression(compression):
+    """
+    Returns the codec, compression level and number of threads specified by
+    <compression>
+
+    Arguments
+    ----------
+    compression: str, dict or None
+        Either the name of the codec ("xz", "zstd", "lz4" or "none") or a
+        dictionary of the form {"method": <codec>, "level": <int>, "threads": <int>},
+        where "level" and "threads" are optional. The default level is the
+        default of the codec and the default number of threads (-1) uses all
+        available cores. None is equivalent to "none"
+    """
+    if compression is None:
+        compression = "none"
+    if isinstance(compression, str):
+        compression = {"method": compression}
+
+    method = compression["method"]
+    if method not in CODECS:
+        raise ValueError(
+            f"Unknown compression {method}. Expected one of {list(CODECS)}"
+        )
+
+    return method, compression.get("level"), compression.get("threads", -1)
+
+
+def table_file(file_stem, compression=DEFAULT_COMPRESSION):
+    """
+    Returns the name of the tab-delimited file <file_stem>.txt with the
+    extension of the codec in <compression> added
+
+    Arguments
+    ----------
+    file_stem: str
+        File name without extension
+
+    compression: str, dict or None
+        Compression codec (see `parse_compression`)
+    """
+    method, _, _ = parse_compression(compression)
+    return file_stem + ".txt" + CODECS[method]
+
+
+def file_stem(filename):
+    """
+    Returns <filename> without the codec and tab-delimited (.txt or .tsv)
+    extensions
+
+    Arguments
+    ----------
+    filename: str
+        File name
+    """
+    stem = filename[: len(filename) - len(CODECS[infer_compression(filename)])]
+    for ext in [".txt", ".tsv"]:
+        if stem.endswith(ext):
+            return stem[: -len(ext)]
+    return stem
+
+
+def find_table_file(file_stem):
+    """
+    Returns the existing tab-delimited file <file_stem>.txt written with any
+    of the supported codecs
+
+    Arguments
+    ----------
+    file_stem: str
+        File name without extension
+    """
+    for ext in CODECS.values():
+        filename = file_stem + ".txt" + ext
+        if os.path.exists(filename):
+            return filename
+
+    raise FileNotFoundError(f"No tab-delimited file found for {file_stem}")
+
+
+def infer_compression(filename):
+    """
+    Returns the codec corresponding to the extension of <filename>
+
+    Arguments
+    ----------
+    filename: str
+        File name
+    """
+    for method, ext in CODECS.items():
+        if ext != "" and filename.endswith(ext):
+            return method
+    return "none"
+
+
+def detect_compression(filename):
+    """
+    Returns the codec that was used to write <filename>, detected from the
+    first bytes of the file
+
+    Arguments
+    ----------
+    filename: str
+        File name
+    """
+    with open(filename, "rb") as f:
+        header = f.read(max(len(magic) for magic in MAGIC_BYTES.values()))
+
+    for method, magic in MAGIC_BYTES.items():
+        if header.startswith(magic):
+            return method
+    return "none"
+
+
+def _open_zstd(filename, mode, level, threads):
+    import zstandard
+
+    if "r" in mode:
+        return zstandard.open(filename, "rb", dctx=zstandard.ZstdDecompressor())
+
+    cctx = zstandard.ZstdCompressor(
+        level=3 if level is None else level, threads=threads
+    )
+    return zstandard.open(filename, "wb", cctx=cctx)
+
+
+def _open_lz4(filename, mode, level):
+    import lz4.frame
+
+    if "r" in mode:
+        return lz4.frame.open(filename, "rb")
+
+    return lz4.frame.open(
+        filename, "wb", compression_level=0 if level is None else level
+    )
+
+
+def open_file(filename, mode="r", compression="infer"):
+    """
+    Open a compressed text file
+
+    Arguments
+    ----------
+    filename: str
+        File name
+
+    mode: str
+        Either "r" to read or "w" to write
+
+    compression: str, dict or None
+        Compression codec (see `parse_compression`). If "infer", the codec is
+        detected from the content of the file when reading and from the
+        extension of the file when writing
+
+    Returns
+    --------
+    Text file object
+    """
+    if compression == "infer":
+        if "r" in mode:
+            compression = detect_compression(filename)
+        else:
+            compression = infer_compression(filename)
+
+    method, level, threads = parse_compression(compression)
+
+    if method == "xz":
+        f = lzma.open(filename, mode[0] + "b", preset=None if "r" in mode else level)
+    elif method == "zstd":
+        f = _open_zstd(filename, mode, level, threads)
+    elif method == "lz4":
+        f = _open_lz4(filename, mode, level)
+    else:
+        f = open(filename, mode[0] + "b")
+
+    return io.TextIOWrapper(f, newline="")
+
+
+def write_table(data, filename, compression="infer", **kwargs):
+    """
+    Save a dataframe as a tab-delimited compressed file
+
+    Arguments
+    ----------
+    data: df
+        Dataframe to save
+
+    filename: str
+        File to write
+
+    compression: str, dict or None
+        Compression codec (see `open_file`)
+
+    kwargs:
+        Additional arguments passed to `pandas.DataFrame.to_csv`
+    """
+    with open_file(filename, "w", compression) as f:
+        data.to_csv(f, sep="\t", **kwargs)
+
+
+def read_table(filename, **kwargs):
+    """
+    Load a tab-delimited file written with any of the supported codecs
+
+    Arguments
+    ----------
+    filename: str
+        File to read
+
+    kwargs:
+        Additional arguments passed to `pandas.read_csv`
+
+    Returns
+    --------
+    Dataframe
+    """
+    with open_file(filename, "r") as f:
+        return pd.read_csv(f, sep="\t", **kwargs)
@@ -0,0 +1,103 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from simulate_expression_compendia_modules import artifact_cache
+
+
+def _save_bytes(num_bytes):
+    def save(out_dir):
+        with open(os.path.join(out_dir, "data.bin"), "wb") as f:
+            f.write(b"\0" * num_bytes)
+
+    return save
+
+
+def _put(cache, name, age):
+    # Outputs are stored <age> seconds apart, oldest first
+    key = cache.key(name, {})
+    artifact_dir = cache.put(key, _save_bytes(1000))
+    os.utime(artifact_dir, (1e9 - age, 1e9 - age))
+    return key
+
+
+def test_evicts_least_recently_used_outputs(tmp_path):
+    cache = artifact_cache.ArtifactCache(str(tmp_path), max_bytes=2500)
+    keys = [_put(cache, f"stage_{i}", 10 - i) for i in range(2)]
+
+    # Using the oldest output makes it the most recently used
+    assert cache.get(keys[0]) is not None
+
+    new_key = cache.key("stage_2", {})
+    cache.put(new_key, _save_bytes(1000))
+
+    assert cache.get(keys[0]) is not None
+    assert cache.get(keys[1]) is None
+    assert cache.get(new_key) is not None
+
+
+def test_keeps_new_output_larger_than_budget(tmp_path):
+    cache = artifact_cache.ArtifactCache(str(tmp_path), max_bytes=500)
+    key = _put(cache, "stage_0", 10)
+
+    assert cache.get(key) is not None
+
+
+def test_unlimited_cache_is_not_evicted(tmp_path):
+    cache = artifact_cache.ArtifactCache(str(tmp_path))
+    keys = [_put(cache, f"stage_{i}", 10 - i) for i in range(5)]
+
+    assert all(cache.get(key) is not None for key in keys)
+
+
+def test_cached_computes_once(tmp_path):
+    cache = artifact_cache.ArtifactCache(str(tmp_path))
+    data = pd.DataFrame({"PA0001": [1.0, 2.0]}, index=["s0", "s1"])
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return data
+
+    outputs = [
+        artifact_cache.cached(
+            cache,
+            "stage",
+            {"data": lambda: artifact_cache.frame_hash(data)},
+            compute,
+            artifact_cache.save_frame,
+            artifact_cache.load_frame,
+        )
+        for _ in range(2)
+    ]
+
+    assert len(calls) == 1
+    pd.testing.assert_frame_equal(outputs[1], data)
+
+
+def test_key_depends_on_params(tmp_path):
+    cache = artifact_cache.ArtifactCache(str(tmp_path))
+
+    assert cache.key("stage", {"run": 0, "k": 5}) == cache.key(
+        "stage", {"k": 5, "run": 0}
+    )
+    assert cache.key("stage", {"run": 0}) != cache.key("stage", {"run": 1})
+    assert cache.key("stage", {"run": 0}) != cache.key("other_stage", {"run": 0})
+
+
+def test_batch_effects_round_trip(tmp_path):
+    rng = np.random.RandomState(0)
+    batch_effects = [
+        (rng.randn(k, 4), rng.randint(0, k, 10).astype(np.int16)) for k in [1, 3]
+    ]
+
+    artifact_cache.save_batch_effects(batch_effects, str(tmp_path))
+    loaded = artifact_cache.load_batch_effects(str(tmp_path))
+
+    assert len(loaded) == len(batch_effects)
+    for (offsets, assignment), (loaded_offsets, loaded_assignment) in zip(
+        batch_effects, loaded
+    ):
+        np.testing.assert_array_equal(loaded_offsets, offsets)
+        np.testing.assert_array_equal(loaded_assignment, assignment)
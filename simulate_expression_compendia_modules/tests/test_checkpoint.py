@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+from simulate_expression_compendia_modules import checkpoint
+
+
+def _run_tasks(checkpoint_dir, calls, fail_at=None):
+    # Scores one task per number of experiments, as a simulation run does
+    checkpoints = checkpoint.Checkpoints(checkpoint_dir, 0)
+    scores = []
+    for i in [1, 5, 20]:
+
+        def compute():
+            if i == fail_at:
+                raise RuntimeError("interrupted")
+            calls.append(i)
+            return 1.0 / i
+
+        scores.append(checkpoint.checkpointed(checkpoints, "svcca", compute, i))
+
+    return scores
+
+
+def test_interrupted_run_resumes_from_completed_tasks(tmp_path):
+    calls = []
+    with pytest.raises(RuntimeError):
+        _run_tasks(str(tmp_path), calls, fail_at=20)
+    assert calls == [1, 5]
+
+    calls = []
+    scores = _run_tasks(str(tmp_path), calls)
+
+    assert calls == [20]
+    assert scores == [1.0, 0.2, 0.05]
+
+
+def test_completed_run_is_not_recomputed(tmp_path):
+    _run_tasks(str(tmp_path), [])
+
+    calls = []
+    scores = _run_tasks(str(tmp_path), calls)
+
+    assert calls == []
+    assert scores == [1.0, 0.2, 0.05]
+
+
+def test_runs_are_checkpointed_separately(tmp_path):
+    checkpoints = [checkpoint.Checkpoints(str(tmp_path), run) for run in range(2)]
+
+    checkpoints[0].save("simulated_data", "run 0")
+
+    assert checkpoints[0].done("simulated_data")
+    assert not checkpoints[1].done("simulated_data")
+    assert checkpoints[0].load("simulated_data") == "run 0"
+
+
+def test_no_temporary_files_are_left(tmp_path):
+    checkpoints = checkpoint.Checkpoints(str(tmp_path), 0)
+
+    checkpoints.save("svcca", 0.5, 5)
+
+    assert sorted(os.listdir(checkpoints.run_dir)) == [
+        checkpoint.MANIFEST_FILE,
+        "svcca_5.pickle",
+    ]
+
+
+def test_checkpoint_dir_ignores_execution_params(tmp_path):
+    params = {"num_simulated_experiments": 600, "num_cores": 5, "seed": 1}
+
+    checkpoint_dir = checkpoint.simulation_checkpoint_dir(str(tmp_path), "sim", params)
+
+    assert checkpoint_dir == checkpoint.simulation_checkpoint_dir(
+        str(tmp_path), "sim", dict(params, num_cores=1)
+    )
+    assert checkpoint_dir != checkpoint.simulation_checkpoint_dir(
+        str(tmp_path), "sim", dict(params, seed=2)
+    )
@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from simulate_expression_compendia_modules import compendium_io, table_io
+
+
+@pytest.fixture
+def compendium():
+    rng = np.random.RandomState(0)
+    return pd.DataFrame(
+        rng.randn(30, 12).astype(np.float32),
+        index=[f"s{i}" for i in range(30)],
+        columns=[f"PA{i:04d}" for i in range(12)],
+    )
+
+
+def test_compendium_round_trip(tmp_path, compendium):
+    out_file = str(tmp_path / "Experiment_1_0")
+
+    compendium_io.write_compendium(compendium, out_file)
+
+    pd.testing.assert_frame_equal(compendium_io.read_compendium(out_file), compendium)
+    pd.testing.assert_frame_equal(
+        compendium_io.read_compendium(
+            out_file, orientation=compendium_io.GENE_X_SAMPLE
+        ),
+        compendium.T,
+    )
+
+
+def test_compendium_round_trip_gene_x_sample(tmp_path, compendium):
+    out_file = str(tmp_path / "Experiment_1_0")
+
+    compendium_io.write_compendium(
+        compendium.T, out_file, orientation=compendium_io.GENE_X_SAMPLE
+    )
+
+    pd.testing.assert_frame_equal(compendium_io.read_compendium(out_file), compendium)
+
+
+def test_read_compendium_array_gene_x_sample_is_a_view(tmp_path, compendium):
+    out_file = str(tmp_path / "Experiment_1_0")
+    compendium_io.write_compendium(compendium, out_file)
+
+    matrix, samples, genes = compendium_io.read_compendium_array(
+        out_file, orientation=compendium_io.GENE_X_SAMPLE
+    )
+
+    # Transposed view of the memory-mapped sample x gene matrix
+    assert isinstance(matrix.base, np.memmap)
+    assert matrix.base.shape == compendium.shape
+    assert np.shares_memory(matrix, matrix.base)
+    np.testing.assert_array_equal(matrix, compendium.values.T)
+    assert samples == list(compendium.index)
+    assert genes == list(compendium.columns)
+
+
+def test_export_compendium(tmp_path, compendium):
+    out_file = str(tmp_path / "Experiment_1_0")
+    compendium_io.write_compendium(compendium, out_file)
+
+    compendium_io.export_compendium(
+        out_file, float_format=None, compression="none", block_size=7
+    )
+
+    exported = table_io.read_table(
+        table_io.table_file(out_file, "none"), header=0, index_col=0
+    )
+    pd.testing.assert_frame_equal(exported.astype(np.float32), compendium)
+
+
+def test_delta_compendium_decodes_to_base_plus_offsets(tmp_path, compendium):
+    rng = np.random.RandomState(1)
+    offsets = rng.randn(4, compendium.shape[1]).astype(np.float32)
+    assignment = rng.randint(0, 4, compendium.shape[0])
+    base_file = str(tmp_path / "Experiment_base_0")
+    out_file = str(tmp_path / "Experiment_4_0")
+    expected = compendium.values + offsets[assignment]
+
+    compendium_io.write_compendium(compendium, base_file)
+    compendium_io.write_delta_compendium(base_file, offsets, assignment, out_file)
+
+    decoded = compendium_io.read_compendium(out_file)
+    np.testing.assert_array_equal(decoded.values, expected)
+    assert decoded.index.equals(compendium.index)
+    assert decoded.columns.equals(compendium.columns)
+
+    blocks = [block for _, block in compendium_io.iter_compendium_blocks(out_file, 7)]
+    np.testing.assert_array_equal(np.vstack(blocks), expected)
+    np.testing.assert_array_equal(
+        compendium_io.read_compendium_genes(out_file, 3, 8), expected[:, 3:8].T
+    )
+
+
+def test_read_delta_compendium_rejects_dense_compendium(tmp_path, compendium):
+    out_file = str(tmp_path / "Experiment_1_0")
+    compendium_io.write_compendium(compendium, out_file)
+
+    with pytest.raises(ValueError):
+        compendium_io.read_delta_compendium(out_file)
+
+
+def test_partition_map_has_string_categories():
+    assignment = np.array([2, 0, 2, 5, 0])
+    samples = ["s0", "s1", "s2", "s3", "s4"]
+
+    experiment_map = compendium_io.partition_map(assignment, samples)
+
+    assert list(experiment_map.index) == samples
+    assert list(experiment_map.cat.categories) == ["0", "2", "5"]
+    assert list(experiment_map.astype(str)) == ["2", "0", "2", "5", "0"]
+
+
+def test_partition_map_round_trip(tmp_path):
+    assignment = np.array([1, 0, 1, 11, 3])
+    samples = ["s0", "s1", "s2", "s3", "s4"]
+    map_file = str(tmp_path / "Experiment_map_12_0")
+
+    compendium_io.write_partition_map(assignment, map_file)
+    experiment_map = compendium_io.read_partition_map(map_file, samples)
+
+    assert np.load(map_file + compendium_io.MAP_EXT).dtype == compendium_io.MAP_DTYPE
+    pd.testing.assert_series_equal(
+        experiment_map, compendium_io.partition_map(assignment, samples)
+    )
+
+
+def test_partition_map_without_samples(tmp_path):
+    map_file = str(tmp_path / "Experiment_map_1_0")
+
+    compendium_io.write_partition_map(np.array([], dtype=int), map_file)
+    experiment_map = compendium_io.read_partition_map(map_file, [])
+
+    assert len(experiment_map) == 0
+    assert len(experiment_map.cat.categories) == 0
@@ -0,0 +1,337 @@
+import sys
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from simulate_expression_compendia_modules import compendium_io, correction
+
+
+def _reference_remove_batch_effect(
+    x, batch=None, batch2=None, covariates=None, design=None
+):
+    # Direct port of limma's removeBatchEffect: batches are coded with
+    # contr.sum contrasts and fitted together with <design> by least squares
+    def contr_sum(factor):
+        levels = sorted(set(factor))
+        return np.column_stack(
+            [
+                (np.asarray(factor) == level).astype(float)
+                - (np.asarray(factor) == levels[-1])
+                for level in levels[:-1]
+            ]
+        )
+
+    X_batch = [contr_sum(factor) for factor in (batch, batch2) if factor is not None]
+    if covariates is not None:
+        X_batch.append(covariates)
+    X_batch = np.column_stack(X_batch)
+
+    if design is None:
+        design = np.ones((x.shape[1], 1))
+
+    beta = np.linalg.lstsq(np.column_stack([design, X_batch]), x.T, rcond=None)[0]
+
+    return x - (X_batch @ beta[design.shape[1] :]).T
+
+
+def _reference_combat(x, batch, mod=None, par_prior=True, mean_only=False):
+    # Line by line port of sva's ComBat (without reference batch), one batch
+    # and gene at a time. Genes that are constant within a batch are not
+    # corrected
+    x = np.array(x, dtype=float)
+    levels = sorted(set(batch))
+    batches = [np.flatnonzero(batch == level) for level in levels]
+    n_batches = np.array([len(samples) for samples in batches])
+    n_array = n_batches.sum()
+    if (n_batches == 1).any():
+        mean_only = True
+
+    constant = np.zeros(x.shape[0], dtype=bool)
+    for samples in batches:
+        if len(samples) > 1:
+            constant |= x[:, samples].var(axis=1) == 0
+    corrected = x.copy()
+    x = x[~constant]
+
+    batch_design = np.column_stack([batch == level for level in levels]) * 1.0
+    design = batch_design if mod is None else np.column_stack([batch_design, mod])
+    design = design[:, ~np.all(design == 1, axis=0)]
+
+    B_hat = np.linalg.solve(design.T @ design, design.T @ x.T)
+    grand_mean = (n_batches / n_array) @ B_hat[: len(levels)]
+    var_pooled = ((x - (design @ B_hat).T) ** 2).mean(axis=1)
+    covariate_design = design.copy()
+    covariate_design[:, : len(levels)] = 0
+    stand_mean = grand_mean[:, None] + (covariate_design @ B_hat).T
+    s_data = (x - stand_mean) / np.sqrt(var_pooled)[:, None]
+
+    gamma_hat = np.linalg.solve(
+        batch_design.T @ batch_design, batch_design.T @ s_data.T
+    )
+    delta_hat = np.array(
+        [
+            (
+                np.ones(len(s_data))
+                if mean_only
+                else s_data[:, samples].var(axis=1, ddof=1)
+            )
+            for samples in batches
+        ]
+    )
+    gamma_bar = gamma_hat.mean(axis=1)
+    t2 = gamma_hat.var(axis=1, ddof=1)
+
+    def postmean(g_hat, g_bar, n, d_star, t2):
+        return (t2 * n * g_hat + d_star * g_bar) / (t2 * n + d_star)
+
+    gamma_star = np.zeros_like(gamma_hat)
+    delta_star = np.zeros_like(delta_hat)
+    for i, samples in enumerate(batches):
+        sdat = s_data[:, samples]
+        if par_prior and mean_only:
+            gamma_star[i] = postmean(gamma_hat[i], gamma_bar[i], 1, 1, t2[i])
+            delta_star[i] = 1
+        elif par_prior:
+            m, v = delta_hat[i].mean(), delta_hat[i].var(ddof=1)
+            a, b = (2 * v + m**2) / v, (m * v + m**3) / v
+            g_old, d_old = gamma_hat[i], delta_hat[i]
+            change = 1
+            while change > 1e-4:
+                g_new = postmean(gamma_hat[i], gamma_bar[i], len(samples), d_old, t2[i])
+                sum2 = ((sdat - g_new[:, None]) ** 2).sum(axis=1)
+                d_new = (0.5 * sum2 + b) / (len(samples) / 2 + a - 1)
+                change = max(
+                    np.max(np.abs(g_new - g_old) / g_old),
+                    np.max(np.abs(d_new - d_old) / d_old),
+                )
+                g_old, d_old = g_new, d_new
+            gamma_star[i], delta_star[i] = g_new, d_new
+        else:
+            d_hat = np.ones(len(sdat)) if mean_only else delta_hat[i]
+            for gene in range(len(sdat)):
+                g = np.delete(gamma_hat[i], gene)
+                d = np.delete(d_hat, gene)
+                sum2 = ((sdat[gene][None, :] - g[:, None]) ** 2).sum(axis=1)
+                LH = np.exp(-sum2 / (2 * d)) / (2 * np.pi * d) ** (len(samples) / 2)
+                gamma_star[i, gene] = (g * LH).sum() / LH.sum()
+                delta_star[i, gene] = (d * LH).sum() / LH.sum()
+
+    bayes_data = s_data.copy()
+    for i, samples in enumerate(batches):
+        bayes_data[:, samples] = (
+            bayes_data[:, samples] - gamma_star[i][:, None]
+        ) / np.sqrt(delta_star[i])[:, None]
+
+    corrected[~constant] = bayes_data * np.sqrt(var_pooled)[:, None] + stand_mean
+    return corrected
+
+
+@pytest.fixture
+def expression():
+    # Expression data (gene x sample) with batch effects added
+    rng = np.random.RandomState(0)
+    batch = np.array([0, 0, 0, 1, 1, 1, 1, 2, 2, 2, 2, 2])
+    x = rng.randn(50, 12) + 2 * rng.randn(50, 3)[:, batch]
+    return x, batch
+
+
+@pytest.fixture
+def fake_r(monkeypatch):
+    # Stand-in for rpy2, which only converts categoricals with string
+    # categories to R factors. Records the batches passed to R
+    batches = []
+
+    def convert(batch):
+        if isinstance(batch.dtype, pd.CategoricalDtype) and not all(
+            isinstance(category, str) for category in batch.cat.categories
+        ):
+            raise ValueError("Categories must be strings")
+        batches.append(batch)
+
+    class Package:
+        def removeBatchEffect(self, data, batch):
+            convert(batch)
+            return correction.remove_batch_effect(data, batch=batch)
+
+        def ComBat(self, data, batch):
+            convert(batch)
+            return correction.combat(data, batch=batch)
+
+    robjects = types.ModuleType("rpy2.robjects")
+    packages = types.ModuleType("rpy2.robjects.packages")
+    packages.importr = lambda name: Package()
+    robjects.packages = packages
+    robjects.pandas2ri = types.SimpleNamespace(activate=lambda: None)
+
+    monkeypatch.setitem(sys.modules, "rpy2", types.ModuleType("rpy2"))
+    monkeypatch.setitem(sys.modules, "rpy2.robjects", robjects)
+    monkeypatch.setitem(sys.modules, "rpy2.robjects.packages", packages)
+    monkeypatch.setattr(correction, "_r_packages", {})
+
+    return batches
+
+
+@pytest.mark.parametrize("correction_method", ["limma", "combat"])
+def test_r_methods_get_string_factors(fake_r, correction_method):
+    rng = np.random.RandomState(0)
+    samples = [f"s{i}" for i in range(12)]
+    experiment_map = compendium_io.partition_map(np.arange(12) % 3, samples)
+    experiment_data = pd.DataFrame(rng.randn(20, 12), columns=samples)
+
+    corrected = correction.correct(experiment_data, experiment_map, correction_method)
+
+    assert np.asarray(corrected).shape == (20, 12)
+    assert len(fake_r) == 1
+
+
+def test_remove_batch_effect_matches_limma(expression):
+    x, batch = expression
+
+    np.testing.assert_allclose(
+        correction.remove_batch_effect(x, batch=batch),
+        _reference_remove_batch_effect(x, batch=batch),
+        atol=1e-12,
+    )
+
+
+def test_remove_batch_effect_with_design_matches_limma(expression):
+    x, batch = expression
+    rng = np.random.RandomState(1)
+    batch2 = np.arange(12) % 2
+    covariates = rng.randn(12, 1)
+    design = np.column_stack([np.ones(12), np.arange(12) % 3 == 0])
+
+    np.testing.assert_allclose(
+        correction.remove_batch_effect(
+            x, batch=batch, batch2=batch2, covariates=covariates, design=design
+        ),
+        _reference_remove_batch_effect(
+            x, batch=batch, batch2=batch2, covariates=covariates, design=design
+        ),
+        atol=1e-12,
+    )
+
+
+def test_remove_batch_effect_ignores_dependent_covariates(expression):
+    # limma sets the coefficients that cannot be estimated to 0
+    x, batch = expression
+    covariates = np.random.RandomState(1).randn(12, 1)
+
+    np.testing.assert_allclose(
+        correction.remove_batch_effect(
+            x, batch=batch, covariates=np.column_stack([covariates, 2 * covariates])
+        ),
+        _reference_remove_batch_effect(x, batch=batch, covariates=covariates),
+        atol=1e-12,
+    )
+
+
+def test_sum_contrasts():
+    np.testing.assert_array_equal(
+        correction.sum_contrasts(["b", "a", "c", "a"]),
+        [[0, 1], [1, 0], [-1, -1], [1, 0]],
+    )
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {},
+        {"mean_only": True},
+        {"par_prior": False},
+        {"par_prior": False, "mean_only": True},
+        {"mod": (np.arange(12) % 2)[:, None]},
+    ],
+)
+def test_combat_matches_sva(expression, options):
+    x, batch = expression
+
+    np.testing.assert_allclose(
+        correction.combat(x, batch, block_size=16, **options),
+        _reference_combat(x, batch, **options),
+        atol=1e-10,
+    )
+
+
+def test_combat_with_single_sample_batch_matches_sva(expression):
+    # Only the mean of the batches is adjusted
+    x, batch = expression
+    batch = batch.copy()
+    batch[0] = 3
+
+    np.testing.assert_allclose(
+        correction.combat(x, batch), _reference_combat(x, batch), atol=1e-10
+    )
+
+
+def test_combat_leaves_genes_constant_within_a_batch(expression):
+    x, batch = expression
+    x = x.copy()
+    x[5, batch == 2] = 0.3
+
+    corrected = correction.combat(x, batch, block_size=16)
+
+    np.testing.assert_array_equal(corrected[5], x[5])
+    np.testing.assert_allclose(corrected, _reference_combat(x, batch), atol=1e-10)
+
+
+def test_one_hot_fast_path_matches_least_squares(expression):
+    x, batch = expression
+
+    # A design of ones is corrected by least squares rather than batch means
+    np.testing.assert_allclose(
+        correction.remove_batch_effect(x, batch=batch),
+        correction.remove_batch_effect(x, batch=batch, design=np.ones((12, 1))),
+        atol=1e-12,
+    )
+
+
+def test_group_means(expression):
+    x, batch = expression
+
+    np.testing.assert_allclose(
+        correction.group_means(x, batch),
+        np.column_stack([x[:, batch == level].mean(axis=1) for level in range(3)]),
+    )
+
+
+def test_numpy_methods_do_not_start_r(fake_r, expression):
+    x, batch = expression
+
+    for correction_method in ["limma_numpy", "combat_numpy", "none"]:
+        correction.correct(pd.DataFrame(x), pd.Series(batch), correction_method)
+
+    assert correction._r_packages == {}
+
+
+def test_r_is_started_once(fake_r, expression):
+    x, batch = expression
+    experiment_map = compendium_io.partition_map(batch, [f"s{i}" for i in range(12)])
+
+    for _ in range(2):
+        correction.correct(pd.DataFrame(x), experiment_map, "limma")
+
+    assert list(correction._r_packages) == ["limma"]
+    assert len(fake_r) == 2
+
+
+def test_registered_method(monkeypatch, expression):
+    x, batch = expression
+    monkeypatch.setattr(correction, "METHODS", dict(correction.METHODS))
+
+    correction.register_method("center", lambda data, batch: data - data.mean())
+
+    np.testing.assert_allclose(
+        correction.correct(pd.DataFrame(x), batch, "center"), x - x.mean(axis=0)
+    )
+    assert correction.block_correction("center") is None
+    assert correction.block_correction("limma_numpy") is not None
+
+
+def test_unknown_method_is_rejected(expression):
+    x, batch = expression
+
+    with pytest.raises(ValueError):
+        correction.correct(pd.DataFrame(x), batch, "harmony")
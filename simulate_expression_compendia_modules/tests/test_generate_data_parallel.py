@@ -0,0 +1,284 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from simulate_expression_compendia_modules import (
+    compendium_io,
+    correction,
+    generate_data_parallel,
+)
+
+
+@pytest.fixture
+def simulated_data():
+    rng = np.random.RandomState(0)
+    return pd.DataFrame(
+        rng.randn(130, 40),
+        index=[f"s{i}" for i in range(130)],
+        columns=[f"PA{i:04d}" for i in range(40)],
+    )
+
+
+def test_permute_data_permutes_each_sample(simulated_data):
+    permuted = generate_data_parallel.permute_data(simulated_data)
+
+    assert permuted.index.equals(simulated_data.index)
+    assert permuted.columns.equals(simulated_data.columns)
+    np.testing.assert_array_equal(
+        np.sort(permuted.values, axis=1), np.sort(simulated_data.values, axis=1)
+    )
+    assert not np.array_equal(permuted.values, simulated_data.values)
+
+
+def test_unseeded_permute_data_leaves_numpy_random_state(simulated_data):
+    np.random.seed(3)
+    generate_data_parallel.permute_data(simulated_data)
+    after_permute = np.random.normal(0.0, 0.2, 10)
+
+    np.random.seed(3)
+    expected = np.random.normal(0.0, 0.2, 10)
+
+    np.testing.assert_array_equal(after_permute, expected)
+
+
+def test_seeded_permute_data_is_reproducible(simulated_data):
+    permuted = [
+        generate_data_parallel.permute_data(
+            simulated_data, rng=np.random.default_rng(7)
+        )
+        for _ in range(2)
+    ]
+
+    pd.testing.assert_frame_equal(permuted[0], permuted[1])
+
+
+def test_seeded_permute_rows_only_draws_uniform_keys(simulated_data):
+    # Generator.permuted needs numpy >= 1.20
+    values = simulated_data.values.copy()
+    rng = SimpleNamespace(random=np.random.default_rng(7).random)
+
+    generate_data_parallel.permute_rows(values, rng, block_size=16)
+
+    np.testing.assert_array_equal(
+        np.sort(values, axis=1), np.sort(simulated_data.values, axis=1)
+    )
+    assert not (values == simulated_data.values).all(axis=1).any()
+
+
+def test_permute_data_inplace(simulated_data):
+    values = simulated_data.values.copy()
+
+    permuted = generate_data_parallel.permute_data(simulated_data, inplace=True)
+
+    assert permuted is simulated_data
+    np.testing.assert_array_equal(
+        np.sort(simulated_data.values, axis=1), np.sort(values, axis=1)
+    )
+
+
+def test_permute_data_inplace_rejects_experiment_ids(simulated_data):
+    simulated_data["experiment_id"] = "E0"
+
+    with pytest.raises(ValueError):
+        generate_data_parallel.permute_data(simulated_data, inplace=True)
+
+
+def _array_split_experiments(simulated_data, num_experiments):
+    # Technical variation drawn as by the original add_experiments_io: the
+    # sample ids are shuffled, split by 'array_split' and shifted one
+    # partition at a time, and sorted in place after each number of
+    # experiments
+    simulated_ind = np.array(simulated_data.index)
+    batch_effects = []
+
+    for i in num_experiments:
+        offsets = np.zeros((i, simulated_data.shape[1]))
+        assignment = pd.Series(0, index=simulated_data.index)
+
+        if i > 1:
+            np.random.shuffle(simulated_ind)
+            for j, partition in enumerate(np.array_split(simulated_ind, i)):
+                offsets[j] = np.random.normal(0.0, 0.2, [1, simulated_data.shape[1]])
+                assignment[partition] = j
+
+        simulated_ind.sort()
+        batch_effects.append((offsets, assignment.values))
+
+    return batch_effects
+
+
+@pytest.mark.parametrize("num_experiments", [[1, 7, 20, 3], [4, 1, 130]])
+def test_add_experiments_matches_array_split_partitions(
+    simulated_data, num_experiments
+):
+    np.random.seed(5)
+    expected = _array_split_experiments(simulated_data, num_experiments)
+    np.random.seed(5)
+    batch_effects = generate_data_parallel.add_experiments(
+        simulated_data, num_experiments
+    )
+
+    for (offsets, assignment), (expected_offsets, expected_assignment) in zip(
+        batch_effects, expected
+    ):
+        np.testing.assert_array_equal(assignment, expected_assignment)
+        np.testing.assert_array_equal(offsets, expected_offsets)
+
+
+def test_draw_batch_effects_partition_sizes():
+    offsets, assignment = generate_data_parallel.draw_batch_effects(
+        23, 4, 5, rng=np.random.default_rng(0)
+    )
+
+    assert offsets.shape == (5, 4)
+    np.testing.assert_array_equal(np.bincount(assignment), [5, 5, 5, 4, 4])
+
+
+def test_inject_batch_effects(simulated_data):
+    offsets, assignment = generate_data_parallel.draw_batch_effects(
+        130, 40, 6, rng=np.random.default_rng(3)
+    )
+
+    noisy, noisy_assignment = generate_data_parallel.inject_batch_effects(
+        simulated_data, 6, rng=np.random.default_rng(3)
+    )
+
+    np.testing.assert_array_equal(noisy_assignment, assignment)
+    np.testing.assert_array_equal(noisy, simulated_data.values + offsets[assignment])
+
+
+def test_inject_batch_effects_keeps_experiments_together(simulated_data):
+    groups = np.repeat([f"E{i}" for i in range(26)], 5)
+
+    noisy, assignment = generate_data_parallel.inject_batch_effects(
+        simulated_data, 4, groups=groups, rng=np.random.default_rng(3)
+    )
+
+    assert set(assignment) == set(range(4))
+    for group in set(groups):
+        assert len(set(assignment[groups == group])) == 1
+    # Samples of a partition are shifted alike
+    shifts = noisy - simulated_data.values
+    for partition in range(4):
+        partition_shifts = shifts[assignment == partition]
+        np.testing.assert_allclose(
+            partition_shifts,
+            partition_shifts[[0]].repeat(len(partition_shifts), axis=0),
+        )
+
+
+def test_experiment_row_index_matches_loop():
+    experiment_ids = np.array(["E2", "E0", "E2", "E1", "E0", "E2", "E3"])
+
+    unique_ids, indptr, rows = generate_data_parallel.experiment_row_index(
+        experiment_ids
+    )
+
+    assert list(unique_ids) == ["E2", "E0", "E1", "E3"]
+    for e, experiment_id in enumerate(unique_ids):
+        expected_rows = [
+            row
+            for row in range(len(experiment_ids))
+            if experiment_ids[row] == experiment_id
+        ]
+        assert list(rows[indptr[e] : indptr[e + 1]]) == expected_rows
+    assert indptr[0] == 0
+    assert indptr[-1] == len(experiment_ids)
+
+
+def test_experiment_index_without_samples():
+    unique_ids, indptr, rows = generate_data_parallel.experiment_row_index(
+        np.array([], dtype=object)
+    )
+    assignment = generate_data_parallel.sample_assignment(
+        np.array([], dtype=int), indptr, rows
+    )
+
+    assert len(unique_ids) == 0
+    assert list(indptr) == [0]
+    assert len(rows) == 0
+    assert len(assignment) == 0
+
+
+def test_sample_assignment_matches_loop():
+    experiment_ids = np.array(["E2", "E0", "E2", "E1", "E0", "E2", "E3"])
+    unique_ids, indptr, rows = generate_data_parallel.experiment_row_index(
+        experiment_ids
+    )
+    # Partition 1 has no experiments
+    experiment_assignment = np.array([2, 0, 2, 3])
+
+    assignment = generate_data_parallel.sample_assignment(
+        experiment_assignment, indptr, rows
+    )
+
+    partition = dict(zip(unique_ids, experiment_assignment))
+    assert list(assignment) == [partition[e] for e in experiment_ids]
+
+
+@pytest.mark.parametrize("prefetch", [True, False])
+def test_iter_experiments_matches_add_experiments(simulated_data, prefetch):
+    num_experiments = [1, 5, 20]
+
+    np.random.seed(11)
+    batch_effects = generate_data_parallel.add_experiments(
+        simulated_data, num_experiments
+    )
+    np.random.seed(11)
+    compendia = list(
+        generate_data_parallel.iter_experiments(
+            simulated_data, num_experiments, prefetch=prefetch
+        )
+    )
+
+    assert [i for i, _, _ in compendia] == num_experiments
+    for (offsets, assignment), (_, noisy, noisy_assignment) in zip(
+        batch_effects, compendia
+    ):
+        np.testing.assert_array_equal(noisy_assignment, assignment)
+        np.testing.assert_array_equal(
+            noisy, simulated_data.values + offsets[assignment]
+        )
+
+
+@pytest.mark.parametrize("correction_method", ["limma_numpy", "combat_numpy", "none"])
+def test_apply_correction_blocks_matches_in_memory_correction(
+    tmp_path, correction_method
+):
+    # Enough genes for several blocks, corrected across threads
+    rng = np.random.RandomState(0)
+    num_genes = 2 * correction.CORRECTION_BLOCK_SIZE + 100
+    simulated_data = pd.DataFrame(
+        rng.randn(12, num_genes),
+        index=[f"s{i}" for i in range(12)],
+        columns=[f"PA{i:04d}" for i in range(num_genes)],
+    )
+    [(offsets, assignment)] = generate_data_parallel.add_experiments(
+        simulated_data, [3]
+    )
+
+    base_file = str(tmp_path / "Experiment_base_0")
+    experiment_file = str(tmp_path / "Experiment_3_0")
+    map_file = str(tmp_path / "Experiment_map_3_0")
+    corrected_file = str(tmp_path / "Experiment_corrected_3_0")
+    compendium_io.write_compendium(simulated_data, base_file)
+    compendium_io.write_delta_compendium(
+        base_file, offsets, assignment, experiment_file
+    )
+    compendium_io.write_partition_map(assignment, map_file)
+
+    generate_data_parallel.apply_correction_blocks(
+        experiment_file, map_file, correction_method, corrected_file, num_threads=4
+    )
+
+    experiment_data = compendium_io.read_compendium(experiment_file)
+    expected = correction.correct(
+        experiment_data.T,
+        compendium_io.partition_map(assignment, experiment_data.index),
+        correction_method,
+    )
+    np.testing.assert_allclose(
+        compendium_io.read_compendium(corrected_file).values.T, expected, atol=1e-5
+    )
@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("ponyo")
+
+from simulate_expression_compendia_modules import generate_data_parallel, pipeline
+
+
+def test_noise_scale_results_are_split_per_scale():
+    noise_scales = [0.1, 0.2, 0.4]
+    index = pd.Index([1, 5], name="number of experiments")
+    results = [
+        (
+            0.3 + run,
+            pd.DataFrame(
+                np.arange(6).reshape(2, 3) + 10 * run, index=index, columns=noise_scales
+            ),
+        )
+        for run in range(2)
+    ]
+
+    results_per_scale = pipeline._noise_scale_results(results, noise_scales)
+
+    assert sorted(results_per_scale) == noise_scales
+    for j, scale in enumerate(noise_scales):
+        for run, (permuted_score, scores) in enumerate(results_per_scale[scale]):
+            assert permuted_score == 0.3 + run
+            pd.testing.assert_frame_equal(
+                scores,
+                pd.DataFrame({"score": [j + 10 * run, j + 3 + 10 * run]}, index=index),
+            )
+
+
+def test_noise_scale_results_without_sweep():
+    results = [(0.3, pd.DataFrame({"score": [0.9]}))]
+
+    assert pipeline._noise_scale_results(results, None) == {
+        generate_data_parallel.NOISE_SCALE: results
+    }
+
+
+def test_noise_scales_include_default_scale():
+    assert pipeline._noise_scales({"noise_scales": [0.4, 0.1]}) == [0.1, 0.2, 0.4]
+    assert pipeline._noise_scales({"noise_scales": [0.4], "dense_sweep": True}) is None
+    assert pipeline._noise_scales({}) is None
+
+
+@pytest.mark.parametrize("out_name", ["transposed.tsv", "transposed.tsv.xz"])
+def test_transpose_data(tmp_path, out_name):
+    # Several blocks of genes and samples, the last ones partial
+    rng = np.random.RandomState(0)
+    data_file = str(tmp_path / "data.tsv")
+    pd.DataFrame(
+        rng.randn(11, 7),
+        index=[f"PA{i:04d}" for i in range(11)],
+        columns=[f"s{i}" for i in range(7)],
+    ).to_csv(data_file, sep="\t")
+    out_file = str(tmp_path / out_name)
+
+    pipeline.transpose_data(data_file, out_file, block_size=3)
+
+    pd.testing.assert_frame_equal(
+        pd.read_csv(out_file, sep="\t", index_col=0),
+        pd.read_csv(data_file, sep="\t", index_col=0).T,
+        check_names=False,
+    )
+    assert sorted(os.listdir(tmp_path)) == sorted(["data.tsv", out_name])
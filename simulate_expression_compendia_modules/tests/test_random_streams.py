@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+
+from simulate_expression_compendia_modules import (
+    generate_data_parallel,
+    random_streams,
+)
+
+
+def _draw(streams, stage, num_experiments=None):
+    return streams.generator(stage, num_experiments).random(5)
+
+
+def test_streams_are_reproducible():
+    np.testing.assert_array_equal(
+        _draw(random_streams.RandomStreams(42, 3), "batch_effects", 20),
+        _draw(random_streams.RandomStreams(42, 3), "batch_effects", 20),
+    )
+    assert random_streams.RandomStreams(42, 3).seed("svcca", 5) == (
+        random_streams.RandomStreams(42, 3).seed("svcca", 5)
+    )
+
+
+def test_tasks_get_different_streams():
+    draws = [
+        _draw(random_streams.RandomStreams(seed, run), stage, num_experiments)
+        for seed, run, stage, num_experiments in [
+            (42, 0, "batch_effects", 5),
+            (43, 0, "batch_effects", 5),
+            (42, 1, "batch_effects", 5),
+            (42, 0, "svcca", 5),
+            (42, 0, "batch_effects", 20),
+            (42, 0, "batch_effects", None),
+        ]
+    ]
+
+    for i in range(len(draws)):
+        for j in range(i + 1, len(draws)):
+            assert not np.array_equal(draws[i], draws[j])
+
+
+def test_seed_sequence_matches_spawned_sequence():
+    streams = random_streams.RandomStreams(42, 3)
+    stage = random_streams.STAGES.index("batch_effects")
+
+    spawned = np.random.SeedSequence(42).spawn(4)[3].spawn(stage + 1)[stage]
+
+    np.testing.assert_array_equal(
+        streams.seed_sequence("batch_effects").generate_state(4),
+        spawned.generate_state(4),
+    )
+
+
+def test_batch_effects_do_not_depend_on_other_numbers_of_experiments():
+    # Sample ids not in sorted order
+    rng = np.random.RandomState(0)
+    simulated_data = pd.DataFrame(
+        rng.randn(30, 8), index=[f"s{i}" for i in rng.permutation(30)]
+    )
+
+    [alone] = generate_data_parallel.add_experiments(
+        simulated_data, [5], random_streams.RandomStreams(42, 0)
+    )
+    _, after_other = generate_data_parallel.add_experiments(
+        simulated_data, [2, 5], random_streams.RandomStreams(42, 0)
+    )
+
+    np.testing.assert_array_equal(alone[0], after_other[0])
+    np.testing.assert_array_equal(alone[1], after_other[1])
+
+
+def test_batch_effects_do_not_depend_on_other_tasks():
+    rng = np.random.RandomState(0)
+    simulated_data = pd.DataFrame(rng.randn(60, 8))
+    simulated_data["experiment_id"] = np.repeat([f"E{i}" for i in range(12)], 5)
+
+    batch_effects = [
+        generate_data_parallel.add_experiments_grped(
+            simulated_data, num_partitions, random_streams.RandomStreams(42, 0)
+        )
+        for num_partitions in [[1, 5], [5, 10]]
+    ]
+
+    np.testing.assert_array_equal(batch_effects[0][1][0], batch_effects[1][0][0])
+    np.testing.assert_array_equal(batch_effects[0][1][1], batch_effects[1][0][1])
+
+
+def test_run_streams_without_seed():
+    assert random_streams.run_streams(None, 0) is None
+    assert random_streams.run_streams(42, 0).run == 0
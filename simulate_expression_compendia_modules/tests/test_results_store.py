@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from simulate_expression_compendia_modules import results_store
+
+SIMULATION = {
+    "dataset_name": "Pseudomonas",
+    "simulation_type": "experiment_lvl_sim",
+    "correction_method": "limma",
+    "num_simulated": 600,
+    "noise_scale": 0.2,
+}
+
+
+@pytest.fixture
+def run_scores():
+    # Similarity scores of 4 runs, as returned by the simulations
+    rng = np.random.RandomState(0)
+    return {
+        run: pd.DataFrame(
+            {"score": rng.rand(3)}, index=pd.Index([1, 5, 20], name="number")
+        )
+        for run in range(4)
+    }
+
+
+def test_summarize_scores(tmp_path, run_scores):
+    store_file = str(tmp_path / "scores.sqlite")
+    scores = results_store.iteration_scores(run_scores)
+    results_store.write_scores(store_file, scores, flow="uncorrected", **SIMULATION)
+
+    summary = results_store.summarize_scores(store_file, flow="uncorrected")
+
+    grouped = scores.groupby("num_experiments")["score"]
+    assert list(summary["num_experiments"]) == [1, 5, 20]
+    assert list(summary["count"]) == [4, 4, 4]
+    np.testing.assert_allclose(summary["score"], grouped.mean())
+    np.testing.assert_allclose(summary["std_err"], grouped.sem())
+    np.testing.assert_allclose(
+        summary["ymax"] - summary["ymin"], 2 * 1.96 * grouped.sem()
+    )
+
+
+def test_write_scores_replaces_scores_of_same_simulation(tmp_path, run_scores):
+    store_file = str(tmp_path / "scores.sqlite")
+    scores = results_store.iteration_scores(run_scores)
+
+    for flow in ["uncorrected", "corrected", "corrected"]:
+        results_store.write_scores(store_file, scores, flow=flow, **SIMULATION)
+
+    assert len(results_store.read_scores(store_file)) == 2 * len(scores)
+    assert len(results_store.read_scores(store_file, flow="corrected")) == len(scores)
+
+
+def test_permuted_scores_have_no_number_of_experiments(tmp_path):
+    store_file = str(tmp_path / "scores.sqlite")
+    scores = results_store.iteration_scores({0: 0.1, 1: np.array([0.2, 0.3])})
+    results_store.write_scores(store_file, scores, flow="permuted", **SIMULATION)
+
+    saved = results_store.read_scores(store_file, flow="permuted")
+
+    assert list(saved["iteration"]) == [0, 1, 1]
+    assert saved["num_experiments"].isnull().all()
+    np.testing.assert_allclose(saved["score"], [0.1, 0.2, 0.3])
+
+
+def test_unknown_filter_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        results_store.read_scores(str(tmp_path / "scores.sqlite"), flows="corrected")
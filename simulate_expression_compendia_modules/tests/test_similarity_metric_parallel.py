@@ -0,0 +1,189 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from simulate_expression_compendia_modules import (
+    correction,
+    generate_data_parallel,
+    similarity_metric_parallel,
+)
+
+NUM_PCS = 5
+
+
+@pytest.fixture
+def simulated_data():
+    rng = np.random.RandomState(0)
+    return rng.randn(60, 8) @ rng.randn(8, 40) + 0.5 * rng.randn(60, 40)
+
+
+def _pca_basis(data):
+    # Orthonormal basis of the top PC scores of <data>
+    centered = data - data.mean(axis=0)
+    u, _, _ = np.linalg.svd(centered, full_matrices=False)
+    return u[:, :NUM_PCS]
+
+
+@pytest.fixture(params=[False, True], ids=["eigh", "subspace_iteration"])
+def gram_eigh_max_samples(request, monkeypatch):
+    if request.param:
+        monkeypatch.setattr(similarity_metric_parallel, "GRAM_EIGH_MAX_SAMPLES", 10)
+
+
+# Small numbers of experiments update the Gram matrix, large numbers
+# materialize the compendium
+@pytest.mark.parametrize("num_experiments", [1, 3, 10, 40, 60])
+def test_low_rank_pca_basis_matches_pca(
+    simulated_data, gram_eigh_max_samples, num_experiments
+):
+    rng = np.random.RandomState(1)
+    offsets = rng.randn(num_experiments, simulated_data.shape[1])
+    assignment = rng.permutation(np.arange(60) % num_experiments)
+
+    basis = similarity_metric_parallel.low_rank_pca_basis(
+        similarity_metric_parallel.base_decomposition(simulated_data),
+        offsets,
+        assignment,
+        NUM_PCS,
+    )
+
+    assert basis.shape == (60, NUM_PCS)
+    np.testing.assert_allclose(basis.T @ basis, np.eye(NUM_PCS), atol=1e-10)
+    assert similarity_metric_parallel.basis_similarity(
+        basis, _pca_basis(simulated_data + offsets[assignment])
+    ) == pytest.approx(1.0, abs=1e-8)
+
+
+def test_data_basis_matches_pca(simulated_data, gram_eigh_max_samples):
+    # PCA of materialized compendia
+    basis = similarity_metric_parallel._data_basis(
+        simulated_data - simulated_data.mean(axis=0), NUM_PCS
+    )
+
+    assert similarity_metric_parallel.basis_similarity(
+        basis, _pca_basis(simulated_data)
+    ) == pytest.approx(1.0, abs=1e-8)
+
+
+def test_data_basis_of_exactly_centered_data():
+    # Constant directions are exactly in the null space of the Gram matrix
+    half = np.random.RandomState(0).randint(-3, 4, (30, 40)).astype(float)
+    centered = np.vstack([half, -half])
+
+    basis = similarity_metric_parallel._data_basis(centered, NUM_PCS)
+
+    assert similarity_metric_parallel.basis_similarity(
+        basis, _pca_basis(centered)
+    ) == pytest.approx(1.0, abs=1e-8)
+
+
+def test_limma_corrected_pca_basis_with_one_sample_per_experiment(simulated_data):
+    # The corrected compendium is zero
+    basis = similarity_metric_parallel.limma_corrected_pca_basis(
+        similarity_metric_parallel.base_decomposition(simulated_data),
+        np.arange(60),
+        NUM_PCS,
+    )
+
+    assert basis.shape == (60, NUM_PCS)
+    np.testing.assert_allclose(basis.T @ basis, np.eye(NUM_PCS), atol=1e-10)
+
+
+def test_limma_corrected_pca_basis_of_low_rank_compendia(simulated_data):
+    # The corrected compendium has rank 3, so its other PCs are arbitrary,
+    # but must not change between calls
+    decomposition = similarity_metric_parallel.base_decomposition(simulated_data)
+    assignment = np.minimum(np.arange(60), 56)
+
+    bases = [
+        similarity_metric_parallel.limma_corrected_pca_basis(
+            decomposition, assignment, NUM_PCS
+        )
+        for _ in range(3)
+    ]
+
+    for basis in bases[1:]:
+        np.testing.assert_array_equal(basis, bases[0])
+
+
+def test_low_rank_pca_basis_with_empty_experiments(simulated_data):
+    rng = np.random.RandomState(1)
+    offsets = rng.randn(5, simulated_data.shape[1])
+    assignment = np.arange(60) % 3
+
+    basis = similarity_metric_parallel.low_rank_pca_basis(
+        similarity_metric_parallel.base_decomposition(simulated_data),
+        offsets,
+        assignment,
+        NUM_PCS,
+    )
+
+    assert similarity_metric_parallel.basis_similarity(
+        basis, _pca_basis(simulated_data + offsets[assignment])
+    ) == pytest.approx(1.0, abs=1e-8)
+
+
+@pytest.mark.parametrize("num_experiments", [1, 3, 10, 20])
+def test_limma_corrected_pca_basis_matches_pca_of_corrected_data(
+    simulated_data, gram_eigh_max_samples, num_experiments
+):
+    rng = np.random.RandomState(1)
+    offsets = rng.randn(num_experiments, simulated_data.shape[1])
+    assignment = rng.permutation(np.arange(60) % num_experiments)
+    corrected = correction.remove_batch_effect(
+        (simulated_data + offsets[assignment]).T, batch=assignment
+    ).T
+
+    basis = similarity_metric_parallel.limma_corrected_pca_basis(
+        similarity_metric_parallel.base_decomposition(simulated_data),
+        assignment,
+        NUM_PCS,
+    )
+
+    assert similarity_metric_parallel.basis_similarity(
+        basis, _pca_basis(corrected)
+    ) == pytest.approx(1.0, abs=1e-8)
+
+
+# Permutations have a flat spectrum, so their PCs found by randomized
+# subspace iteration differ slightly from the PCs of the PCA solver
+@pytest.mark.parametrize("use_pca, atol", [(True, 5e-3), (False, 1e-3)])
+def test_permuted_null_scores_match_svcca_scores(simulated_data, use_pca, atol):
+    simulated_data = pd.DataFrame(simulated_data)
+    num_permutations = 50
+
+    scores = similarity_metric_parallel.permuted_null_scores(
+        simulated_data,
+        num_permutations,
+        use_pca,
+        NUM_PCS,
+        rng=np.random.default_rng(2),
+        random_state=0,
+    )
+
+    # Same permutations, drawn first from the same generator
+    permutations = np.repeat(simulated_data.values[np.newaxis], num_permutations, 0)
+    generate_data_parallel.permute_rows(
+        permutations.reshape(-1, simulated_data.shape[1]), np.random.default_rng(2)
+    )
+    expected = [
+        similarity_metric_parallel.svcca_score(
+            simulated_data, pd.DataFrame(permuted), use_pca, NUM_PCS, random_state=0
+        )
+        for permuted in permutations
+    ]
+
+    np.testing.assert_allclose(scores, expected, atol=atol)
+
+
+def test_null_thresholds_are_quantiles():
+    null_scores = np.random.RandomState(0).permutation(np.linspace(0, 1, 201))
+
+    thresholds = similarity_metric_parallel.null_thresholds(null_scores)
+
+    assert thresholds.index.name == "level"
+    assert list(thresholds.index) == similarity_metric_parallel.NULL_LEVELS
+    np.testing.assert_allclose(thresholds, [0.95, 0.99])
+    np.testing.assert_allclose(
+        similarity_metric_parallel.null_thresholds(null_scores, [0.5]), [0.5]
+    )
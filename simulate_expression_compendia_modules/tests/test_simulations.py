@@ -0,0 +1,331 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("ponyo")
+
+from simulate_expression_compendia_modules import (
+    generate_data_parallel,
+    random_streams,
+    similarity_metric_parallel,
+    simulations,
+)
+
+NUM_EXPERIMENTS = [1, 4, 10]
+
+
+@pytest.fixture
+def simulated_data():
+    rng = np.random.RandomState(0)
+    return pd.DataFrame(
+        rng.randn(40, 8) @ rng.randn(8, 30) + 0.5 * rng.randn(40, 30),
+        index=[f"s{i:02d}" for i in range(40)],
+        columns=[f"PA{i:04d}" for i in range(30)],
+    )
+
+
+def _score_compendia(simulated_data, local_dir, flows, **kwargs):
+    return simulations.score_compendia(
+        simulated_data,
+        simulated_data,
+        NUM_EXPERIMENTS,
+        flows,
+        "limma_numpy",
+        True,
+        5,
+        0,
+        str(local_dir),
+        "Pseudomonas",
+        "experiment_lvl_sim",
+        streams=random_streams.RandomStreams(1, 0),
+        **kwargs,
+    )
+
+
+def test_in_memory_scores_match_scores_of_compendia_on_disk(tmp_path, simulated_data):
+    permuted_data = generate_data_parallel.permute_data(
+        simulated_data, np.random.default_rng(0)
+    )
+    analysis = ("Pseudomonas", "sample_lvl_sim")
+
+    scores, permuted_score = simulations.score_compendia(
+        simulated_data,
+        permuted_data,
+        NUM_EXPERIMENTS,
+        ["uncorrected", "corrected"],
+        "limma_numpy",
+        True,
+        5,
+        0,
+        str(tmp_path / "in_memory"),
+        *analysis,
+        streams=random_streams.RandomStreams(1, 0),
+    )
+
+    local_dir = str(tmp_path / "on_disk")
+    generate_data_parallel.add_experiments_io(
+        simulated_data,
+        NUM_EXPERIMENTS,
+        0,
+        local_dir,
+        *analysis,
+        streams=random_streams.RandomStreams(1, 0),
+    )
+    generate_data_parallel.apply_correction_io(
+        local_dir, 0, *analysis, NUM_EXPERIMENTS, "limma_numpy"
+    )
+    disk_scores = {
+        flow: similarity_metric_parallel.sim_svcca_io(
+            simulated_data,
+            permuted_data,
+            file_prefix,
+            0,
+            NUM_EXPERIMENTS,
+            True,
+            5,
+            local_dir,
+            *analysis,
+            streams=random_streams.RandomStreams(1, 0),
+        )
+        for flow, file_prefix in [
+            ("uncorrected", "Experiment"),
+            ("corrected", "Experiment_corrected"),
+        ]
+    }
+
+    for flow in scores:
+        np.testing.assert_allclose(scores[flow], disk_scores[flow][0])
+        assert disk_scores[flow][1] == pytest.approx(permuted_score)
+
+
+def test_noise_scales_rescale_one_draw(tmp_path, simulated_data, monkeypatch):
+    noise_scales = [0.1, 0.2, 0.4]
+    compendia = []
+
+    def svcca_score(reference, compendium, *args):
+        compendia.append(np.asarray(compendium))
+        return 0.0
+
+    monkeypatch.setattr(similarity_metric_parallel, "svcca_score", svcca_score)
+    _score_compendia(
+        simulated_data, tmp_path, ["uncorrected"], noise_scales=noise_scales
+    )
+
+    batch_effects = generate_data_parallel.add_experiments(
+        simulated_data, NUM_EXPERIMENTS, random_streams.RandomStreams(1, 0)
+    )
+    expected = [
+        simulated_data.values
+        + offsets[assignment] * scale / generate_data_parallel.NOISE_SCALE
+        for offsets, assignment in batch_effects
+        for scale in noise_scales
+    ]
+    # The permuted data is scored last
+    assert len(compendia) == len(expected) + 1
+    for compendium, expected_compendium in zip(compendia, expected):
+        np.testing.assert_allclose(compendium, expected_compendium)
+
+
+def test_noise_scales_score_each_flow_and_scale(tmp_path, simulated_data):
+    flows = ["uncorrected", "corrected"]
+    noise_scales = [0.1, 0.2, 0.4]
+
+    scores, _ = _score_compendia(
+        simulated_data, tmp_path, flows, noise_scales=noise_scales
+    )
+    default_scores, _ = _score_compendia(simulated_data, tmp_path, flows)
+
+    assert sorted(scores) == sorted(flows)
+    for flow in flows:
+        assert list(scores[flow].index) == NUM_EXPERIMENTS
+        assert list(scores[flow].columns) == noise_scales
+        np.testing.assert_allclose(
+            scores[flow][generate_data_parallel.NOISE_SCALE], default_scores[flow]
+        )
+
+
+def test_low_rank_and_fused_limma_scores_match_materialized_compendia(
+    tmp_path, simulated_data
+):
+    flows = ["uncorrected", "corrected"]
+
+    scores, _ = _score_compendia(simulated_data, tmp_path, flows)
+    low_rank_scores, _ = _score_compendia(
+        simulated_data, tmp_path, flows, low_rank_svcca=True
+    )
+
+    for flow in flows:
+        np.testing.assert_allclose(low_rank_scores[flow], scores[flow], atol=1e-4)
+
+
+def test_fused_limma_scores_corrected_compendia_from_decomposition(
+    tmp_path, simulated_data, monkeypatch
+):
+    scores, _ = _score_compendia(
+        simulated_data, tmp_path, ["uncorrected", "corrected"], low_rank_svcca=True
+    )
+
+    low_rank_pca_basis = similarity_metric_parallel.low_rank_pca_basis
+    calls = []
+
+    def count_calls(*args, **kwargs):
+        calls.append(1)
+        return low_rank_pca_basis(*args, **kwargs)
+
+    def iter_compendia(*args, **kwargs):
+        raise AssertionError("compendia are materialized")
+
+    monkeypatch.setattr(similarity_metric_parallel, "low_rank_pca_basis", count_calls)
+    monkeypatch.setattr(generate_data_parallel, "iter_compendia", iter_compendia)
+    corrected_scores, _ = _score_compendia(
+        simulated_data, tmp_path, ["corrected"], low_rank_svcca=True
+    )
+
+    # Only the basis of the reference compendium
+    assert len(calls) == 1
+    np.testing.assert_allclose(corrected_scores["corrected"], scores["corrected"])
+
+
+def _sweep_compendia(simulated_data, monkeypatch, **kwargs):
+    # Sweep up to 40 experiments, recording the numbers of experiments scored
+    add_experiments = generate_data_parallel.add_experiments
+    scored = []
+
+    def record_experiments(simulated_data, lst_num_experiments, streams):
+        scored.extend(lst_num_experiments)
+        return add_experiments(simulated_data, lst_num_experiments, streams)
+
+    monkeypatch.setattr(generate_data_parallel, "add_experiments", record_experiments)
+    scores = simulations.sweep_compendia(
+        simulated_data,
+        40,
+        ["uncorrected", "corrected"],
+        "limma_numpy",
+        5,
+        random_streams.RandomStreams(1, 0),
+        **kwargs,
+    )
+    monkeypatch.undo()
+
+    return scores, sorted(scored)
+
+
+def test_dense_sweep_matches_scores_per_number_of_experiments(tmp_path, simulated_data):
+    flows = ["uncorrected", "corrected"]
+
+    sweep_scores, _ = _score_compendia(
+        simulated_data, tmp_path, flows, dense_sweep=True
+    )
+    scores, _ = _score_compendia(simulated_data, tmp_path, flows)
+
+    for flow in flows:
+        assert list(sweep_scores[flow].index) == list(range(1, 11))
+        np.testing.assert_allclose(
+            sweep_scores[flow].loc[NUM_EXPERIMENTS, "score"],
+            scores[flow],
+            atol=1e-4,
+        )
+
+
+def test_dense_sweep_requires_pca(tmp_path, simulated_data):
+    with pytest.raises(ValueError):
+        simulations.score_compendia(
+            simulated_data,
+            simulated_data,
+            NUM_EXPERIMENTS,
+            ["uncorrected"],
+            "limma_numpy",
+            False,
+            5,
+            0,
+            str(tmp_path),
+            "Pseudomonas",
+            "experiment_lvl_sim",
+            dense_sweep=True,
+        )
+
+
+def test_adaptive_sweep_refines_until_scores_are_interpolated(
+    simulated_data, monkeypatch
+):
+    scores, scored = _sweep_compendia(simulated_data, monkeypatch)
+    adaptive_scores, adaptive_scored = _sweep_compendia(
+        simulated_data, monkeypatch, adaptive=True, tolerance=0.0
+    )
+
+    assert scored == list(range(1, 41))
+    assert adaptive_scored == scored
+    for flow in scores:
+        pd.testing.assert_frame_equal(adaptive_scores[flow], scores[flow])
+
+
+def _initial_intervals():
+    # Intervals between the numbers of experiments first scored by adaptive
+    # sweeps up to 40 experiments, that can be refined
+    initial = sorted(
+        set(np.geomspace(1, 40, simulations.SWEEP_INITIAL_POINTS).round().astype(int))
+    )
+    return initial, [
+        (start, end) for start, end in zip(initial[:-1], initial[1:]) if end - start > 1
+    ]
+
+
+def test_adaptive_sweep_interpolates_unscored_numbers(simulated_data, monkeypatch):
+    scores, _ = _sweep_compendia(simulated_data, monkeypatch)
+    adaptive_scores, scored = _sweep_compendia(
+        simulated_data, monkeypatch, adaptive=True, tolerance=np.inf
+    )
+
+    # Only the initial numbers are scored, and each interval halved once
+    initial, intervals = _initial_intervals()
+    assert scored == sorted(initial + [(start + end) // 2 for start, end in intervals])
+
+    lst_num_experiments = np.arange(1, 41)
+    for flow in scores:
+        np.testing.assert_allclose(
+            adaptive_scores[flow]["score"],
+            np.interp(
+                np.log(lst_num_experiments),
+                np.log(scored),
+                scores[flow].loc[scored, "score"],
+            ),
+        )
+
+
+def test_adaptive_sweep_refines_where_scores_bend(simulated_data, monkeypatch):
+    scores, _ = _sweep_compendia(simulated_data, monkeypatch)
+    tolerance = 0.03
+    adaptive_scores, scored = _sweep_compendia(
+        simulated_data, monkeypatch, adaptive=True, tolerance=tolerance
+    )
+    _, finer_scored = _sweep_compendia(
+        simulated_data, monkeypatch, adaptive=True, tolerance=tolerance / 4
+    )
+
+    assert len(scored) < 40
+    assert set(scored) < set(finer_scored)
+    for flow in scores:
+        np.testing.assert_allclose(
+            adaptive_scores[flow].loc[scored], scores[flow].loc[scored]
+        )
+
+    # Both halves of an interval are refined if the score of its midpoint
+    # is not interpolated within the tolerance
+    _, intervals = _initial_intervals()
+    for start, end in intervals:
+        midpoint = (start + end) // 2
+        bends = any(
+            abs(
+                scores[flow].loc[midpoint, "score"]
+                - np.interp(
+                    np.log(midpoint),
+                    np.log([start, end]),
+                    scores[flow].loc[[start, end], "score"],
+                )
+            )
+            > tolerance
+            for flow in scores
+        )
+        for half_start, half_end in [(start, midpoint), (midpoint, end)]:
+            if half_end - half_start > 1:
+                assert ((half_start + half_end) // 2 in scored) == bends
@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from simulate_expression_compendia_modules import table_io
+
+REQUIRED_MODULES = {"xz": None, "zstd": "zstandard", "lz4": "lz4", "none": None}
+
+
+@pytest.fixture
+def data():
+    rng = np.random.RandomState(0)
+    return pd.DataFrame(
+        rng.rand(20, 5),
+        index=[f"s{i}" for i in range(20)],
+        columns=[f"PA{i:04d}" for i in range(5)],
+    )
+
+
+@pytest.fixture(params=list(table_io.CODECS))
+def codec(request):
+    if REQUIRED_MODULES[request.param] is not None:
+        pytest.importorskip(REQUIRED_MODULES[request.param])
+    return request.param
+
+
+def test_write_table_round_trip(tmp_path, data, codec):
+    filename = table_io.table_file(str(tmp_path / "data"), codec)
+
+    table_io.write_table(data, filename)
+
+    assert table_io.infer_compression(filename) == codec
+    pd.testing.assert_frame_equal(
+        table_io.read_table(filename, header=0, index_col=0), data
+    )
+
+
+def test_codec_is_detected_from_file_content(tmp_path, data, codec):
+    # The extension does not match the codec used to write the file
+    filename = str(tmp_path / "data.tsv")
+
+    table_io.write_table(data, filename, codec)
+
+    assert table_io.detect_compression(filename) == codec
+    pd.testing.assert_frame_equal(
+        table_io.read_table(filename, header=0, index_col=0), data
+    )
+
+
+def test_parse_compression():
+    assert table_io.parse_compression("xz") == ("xz", None, -1)
+    assert table_io.parse_compression(None) == ("none", None, -1)
+    compression = {"method": "zstd", "level": 9, "threads": 4}
+    assert table_io.parse_compression(compression) == ("zstd", 9, 4)
+
+    with pytest.raises(ValueError):
+        table_io.parse_compression("gzip")
+
+
+def test_file_names(tmp_path):
+    stem = str(tmp_path / "Experiment_1_0")
+
+    assert table_io.table_file(stem, "zstd") == stem + ".txt.zst"
+    assert table_io.file_stem(stem + ".txt.zst") == stem
+    assert table_io.file_stem(stem + ".tsv") == stem
+
+    open(stem + ".txt.lz4", "w").close()
+    assert table_io.find_table_file(stem) == stem + ".txt.lz4"
+
+    with pytest.raises(FileNotFoundError):
+        table_io.find_table_file(str(tmp_path / "Experiment_2_0"))